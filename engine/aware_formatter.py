@@ -5,6 +5,8 @@ from plover.formatting import (Formatter, OutputHelper, _get_last_action,
                                _translation_to_actions, _raw_to_actions)
 from os.path import commonprefix
 from collections import namedtuple
+from latency import recorder as latency
+import log
 
 
 class AwareFormatter(Formatter):
@@ -24,18 +26,36 @@ class AwareFormatter(Formatter):
         This duplicates Formatter's logic - it would be better if
         there was a render(old, new) method that could be overridden.
         """
+        with latency.timed('format'):
+            self._format(undo, do, prev)
+
+    def _format(self, undo, do, prev):
         for t in do:
             last_action = _get_last_action(prev.formatting if prev else None)
-            if t.english:
-                t.formatting = _translation_to_actions(t.english, last_action, False)
-            else:
-                t.formatting = _raw_to_actions(t.rtfcre[0], last_action, False)
+            # Translations being redone after an undo usually follow the
+            # same action as when they were first formatted; reuse the
+            # cached actions then.
+            if getattr(t, 'formatted_after', None) is not last_action:
+                if t.english:
+                    t.formatting = _translation_to_actions(
+                        t.english, last_action, False)
+                else:
+                    t.formatting = _raw_to_actions(
+                        t.rtfcre[0], last_action, False)
+                t.formatted_after = last_action
             prev = t
 
-        old = [a for t in undo for a in t.formatting]
-        new = [a for t in do for a in t.formatting]
-        print "old:", old
-        print "new:", new
+        # Skip leading translations whose actions are unchanged, so only
+        # the changed tail is flattened and compared below.
+        n = 0
+        min_length = min(len(undo), len(do))
+        while n < min_length and undo[n].formatting == do[n].formatting:
+            n += 1
+
+        old = [a for t in undo[n:] for a in t.formatting]
+        new = [a for t in do[n:] for a in t.formatting]
+        if log.is_enabled_for(log.DEBUG):
+            log.debug("format", old=old, new=new)
 
         min_length = min(len(old), len(new))
         for i in xrange(min_length):
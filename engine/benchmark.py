@@ -0,0 +1,435 @@
+"""Headless benchmarks for the steno pipeline
+
+Replays key event streams through Stenotype and Steno against a
+FakeOutput and reports strokes per second, per-stroke latency
+percentiles and the net number of objects left allocated. Bundled
+corpora run against a small bundled dictionary; recorded streams (see
+replay.py) can be given on the command line instead.
+
+    python benchmark.py [-n ITERATIONS] [-d DICTIONARY] [-s LOG_FILE]
+                        [EVENTS_FILE...]
+    python benchmark.py --chords [-n ITERATIONS]
+    python benchmark.py --lookups [-n ITERATIONS] [-d DICTIONARY]
+    python benchmark.py --undo [-n ITERATIONS] [-d DICTIONARY]
+    python benchmark.py --suggestions [-d DICTIONARY]
+
+-s enables Plover's stroke and translation logging to LOG_FILE, to
+measure its cost on the stroke path.
+
+--chords runs a microbenchmark of chord accumulation alone, comparing
+Stenotype with the set-based implementation it replaced.
+
+--lookups replays the dictionary lookups the translator makes for a
+stream of strokes taken from the dictionaries' own entries, comparing
+the plain dictionary collection with the indexed one, and checks that
+both give the same results. Use it with full-size dictionaries; -d
+may be repeated to stack several, lowest precedence first.
+
+--undo times strokes with the translator's undo history filled to
+depths from 10 to 1000, with the ring buffer of undo_history and with
+Plover's list-based history, and checks that both write the same text.
+
+--suggestions builds the reverse index of suggestions.py and times
+brief queries for the dictionaries' own entries, and prefix queries.
+"""
+
+import gc
+import sys
+import random
+import getopt
+
+import plover.config
+from plover.machine.base import StenotypeBase, STATE_RUNNING
+from plover.steno_dictionary import StenoDictionaryCollection
+from plover.translation import _State as ListState
+
+from latency import monotonic, Histogram
+import replay
+import plover_machine
+from plover_machine import KEYCODE_TO_STENO_KEY
+from dictionary_collection import IndexedDictionaryCollection
+from ploverlink import default_options
+import suggestions
+
+DICTIONARY = {
+    'KAT': u'cat',
+    'TKOG': u'dog',
+    'THE': u'the',
+    'AEU': u'a',
+    'PHAPB': u'man',
+    'WOPL': u'woman',
+    'HORS': u'horse',
+    'STPH': u'is',
+    'TPH': u'in',
+    'PWEU': u'by',
+    'SAT': u'sat',
+    'ORPB': u'on',
+    'PHAT': u'mat',
+    '-G': u'{^ing}',
+    '-S': u'{^s}',
+    'KPA': u'{-|}',
+    'TP-PL': u'{.}',
+    'KW-BG': u'{,}',
+    'KAT/A/HROG': u'catalogue',
+    'TKEUBGS/PHAEUR': u'dictionary',
+    'STEPB/TKPWRAFR': u'stenographer',
+    'STEPB/TKPWRAFR/-S': u'stenographers',
+    'PHAPB/AEU/SKWRER': u'manager',
+    'HORS/PWABG': u'horseback',
+}
+
+CORPORA = [
+    ('briefs',
+     'KPA THE KAT SAT ORPB THE PHAT TP-PL '
+     'KPA AEU TKOG STPH TPH THE HORS KW-BG PWEU THE WOPL TP-PL'),
+    ('multistroke',
+     'KPA THE STEPB TKPWRAFR STPH TPH THE KAT A HROG TP-PL '
+     'KPA AEU PHAPB AEU SKWRER SAT ORPB HORS PWABG KW-BG '
+     'STEPB TKPWRAFR -S TPH TKEUBGS PHAEUR TP-PL'),
+    ('undo',
+     'KAT * TKOG * KAT A * * HROG * THE * '
+     'STEPB TKPWRAFR * * -S * PHAPB AEU SKWRER * * * KAT TKOG * *'),
+]
+
+UNDO_DEPTHS = (10, 100, 1000)
+
+
+class SetStenotype(StenotypeBase):
+    """The original set-based chord accumulation, for comparison."""
+
+    def __init__(self):
+        StenotypeBase.__init__(self)
+        self._down_keys = set()
+        self._released_keys = set()
+
+    def start_capture(self):
+        self._ready()
+
+    def key_down(self, keycode):
+        if self.state != STATE_RUNNING:
+            return False
+        elif keycode in KEYCODE_TO_STENO_KEY:
+            self._down_keys.add(keycode)
+            return True
+        else:
+            return False
+
+    def key_up(self, keycode):
+        if self.state != STATE_RUNNING:
+            return False
+        if keycode in KEYCODE_TO_STENO_KEY:
+            self._released_keys.add(keycode)
+            self._released_keys = \
+                self._released_keys.intersection(self._down_keys)
+            send_strokes = bool(self._down_keys and
+                                self._down_keys == self._released_keys)
+            if send_strokes:
+                steno_keys = [KEYCODE_TO_STENO_KEY[k] for k in self._down_keys]
+                self._down_keys.clear()
+                self._released_keys.clear()
+                self._notify(steno_keys)
+            return True
+        return False
+
+
+def time_chords(name, machine, events, iterations):
+    machine.add_stroke_callback(lambda steno_keys: None)
+    machine.start_capture()
+    RELEASE_MASK = replay.RELEASE_MASK
+    key_down = machine.key_down
+    key_up = machine.key_up
+    gc.collect()
+    objects_before = len(gc.get_objects())
+    # Best of several runs, as timeit does, to filter out noise
+    elapsed = None
+    for _ in xrange(5):
+        start = monotonic()
+        for _ in xrange(iterations):
+            for keyval, keycode, state in events:
+                if state & RELEASE_MASK:
+                    key_up(keycode)
+                else:
+                    key_down(keycode)
+        run_time = monotonic() - start
+        if elapsed is None or run_time < elapsed:
+            elapsed = run_time
+    gc.collect()
+    print "%-14s %12.0f %10.3f %9d" % (
+        name, len(events) * iterations / elapsed,
+        elapsed / (len(events) * iterations) * 1e6,
+        len(gc.get_objects()) - objects_before)
+
+
+def run_chords(iterations):
+    events = []
+    for name, strokes in CORPORA:
+        events.extend(replay.strokes_to_events(strokes.split()))
+    print "%-14s %12s %10s %9s" % ("machine", "events/s", "us/event",
+                                   "objects")
+    time_chords("sets", SetStenotype(), events, iterations)
+    time_chords("bitmasks", plover_machine.Stenotype({'arpeggiate': False}),
+                events, iterations)
+
+
+def lookup_probes(dicts, strokes=20000):
+    """The keys a translator looks up for a stream of strokes.
+
+    The stream concatenates random entries; for each stroke every key
+    ending with it, up to the longest key length, is probed, longest
+    first, as Translator does when no translation boundaries limit it.
+    """
+    rng = random.Random(0)
+    keys = [k for d in dicts for k in d]
+    longest_key = max(len(k) for k in keys)
+    stream = []
+    while len(stream) < strokes:
+        stream.extend(rng.choice(keys))
+    probes = []
+    for i in xrange(len(stream)):
+        for n in xrange(min(longest_key, i + 1), 0, -1):
+            probes.append(tuple(stream[i + 1 - n:i + 1]))
+    return probes
+
+
+def time_lookups(name, collection, probes, iterations):
+    """Time lookups of probes; return their results."""
+    lookup = collection.lookup
+    elapsed = None
+    for _ in xrange(3):
+        start = monotonic()
+        for _ in xrange(iterations):
+            for key in probes:
+                lookup(key)
+        run_time = monotonic() - start
+        if elapsed is None or run_time < elapsed:
+            elapsed = run_time
+    results = [lookup(key) for key in probes]
+    print "%-14s %12.0f %10.3f %9d" % (
+        name, len(probes) * iterations / elapsed,
+        elapsed / (len(probes) * iterations) * 1e6,
+        sum(1 for r in results if r is not None))
+    return results
+
+
+def run_lookups(dicts, iterations):
+    probes = lookup_probes(dicts)
+    plain = StenoDictionaryCollection()
+    plain.set_dicts(dicts)
+    indexed = IndexedDictionaryCollection()
+    start = monotonic()
+    indexed.set_dicts(dicts)
+    build_time = monotonic() - start
+    print "%d entries in %d dictionaries, index of %d nodes built in %.2fs" % (
+        sum(len(d) for d in dicts), len(dicts), len(indexed.index),
+        build_time)
+    print "%-14s %12s %10s %9s" % ("collection", "lookups/s", "us/lookup",
+                                   "hits")
+    expected = time_lookups("plain", plain, probes, iterations)
+    results = time_lookups("indexed", indexed, probes, iterations)
+    differences = sum(1 for a, b in zip(expected, results) if a != b)
+    if differences:
+        print "%d lookups differ from the plain collection" % differences
+
+
+def time_undo(name, events, dicts, depth, iterations, state=None):
+    """Time strokes with the undo history at depth; return the text.
+
+    state, if given, replaces the translator's own empty state.
+    """
+    options = default_options()
+    options['undo_depth'] = depth
+    pipeline = replay.Pipeline(dicts, options=options)
+    translator = pipeline.steno.translator
+    if state is not None:
+        translator.set_state(state)
+        translator.set_min_undo_length(depth)
+    timer = StrokeTimer(pipeline)
+    # Fill the history before measuring
+    strokes = sum(1 for e in events if e[2] & replay.RELEASE_MASK) or 1
+    for _ in xrange(depth / strokes + 2):
+        pipeline.replay(events)
+    timer.histogram = Histogram()
+    timer.strokes = 0
+
+    start = monotonic()
+    for _ in xrange(iterations):
+        timer.run(pipeline, events)
+    elapsed = monotonic() - start
+    h = timer.histogram
+    print "%6d %-8s %12d %10.0f %9.1f %9.1f %9.1f" % (
+        depth, name, len(translator.get_state().translations),
+        timer.strokes / elapsed, h.percentile(50) * 1e6,
+        h.percentile(95) * 1e6, h.percentile(99) * 1e6)
+    return pipeline.output.text
+
+
+def run_undo(dicts, iterations):
+    events = []
+    for name, strokes in CORPORA:
+        events.extend(replay.strokes_to_events(strokes.split()))
+    print "%6s %-8s %12s %10s %9s %9s %9s" % (
+        "depth", "history", "translations", "strokes/s", "p50 us",
+        "p95 us", "p99 us")
+    for depth in UNDO_DEPTHS:
+        ring = time_undo("ring", events, dicts, depth, iterations)
+        plain = time_undo("list", events, dicts, depth, iterations,
+                          ListState())
+        if ring != plain:
+            print "Output differs from the list-based history at depth %d" % (
+                depth)
+
+
+def time_queries(name, query, probes):
+    """Time query(probe) for each probe; return the number of hits."""
+    h = Histogram()
+    hits = 0
+    for probe in probes:
+        start = monotonic()
+        result = query(probe)
+        h.add(monotonic() - start)
+        if result:
+            hits += 1
+    print "%-14s %8d %8d %9.1f %9.1f %9.1f %9.1f" % (
+        name, len(probes), hits, h.percentile(50) * 1e6,
+        h.percentile(99) * 1e6, h.max * 1e6, h.total / h.count * 1e6)
+    return hits
+
+
+def run_suggestions(dicts, queries=20000):
+    collection = IndexedDictionaryCollection()
+    collection.set_dicts(dicts)
+    start = monotonic()
+    index = suggestions.SuggestionIndex(dicts)
+    build_time = monotonic() - start
+    print "%d entries, %d texts indexed in %.2fs, %.1f MB" % (
+        sum(len(d) for d in dicts), len(index), build_time,
+        index.memory_usage() / (1024.0 * 1024.0))
+    rng = random.Random(0)
+    entries = [(k, v) for d in dicts for k, v in d.iteritems()]
+    entries = [rng.choice(entries) for _ in xrange(queries)]
+    print "%-14s %8s %8s %9s %9s %9s %9s" % (
+        "query", "queries", "hits", "p50 us", "p99 us", "max us", "mean us")
+    time_queries("briefs",
+                 lambda (key, value): index.briefs(collection, value, key),
+                 entries)
+    time_queries("prefix",
+                 lambda (key, value): index.starting_with(value[:3]),
+                 entries)
+
+
+class StrokeTimer(object):
+    """Measure key events from the start of a stroke to its output."""
+
+    def __init__(self, pipeline):
+        self.histogram = Histogram()
+        self.strokes = 0
+        self._elapsed = 0.0
+        pipeline.machine.add_stroke_callback(self._stroke_done)
+
+    def _stroke_done(self, steno_keys):
+        self._done = True
+
+    def run(self, pipeline, events):
+        for event in events:
+            self._done = False
+            start = monotonic()
+            pipeline.process_key_event(*event)
+            self._elapsed += monotonic() - start
+            if self._done:
+                self.histogram.add(self._elapsed)
+                self.strokes += 1
+                self._elapsed = 0.0
+
+
+def run(name, events, dicts, iterations, config=None):
+    pipeline = replay.Pipeline(dicts, config=config)
+    timer = StrokeTimer(pipeline)
+    # Warm up caches before measuring
+    pipeline.replay(events)
+    timer.histogram = Histogram()
+    timer.strokes = 0
+
+    gc.collect()
+    objects_before = len(gc.get_objects())
+    start = monotonic()
+    for _ in xrange(iterations):
+        timer.run(pipeline, events)
+    elapsed = monotonic() - start
+    gc.collect()
+    objects_after = len(gc.get_objects())
+
+    h = timer.histogram
+    print "%-14s %8d %10.0f %9.1f %9.1f %9.1f %9d %6d" % (
+        name, timer.strokes, timer.strokes / elapsed,
+        h.percentile(50) * 1e6, h.percentile(95) * 1e6,
+        h.percentile(99) * 1e6, objects_after - objects_before,
+        pipeline.output.mismatches)
+
+
+def main():
+    iterations = 200
+    dictionaries = []
+    chords = False
+    lookups = False
+    undo = False
+    suggestion_queries = False
+    config = None
+    opts, args = getopt.getopt(sys.argv[1:], "n:d:s:",
+                               ["iterations=", "dictionary=", "chords",
+                                "lookups", "undo", "suggestions",
+                                "stroke-log="])
+    for o, a in opts:
+        if o in ("-n", "--iterations"):
+            iterations = int(a)
+        elif o in ("-d", "--dictionary"):
+            dictionaries.append(a)
+        elif o == "--chords":
+            chords = True
+        elif o == "--lookups":
+            lookups = True
+        elif o == "--undo":
+            undo = True
+        elif o == "--suggestions":
+            suggestion_queries = True
+        elif o in ("-s", "--stroke-log"):
+            config = plover.config.Config()
+            config.set_log_file_name(a)
+            config.set_enable_stroke_logging(True)
+            config.set_enable_translation_logging(True)
+
+    if chords:
+        run_chords(iterations * 10)
+        return
+
+    if dictionaries:
+        from plover.dictionary.base import load_dictionary
+        dicts = [load_dictionary(f) for f in dictionaries]
+    else:
+        dicts = [replay.make_dictionary(DICTIONARY)]
+
+    if lookups:
+        run_lookups(dicts, max(iterations / 100, 1))
+        return
+
+    if undo:
+        run_undo(dicts, iterations)
+        return
+
+    if suggestion_queries:
+        run_suggestions(dicts)
+        return
+
+    if args:
+        corpora = [(f, replay.load_events(f)) for f in args]
+    else:
+        corpora = [(name, replay.strokes_to_events(strokes.split()))
+                   for name, strokes in CORPORA]
+
+    print "%-14s %8s %10s %9s %9s %9s %9s %6s" % (
+        "corpus", "strokes", "strokes/s", "p50 us", "p95 us", "p99 us",
+        "objects", "mism.")
+    for name, events in corpora:
+        run(name, events, dicts, iterations, config)
+
+if __name__ == "__main__":
+    main()
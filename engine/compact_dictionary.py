@@ -0,0 +1,140 @@
+"""Compact in-memory dictionary storage
+
+A plain StenoDictionary keeps a tuple of stroke strings for every key,
+a unicode string for every translation and reverse lookup tables on
+top, which for large dictionaries comes to hundreds of bytes per
+entry. CompactDictionary interns each distinct stroke once and packs
+the stroke numbers of a key into a single integer; translations are
+stored UTF-8 encoded in one byte string table, with identical
+translations stored once.
+
+Like the compiled cache, it keeps no reverse lookup tables.
+"""
+
+import sys
+import array
+
+from plover.steno_dictionary import StenoDictionary
+
+# Bits per stroke number in a packed key
+STROKE_BITS = 20
+STROKE_MASK = (1 << STROKE_BITS) - 1
+
+
+class CompactDictionary(StenoDictionary):
+    """A StenoDictionary storing its entries in packed form."""
+
+    def __init__(self, entries=None):
+        StenoDictionary.__init__(self)
+        self._stroke_numbers = {}
+        # Stroke number -> stroke; numbers start at 1 so that packed
+        # keys of different lengths differ
+        self._strokes = [None]
+        # Packed key -> translation number
+        self._keys = {}
+        # Translation n is _data[_offsets[n]:_offsets[n + 1]]
+        self._data = bytearray()
+        self._offsets = array.array('L', [0])
+        if entries is not None:
+            self._fill(entries)
+
+    def _fill(self, entries):
+        # Share the stored copy of repeated translations while filling
+        numbers = {}
+        longest_key = 0
+        for key, value in entries:
+            n = numbers.get(value)
+            if n is None:
+                n = numbers[value] = self._add_value(value)
+            self._keys[self._pack(key, True)] = n
+            longest_key = max(longest_key, len(key))
+        self._longest_key = max(self._longest_key, longest_key)
+
+    def _pack(self, key, add=False):
+        """Return the packed form of key, or None if a stroke is new."""
+        stroke_numbers = self._stroke_numbers
+        packed = 0
+        shift = 0
+        for stroke in key:
+            n = stroke_numbers.get(stroke)
+            if n is None:
+                if not add:
+                    return None
+                n = stroke_numbers[stroke] = len(self._strokes)
+                self._strokes.append(stroke)
+            packed |= n << shift
+            shift += STROKE_BITS
+        return packed
+
+    def _unpack(self, packed):
+        key = []
+        while packed:
+            key.append(self._strokes[packed & STROKE_MASK])
+            packed >>= STROKE_BITS
+        return tuple(key)
+
+    def _add_value(self, value):
+        self._data.extend(value.encode('utf-8'))
+        self._offsets.append(len(self._data))
+        return len(self._offsets) - 2
+
+    def _value(self, n):
+        return self._data[self._offsets[n]:self._offsets[n + 1]].decode(
+            'utf-8')
+
+    def get(self, key, default=None):
+        n = self._keys.get(self._pack(key))
+        if n is None:
+            return default
+        return self._value(n)
+
+    def __getitem__(self, key):
+        n = self._keys.get(self._pack(key))
+        if n is None:
+            raise KeyError(key)
+        return self._value(n)
+
+    def __contains__(self, key):
+        return self._pack(key) in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        for packed in self._keys.keys():
+            yield self._unpack(packed)
+
+    def iteritems(self):
+        for packed, n in self._keys.items():
+            yield self._unpack(packed), self._value(n)
+
+    def __setitem__(self, key, value):
+        # Replaced translations stay in the table; runtime changes
+        # are few.
+        self._keys[self._pack(key, True)] = self._add_value(value)
+        self._longest_key = max(self._longest_key, len(key))
+
+    def __delitem__(self, key):
+        packed = self._pack(key)
+        if packed not in self._keys:
+            raise KeyError(key)
+        del self._keys[packed]
+        if len(key) == self.longest_key:
+            self._longest_key = max([len(k) for k in self] or [0])
+
+    def memory_usage(self):
+        """Approximate number of bytes held by the entries."""
+        size = sys.getsizeof(self._keys) + sys.getsizeof(self._stroke_numbers)
+        size += sys.getsizeof(self._strokes)
+        size += sum(sys.getsizeof(s) for s in self._strokes)
+        size += sum(sys.getsizeof(k) for k in self._keys)
+        size += sys.getsizeof(self._data)
+        size += self._offsets.itemsize * len(self._offsets)
+        return size
+
+
+def compact(source):
+    """Return a CompactDictionary with the entries of source."""
+    d = CompactDictionary(source.iteritems())
+    d.set_path(source.get_path())
+    return d
@@ -0,0 +1,239 @@
+"""Precompiled, memory-mapped dictionary cache
+
+Source dictionaries are parsed once and written out as a flat hash
+table next to the Plover config. Later starts map the compiled file
+and serve lookups straight from the mapped index, so startup time and
+resident memory don't depend on the size of the dictionaries.
+
+File layout (all integers little endian):
+
+    header   magic, entry count, slot count, longest key,
+             source mtime, source size
+    slots    (hash, offset) pairs, open addressing, offset 0 is empty
+    entries  (key length, value length, key, value) records
+
+Keys are the strokes joined with '/' and values are stored as UTF-8.
+"""
+
+import os
+import sys
+import mmap
+import zlib
+import struct
+import hashlib
+
+import plover.config
+from plover.steno_dictionary import StenoDictionary
+from plover.dictionary.base import load_dictionary
+
+MAGIC = 'IBPLDIC1'
+HEADER = struct.Struct('<8sIIIdQ')
+SLOT = struct.Struct('<II')
+RECORD = struct.Struct('<HI')
+
+CACHE_DIR = os.path.join(os.path.dirname(plover.config.CONFIG_FILE),
+                         'ibus-plover-cache')
+
+
+def _encode_key(key):
+    return u'/'.join(key).encode('utf-8')
+
+
+def _hash(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+def cache_file_name(filename):
+    """Return the path of the compiled cache for a source dictionary."""
+    path = os.path.abspath(filename)
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    digest = hashlib.sha1(path).hexdigest()
+    return os.path.join(CACHE_DIR, digest + '.dict')
+
+
+def _source_stamp(filename):
+    st = os.stat(filename)
+    return st.st_mtime, st.st_size
+
+
+def is_fresh(filename):
+    """Whether the compiled cache for filename matches the source file."""
+    try:
+        with open(cache_file_name(filename), 'rb') as f:
+            header = f.read(HEADER.size)
+    except IOError:
+        return False
+    if len(header) != HEADER.size:
+        return False
+    magic, _, _, _, mtime, size = HEADER.unpack(header)
+    return magic == MAGIC and (mtime, size) == _source_stamp(filename)
+
+
+def build(filename):
+    """Parse a source dictionary and write its compiled cache."""
+    mtime, size = _source_stamp(filename)
+    source = load_dictionary(filename)
+
+    records = []
+    for key, value in source.iteritems():
+        records.append((_encode_key(key), value.encode('utf-8')))
+
+    n_slots = 1
+    while n_slots < 2 * len(records):
+        n_slots *= 2
+    slots = [(0, 0)] * n_slots
+    offset = HEADER.size + n_slots * SLOT.size
+    for key, value in records:
+        h = _hash(key)
+        i = h & (n_slots - 1)
+        while slots[i][1]:
+            i = (i + 1) & (n_slots - 1)
+        slots[i] = (h, offset)
+        offset += RECORD.size + len(key) + len(value)
+
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    path = cache_file_name(filename)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(records), n_slots,
+                            source.longest_key, mtime, size))
+        f.write(''.join(SLOT.pack(h, o) for h, o in slots))
+        for key, value in records:
+            f.write(RECORD.pack(len(key), len(value)))
+            f.write(key)
+            f.write(value)
+    os.rename(tmp, path)
+    return path
+
+
+def load(filename):
+    """Return a CompiledDictionary for filename, rebuilding it if stale."""
+    if not is_fresh(filename):
+        build(filename)
+    d = CompiledDictionary(cache_file_name(filename))
+    d.set_path(filename)
+    return d
+
+
+class CompiledDictionary(StenoDictionary):
+    """A read-mostly StenoDictionary backed by a compiled cache file.
+
+    Entries are looked up in the mapped file. Changes made at runtime
+    are kept in a small in-memory overlay on top of it.
+    """
+
+    def __init__(self, cache_file):
+        StenoDictionary.__init__(self)
+        self.cache_file = cache_file
+        with open(cache_file, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self._entries, self._slots, longest_key,
+         _, _) = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a compiled dictionary' % cache_file)
+        self._deleted = set()
+        self._overlay_only = 0
+        self._longest_key = longest_key
+
+    def _find(self, key):
+        data = _encode_key(key)
+        h = _hash(data)
+        mask = self._slots - 1
+        i = h & mask
+        m = self._map
+        while True:
+            slot_hash, offset = SLOT.unpack_from(m,
+                                                 HEADER.size + i * SLOT.size)
+            if not offset:
+                return None
+            if slot_hash == h:
+                key_length, value_length = RECORD.unpack_from(m, offset)
+                start = offset + RECORD.size
+                if m[start:start + key_length] == data:
+                    start += key_length
+                    return m[start:start + value_length].decode('utf-8')
+            i = (i + 1) & mask
+
+    def stamp(self):
+        """The header of the cache file, which changes when it is rebuilt."""
+        return self._map[:HEADER.size]
+
+    def compiled_items(self):
+        """Iterate over the entries of the file, ignoring the overlay."""
+        return self._iter_records()
+
+    def changed_keys(self):
+        """Keys changed or deleted since the file was mapped."""
+        return list(self._dict) + list(self._deleted)
+
+    def _iter_records(self):
+        m = self._map
+        offset = HEADER.size + self._slots * SLOT.size
+        for _ in xrange(self._entries):
+            key_length, value_length = RECORD.unpack_from(m, offset)
+            start = offset + RECORD.size
+            key = m[start:start + key_length].decode('utf-8')
+            start += key_length
+            value = m[start:start + value_length].decode('utf-8')
+            offset = start + value_length
+            yield tuple(key.split(u'/')), value
+
+    def get(self, key, default=None):
+        value = self._dict.get(key)
+        if value is not None:
+            return value
+        if key in self._deleted:
+            return default
+        value = self._find(key)
+        if value is None:
+            return default
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return self._entries - len(self._deleted) + self._overlay_only
+
+    def __iter__(self):
+        for key, _ in self._iter_records():
+            if key not in self._deleted and key not in self._dict:
+                yield key
+        for key in self._dict:
+            yield key
+
+    def iteritems(self):
+        for key in self:
+            yield key, self[key]
+
+    def __setitem__(self, key, value):
+        if key not in self._dict:
+            if key in self._deleted:
+                self._deleted.discard(key)
+            elif self._find(key) is None:
+                self._overlay_only += 1
+        self._dict[key] = value
+        self._longest_key = max(self._longest_key, len(key))
+
+    def memory_usage(self):
+        """Approximate number of bytes held, including the mapping."""
+        return (len(self._map) + sys.getsizeof(self._dict) +
+                sys.getsizeof(self._deleted))
+
+    def __delitem__(self, key):
+        if key in self._dict:
+            del self._dict[key]
+            if self._find(key) is None:
+                self._overlay_only -= 1
+                return
+        elif key in self._deleted or self._find(key) is None:
+            raise KeyError(key)
+        self._deleted.add(key)
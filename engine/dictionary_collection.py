@@ -0,0 +1,519 @@
+"""Dictionary collection with a stroke-sequence index
+
+The translator looks up every stroke sequence that could end with the
+new stroke, longest first, and most of those lookups miss. The index
+is a trie over the keys of all dictionaries, read from the last stroke
+backwards, so a sequence that no dictionary entry ends with is
+rejected after a step or two, before any dictionary is consulted.
+
+The index also resolves dictionary precedence: the node of each key
+records which dictionary's entry wins, the first in lookup order with
+a non-empty translation. A lookup then reads that one dictionary
+instead of walking the layers. When a dictionary changes, the winner
+is recomputed for the changed keys only.
+
+Nodes are numbered and all edges are kept in one dict, keyed by
+node * STRIDE + stroke number; one dict per node would cost several
+times the memory. Each node also records the longest key ending with
+the strokes that lead to it.
+
+Nodes are never removed; a deleted key keeps its node with no winner.
+Indexes are shared by every collection over the same dictionaries,
+through the indexes cache.
+
+Building an index reads every entry into memory, which compiled
+dictionaries are there to avoid. The index of compiled dictionaries is
+therefore written to an index file next to their caches, once, and
+mapped on later starts like the dictionaries themselves; keys changed
+at runtime are added in memory. The file is rebuilt when any of the
+compiled caches is. Served dictionaries can't be listed and are left
+unindexed (see indexable).
+
+Index file layout (all integers little endian):
+
+    header        magic, digest of the compiled caches' headers,
+                  stroke count, stroke slots, edge slots, node count
+    stroke slots  (hash, offset) pairs, open addressing, 0 is empty
+    edge slots    (edge, child) pairs, open addressing, 0 is empty
+    longest       longest key length, for each node
+    winners       1 + position of the winning dictionary, for each node
+    strokes       (number, length, stroke) records, UTF-8 encoded
+"""
+
+import os
+import sys
+import mmap
+import zlib
+import array
+import struct
+import hashlib
+
+from plover.steno_dictionary import StenoDictionary, StenoDictionaryCollection
+
+from dictionary_cache import CompiledDictionary
+from index_cache import IndexCache
+import log
+
+# More than the number of distinct strokes in any dictionary
+STRIDE = 1 << 24
+
+INDEX_MAGIC = 'IBPLIDX1'
+INDEX_HEADER = struct.Struct('<8s20sIIII')
+STROKE_SLOT = struct.Struct('<II')
+STROKE_RECORD = struct.Struct('<IH')
+EDGE_SLOT = struct.Struct('<QI')
+LONGEST = struct.Struct('<H')
+
+
+def _collection_reverses():
+    """Whether StenoDictionaryCollection gives later dicts precedence."""
+    first, last = StenoDictionary(), StenoDictionary()
+    collection = StenoDictionaryCollection()
+    collection.set_dicts([first, last])
+    return collection.dicts[0] is last
+
+_REVERSED = _collection_reverses()
+
+
+class StrokeIndex(object):
+    """Trie over the reversed stroke sequences of dictionary keys.
+
+    dicts are given in the order passed to set_dicts.
+    """
+
+    def __init__(self, dicts):
+        # Holding the dictionaries keeps their ids valid as cache keys.
+        # self.dicts is in lookup order, highest precedence first.
+        self.dicts = list(reversed(dicts)) if _REVERSED else list(dicts)
+        self._stroke_numbers = {}
+        self._edges = {}
+        self._longest = array.array('H', [0])
+        # 1 + position in self.dicts of the winning entry; 0 for none
+        self._winners = bytearray(1)
+        # Lowest precedence first, so that winners overwrite
+        for layer in xrange(len(self.dicts) - 1, -1, -1):
+            for key, value in self.dicts[layer].iteritems():
+                node = self._add(key)
+                if value:
+                    self._winners[node] = layer + 1
+
+    def _add(self, key):
+        """Return the node for key, adding nodes as needed."""
+        stroke_numbers = self._stroke_numbers
+        edges = self._edges
+        longest = self._longest
+        length = len(key)
+        node = 0
+        for stroke in reversed(key):
+            n = stroke_numbers.get(stroke)
+            if n is None:
+                n = stroke_numbers[stroke] = len(stroke_numbers) + 1
+            edge = node * STRIDE + n
+            child = edges.get(edge)
+            if child is None:
+                # Extend the node arrays before publishing the edge, as
+                # lookups may run on another thread.
+                child = len(longest)
+                longest.append(0)
+                self._winners.append(0)
+                edges[edge] = child
+            if length > longest[child]:
+                longest[child] = length
+            node = child
+        return node
+
+    def update(self, dictionary, key):
+        """Recompute the winning entry for key after a change."""
+        node = self._add(key)
+        for layer, d in enumerate(self.dicts):
+            if d.get(key):
+                self._winners[node] = layer + 1
+                return
+        self._winners[node] = 0
+
+    def _find(self, strokes):
+        """Return the node for strokes, or 0 if no key ends with them."""
+        stroke_numbers = self._stroke_numbers
+        edges = self._edges
+        node = 0
+        for stroke in reversed(strokes):
+            n = stroke_numbers.get(stroke)
+            if n is None:
+                return 0
+            node = edges.get(node * STRIDE + n, 0)
+            if not node:
+                return 0
+        return node
+
+    def find_dictionary(self, key):
+        """Return the dictionary whose entry for key wins, or None."""
+        # _find inlined: this runs for every lookup
+        stroke_numbers = self._stroke_numbers
+        edges = self._edges
+        node = 0
+        for stroke in reversed(key):
+            n = stroke_numbers.get(stroke)
+            if n is None:
+                return None
+            node = edges.get(node * STRIDE + n, 0)
+            if not node:
+                return None
+        winner = self._winners[node]
+        if not winner:
+            return None
+        return self.dicts[winner - 1]
+
+    def longest_key_ending_with(self, strokes):
+        """Length of the longest key ending with strokes; 0 if none."""
+        return self._longest[self._find(strokes)]
+
+    def memory_usage(self):
+        """Approximate number of bytes held by the index."""
+        int_size = sys.getsizeof(sys.maxint)
+        return (sys.getsizeof(self._edges) + 2 * len(self._edges) * int_size +
+                sys.getsizeof(self._stroke_numbers) +
+                len(self._stroke_numbers) * int_size +
+                self._longest.itemsize * len(self._longest) +
+                len(self._winners))
+
+    def __len__(self):
+        """Number of nodes, excluding the root."""
+        return len(self._longest) - 1
+
+
+def _stroke_hash(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+def _edge_slot(edge, bits):
+    """Slot of edge in a table of 1 << bits slots (Fibonacci hashing)."""
+    return ((edge * 0x9e3779b97f4a7c15) & 0xffffffffffffffff) >> (64 - bits)
+
+
+def _table_size(n):
+    """Slots for n entries: a power of two, at most half full."""
+    size = 2
+    while size < 2 * n:
+        size *= 2
+    return size
+
+
+class MappedStrokeIndex(object):
+    """StrokeIndex read from an index file written by write_index.
+
+    Keys changed at runtime are added in memory, on top of the file.
+    """
+
+    def __init__(self, dicts, filename, digest):
+        self.dicts = list(reversed(dicts)) if _REVERSED else list(dicts)
+        with open(filename, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, file_digest, strokes, self._stroke_slots, self._edge_slots,
+         self._nodes) = INDEX_HEADER.unpack_from(self._map, 0)
+        if magic != INDEX_MAGIC or file_digest != digest:
+            raise ValueError('%s is not the index of these dictionaries' %
+                             filename)
+        self._edge_bits = self._edge_slots.bit_length() - 1
+        self._edges_at = INDEX_HEADER.size + self._stroke_slots * STROKE_SLOT.size
+        self._longest_at = self._edges_at + self._edge_slots * EDGE_SLOT.size
+        self._winners_at = self._longest_at + self._nodes * LONGEST.size
+        # Strokes looked up so far, and those added at runtime
+        self._stroke_numbers = {}
+        self._next_stroke = strokes + 1
+        # Edges, longest key lengths and winners added or changed at
+        # runtime, overriding the file's
+        self._added_edges = {}
+        self._added_longest = {}
+        self._added_winners = {}
+        self._next_node = self._nodes
+
+    def _stroke_number(self, stroke):
+        """Return the number of stroke, or 0 if no key has it."""
+        n = self._stroke_numbers.get(stroke)
+        if n is not None:
+            return n
+        data = stroke.encode('utf-8')
+        h = _stroke_hash(data)
+        mask = self._stroke_slots - 1
+        i = h & mask
+        m = self._map
+        while True:
+            slot_hash, offset = STROKE_SLOT.unpack_from(
+                m, INDEX_HEADER.size + i * STROKE_SLOT.size)
+            if not offset:
+                return 0
+            if slot_hash == h:
+                n, length = STROKE_RECORD.unpack_from(m, offset)
+                start = offset + STROKE_RECORD.size
+                if m[start:start + length] == data:
+                    self._stroke_numbers[stroke] = n
+                    return n
+            i = (i + 1) & mask
+
+    def _child(self, node, n):
+        """Return the child of node along stroke number n, or 0."""
+        edge = node * STRIDE + n
+        child = self._added_edges.get(edge)
+        if child is not None:
+            return child
+        if node >= self._nodes:
+            return 0
+        mask = self._edge_slots - 1
+        i = _edge_slot(edge, self._edge_bits)
+        m = self._map
+        while True:
+            slot_edge, child = EDGE_SLOT.unpack_from(
+                m, self._edges_at + i * EDGE_SLOT.size)
+            if not child or slot_edge == edge:
+                return child
+            i = (i + 1) & mask
+
+    def _longest(self, node):
+        length = self._added_longest.get(node)
+        if length is not None:
+            return length
+        if node >= self._nodes:
+            return 0
+        return LONGEST.unpack_from(
+            self._map, self._longest_at + node * LONGEST.size)[0]
+
+    def _winner(self, node):
+        winner = self._added_winners.get(node)
+        if winner is not None:
+            return winner
+        if node >= self._nodes:
+            return 0
+        return ord(self._map[self._winners_at + node])
+
+    def _add(self, key):
+        """Return the node for key, adding nodes as needed."""
+        length = len(key)
+        node = 0
+        for stroke in reversed(key):
+            n = self._stroke_number(stroke)
+            if not n:
+                n = self._stroke_numbers[stroke] = self._next_stroke
+                self._next_stroke += 1
+            child = self._child(node, n)
+            if not child:
+                child = self._next_node
+                self._next_node += 1
+                # Set up the node before publishing the edge, as
+                # lookups may run on another thread.
+                self._added_longest[child] = 0
+                self._added_winners[child] = 0
+                self._added_edges[node * STRIDE + n] = child
+            if length > self._longest(child):
+                self._added_longest[child] = length
+            node = child
+        return node
+
+    def update(self, dictionary, key):
+        """Recompute the winning entry for key after a change."""
+        node = self._add(key)
+        for layer, d in enumerate(self.dicts):
+            if d.get(key):
+                self._added_winners[node] = layer + 1
+                return
+        self._added_winners[node] = 0
+
+    def _find(self, strokes):
+        """Return the node for strokes, or 0 if no key ends with them."""
+        node = 0
+        for stroke in reversed(strokes):
+            n = self._stroke_number(stroke)
+            if not n:
+                return 0
+            node = self._child(node, n)
+            if not node:
+                return 0
+        return node
+
+    def find_dictionary(self, key):
+        """Return the dictionary whose entry for key wins, or None."""
+        node = self._find(key)
+        if not node:
+            return None
+        winner = self._winner(node)
+        if not winner:
+            return None
+        return self.dicts[winner - 1]
+
+    def longest_key_ending_with(self, strokes):
+        """Length of the longest key ending with strokes; 0 if none."""
+        return self._longest(self._find(strokes))
+
+    def memory_usage(self):
+        """Approximate number of bytes held, including the mapping."""
+        return (len(self._map) + sys.getsizeof(self._stroke_numbers) +
+                sys.getsizeof(self._added_edges) +
+                sys.getsizeof(self._added_longest) +
+                sys.getsizeof(self._added_winners))
+
+    def __len__(self):
+        """Number of nodes, excluding the root."""
+        return self._next_node - 1
+
+
+def write_index(index, filename, digest):
+    """Write a StrokeIndex out as an index file."""
+    strokes = sorted(index._stroke_numbers.iteritems(), key=lambda s: s[1])
+    stroke_slots = _table_size(len(strokes))
+    records_at = (INDEX_HEADER.size + stroke_slots * STROKE_SLOT.size +
+                  _table_size(len(index._edges)) * EDGE_SLOT.size +
+                  len(index._longest) * (LONGEST.size + 1))
+    slots = [(0, 0)] * stroke_slots
+    records = []
+    offset = records_at
+    for stroke, n in strokes:
+        data = stroke.encode('utf-8')
+        h = _stroke_hash(data)
+        i = h & (stroke_slots - 1)
+        while slots[i][1]:
+            i = (i + 1) & (stroke_slots - 1)
+        slots[i] = (h, offset)
+        records.append(STROKE_RECORD.pack(n, len(data)) + data)
+        offset += STROKE_RECORD.size + len(data)
+
+    edge_slots = _table_size(len(index._edges))
+    bits = edge_slots.bit_length() - 1
+    edges = [(0, 0)] * edge_slots
+    for edge, child in index._edges.iteritems():
+        i = _edge_slot(edge, bits)
+        while edges[i][1]:
+            i = (i + 1) & (edge_slots - 1)
+        edges[i] = (edge, child)
+
+    longest = array.array('H', index._longest)
+    if sys.byteorder != 'little':
+        longest.byteswap()
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, digest, len(strokes),
+                                  stroke_slots, edge_slots,
+                                  len(index._longest)))
+        f.write(''.join(STROKE_SLOT.pack(h, o) for h, o in slots))
+        f.write(''.join(EDGE_SLOT.pack(e, c) for e, c in edges))
+        f.write(longest.tostring())
+        f.write(str(index._winners))
+        f.write(''.join(records))
+    os.rename(tmp, filename)
+
+
+class _CompiledEntries(object):
+    """The entries in the file of a compiled dictionary, for StrokeIndex."""
+
+    def __init__(self, dictionary):
+        self.iteritems = dictionary.compiled_items
+
+
+def index_file_name(dicts):
+    """Return the path of the index file for compiled dicts."""
+    names = '\0'.join(d.cache_file for d in dicts)
+    if isinstance(names, unicode):
+        names = names.encode('utf-8')
+    return os.path.join(os.path.dirname(dicts[0].cache_file),
+                        hashlib.sha1(names).hexdigest() + '.index')
+
+
+def _layers_digest(dicts):
+    return hashlib.sha1(''.join(d.stamp() for d in dicts)).digest()
+
+
+def load_index(dicts):
+    """Return a MappedStrokeIndex for compiled dicts.
+
+    The index file is written first if it is missing or stale, which
+    takes as long as building a StrokeIndex.
+    """
+    filename = index_file_name(dicts)
+    digest = _layers_digest(dicts)
+    try:
+        index = MappedStrokeIndex(dicts, filename, digest)
+    except (IOError, ValueError, struct.error):
+        write_index(StrokeIndex([_CompiledEntries(d) for d in dicts]),
+                    filename, digest)
+        index = MappedStrokeIndex(dicts, filename, digest)
+    for d in dicts:
+        for key in d.changed_keys():
+            index.update(d, key)
+    return index
+
+
+def build_index(dicts):
+    """Return the stroke index for dicts.
+
+    Compiled dictionaries are indexed through an index file (see
+    load_index), others in memory.
+    """
+    if dicts and all(isinstance(d, CompiledDictionary) for d in dicts):
+        try:
+            return load_index(dicts)
+        except EnvironmentError as e:
+            # Cache directory not writable, or similar
+            log.warning("Not using an index file: %s", e)
+    return StrokeIndex(dicts)
+
+
+def indexable(dicts):
+    """Whether dicts can be indexed.
+
+    Dictionaries with a false indexable attribute are looked up where
+    they are instead.
+    """
+    return all(getattr(d, 'indexable', True) for d in dicts)
+
+
+# Get an index from a loader thread first, so that set_dicts finds it
+# ready.
+indexes = IndexCache(build_index)
+
+
+class IndexedDictionaryCollection(StenoDictionaryCollection):
+    """StenoDictionaryCollection looking keys up through an index.
+
+    Results are those of the layered walk in StenoDictionaryCollection.
+    """
+
+    def __init__(self):
+        StenoDictionaryCollection.__init__(self)
+        self.index = indexes.get([])
+
+    def set_dicts(self, dicts):
+        self.index = indexes.get(dicts)
+        StenoDictionaryCollection.set_dicts(self, dicts)
+
+    def lookup(self, key):
+        d = self.index.find_dictionary(key)
+        if d is None:
+            return None
+        value = d.get(key)
+        if not value:
+            # Changed without the index being told; walk the layers.
+            return StenoDictionaryCollection.lookup(self, key)
+        for f in self.filters:
+            if f(key, value):
+                return None
+        return value
+
+    def raw_lookup(self, key):
+        d = self.index.find_dictionary(key)
+        if d is None:
+            return None
+        value = d.get(key)
+        if not value:
+            return StenoDictionaryCollection.raw_lookup(self, key)
+        return value
+
+    def set(self, key, value, dictionary=None):
+        StenoDictionaryCollection.set(self, key, value, dictionary)
+        # dictionary is a path, as in StenoDictionaryCollection
+        if dictionary is None:
+            d = self.dicts[0]
+        else:
+            d = self.get_by_path(dictionary)
+        self.index.update(d, key)
+
+    def longest_key_ending_with(self, strokes):
+        """Length of the longest entry that strokes could complete."""
+        return self.index.longest_key_ending_with(strokes)
@@ -0,0 +1,541 @@
+"""Dictionary service shared by the daemons of a multi-user host
+
+Every user's daemon loads its own copy of the dictionaries, so on a
+host with many sessions memory grows with the number of users even
+when they all use the same system-wide dictionaries. The service loads
+each distinct dictionary file once, through the dictionary registry,
+and answers lookups from the daemons over a Unix socket:
+
+    python dictionary_service.py -a DIRECTORY [-a DIRECTORY...]
+                                 [-s SOCKET] [-t STORAGE]
+
+Only files under the -a directories are served; the socket is open to
+every user of the host, who can read those files anyway. STORAGE is a
+dictionary_storage option value (default compiled). Served files are
+reloaded when they change on disk, as in the daemon.
+
+A daemon uses the service when its dictionary_service option names the
+socket. Each of its dictionaries the service serves becomes a
+RemoteDictionary, whose lookups go to the service and are kept in a
+small local LRU cache, misses included, checked with the service at
+least once a second; dictionaries the service refuses, or all of them
+if it can't be reached, are loaded in the daemon as usual. Served
+dictionaries can't be listed, so the stroke index is not used and
+suggestions come from local dictionaries only.
+
+The protocol is one JSON object per line each way. A lookup returns
+the translation of every suffix of the key, since the translator's
+other lookups for a stroke are suffixes of its longest one, and each
+reply carries a generation that changes when the file is reloaded, on
+which the daemon drops its cache.
+"""
+
+import os
+import sys
+import json
+import errno
+import socket
+import getopt
+import threading
+import collections
+
+import gobject
+from plover.steno_dictionary import StenoDictionary
+
+import log
+import memory
+from latency import monotonic
+
+DEFAULT_SOCKET = '/var/run/ibus-plover/dictionaries.sock'
+
+# Entries of each served dictionary a daemon caches
+CACHE_SIZE = 4096
+
+# Seconds to wait for a reply, and between attempts to reconnect
+TIMEOUT = 2.0
+RETRY_INTERVAL = 5.0
+
+# Seconds a daemon goes on with cached entries alone before asking
+# the service again, which tells it of reloads
+CHECK_INTERVAL = 1.0
+
+_MISSING = object()
+
+
+class ServiceError(Exception):
+    """The service could not be reached or refused a request."""
+
+
+class ServiceClient(object):
+    """Connection of a daemon to the service, shared by its threads.
+
+    Reconnects on the next request after the connection is lost.
+    Dictionary ids are only valid on the connection that opened them;
+    connection counts the connections made so far.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = 0
+        self._lock = threading.Lock()
+        self._socket = None
+        self._file = None
+        self._retry_at = 0.0
+
+    def _connect(self):
+        if monotonic() < self._retry_at:
+            raise ServiceError("dictionary service unavailable")
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(TIMEOUT)
+        try:
+            s.connect(self.path)
+        except socket.error:
+            s.close()
+            self._retry_at = monotonic() + RETRY_INTERVAL
+            raise
+        self._socket = s
+        self._file = s.makefile('rb')
+        self.connection += 1
+
+    def _disconnect(self):
+        if self._socket is not None:
+            self._file.close()
+            self._socket.close()
+            self._socket = self._file = None
+
+    def call(self, request):
+        """Send request and return the reply."""
+        with self._lock:
+            try:
+                if self._socket is None:
+                    self._connect()
+                self._socket.sendall(json.dumps(request) + '\n')
+                line = self._file.readline()
+            except socket.error as e:
+                self._disconnect()
+                raise ServiceError("dictionary service: %s" % e)
+            if not line:
+                self._disconnect()
+                raise ServiceError("dictionary service closed the connection")
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise ServiceError(reply['error'])
+        return reply
+
+    def stats(self):
+        """Return what the service has loaded and for how many clients."""
+        return self.call({'op': 'stats'})
+
+
+class RemoteDictionary(StenoDictionary):
+    """A dictionary held by the service.
+
+    Changes made at runtime, such as added translations, are kept in
+    an in-memory overlay on top of it, as in CompiledDictionary; the
+    served file is never written. Thread-safe, as it is shared by every
+    pipeline of the daemon.
+    """
+
+    # Entries can't be listed
+    indexable = False
+
+    def __init__(self, client, filename, cache_size=CACHE_SIZE):
+        StenoDictionary.__init__(self)
+        self.set_path(filename)
+        self.client = client
+        self._cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._check_at = 0.0
+        self._deleted = set()
+        self._overlay_only = 0
+        self._overlay_longest_key = 0
+        self._open()
+
+    def _open(self):
+        reply = self.client.call({'op': 'open', 'file': self.get_path()})
+        # The connection the call went over; it only reconnects first.
+        self._connection = self.client.connection
+        self._id = reply['id']
+        self._entries = reply['entries']
+        with self._lock:
+            self._cache.clear()
+            self._generation = reply['generation']
+        self._set_served_longest_key(reply['longest_key'])
+
+    def _set_served_longest_key(self, longest_key):
+        self._served_longest_key = longest_key
+        self._longest_key = max(longest_key, self._overlay_longest_key)
+
+    def _fetch(self, key):
+        """Look key and its suffixes up in the service; cache them."""
+        for attempt in (0, 1):
+            try:
+                if self._connection != self.client.connection:
+                    self._open()
+                reply = self.client.call(
+                    {'op': 'lookup', 'id': self._id, 'key': key})
+                break
+            except ServiceError as e:
+                # Ids from a lost connection are refused once reconnected.
+                if attempt or self._connection == self.client.connection:
+                    log.warning("Lookup in %s failed: %s",
+                                self.get_path(), e)
+                    return None
+        values = reply['values']
+        self._check_at = monotonic() + CHECK_INTERVAL
+        with self._lock:
+            if reply['generation'] != self._generation:
+                self._cache.clear()
+                self._generation = reply['generation']
+            for i, value in enumerate(values):
+                self._cache[key[i:]] = value
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        self._set_served_longest_key(reply['longest_key'])
+        return values[0]
+
+    def _get_served(self, key):
+        """The served translation of key, from the cache if fresh."""
+        if len(key) > self._served_longest_key:
+            return None
+        value = _MISSING
+        if monotonic() < self._check_at:
+            with self._lock:
+                value = self._cache.pop(key, _MISSING)
+                if value is not _MISSING:
+                    self._cache[key] = value
+        if value is _MISSING:
+            value = self._fetch(tuple(key))
+        return value
+
+    def get(self, key, default=None):
+        value = self._dict.get(key)
+        if value is not None:
+            return value
+        if key in self._deleted:
+            return default
+        value = self._get_served(key)
+        if value is None:
+            return default
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return self._entries - len(self._deleted) + self._overlay_only
+
+    def __iter__(self):
+        # Served entries can't be listed; only the overlay's
+        return iter(list(self._dict))
+
+    def iteritems(self):
+        return iter(self._dict.items())
+
+    def __setitem__(self, key, value):
+        if key not in self._dict:
+            if key in self._deleted:
+                self._deleted.discard(key)
+            elif self._get_served(key) is None:
+                self._overlay_only += 1
+        self._dict[key] = value
+        self._overlay_longest_key = max(self._overlay_longest_key, len(key))
+        self._longest_key = max(self._longest_key, len(key))
+
+    def __delitem__(self, key):
+        if key in self._dict:
+            del self._dict[key]
+            if self._get_served(key) is None:
+                self._overlay_only -= 1
+                return
+        elif key in self._deleted or self._get_served(key) is None:
+            raise KeyError(key)
+        self._deleted.add(key)
+
+    def close(self):
+        """Let the service drop the dictionary if no one else uses it."""
+        if self._connection != self.client.connection:
+            # Already dropped with the connection that opened it
+            return
+        try:
+            self.client.call({'op': 'close', 'id': self._id})
+        except ServiceError as e:
+            log.warning("Closing %s failed: %s", self.get_path(), e)
+
+    def memory_usage(self):
+        """Approximate number of bytes held by the cache and overlay."""
+        with self._lock:
+            entries = self._cache.items()
+        size = (sys.getsizeof(self._cache) + sys.getsizeof(self._dict) +
+                sys.getsizeof(self._deleted))
+        for key, value in entries:
+            # OrderedDict keeps a 3-item list per entry for its order
+            size += sys.getsizeof(key) + sys.getsizeof(value) + 88
+            size += sum(sys.getsizeof(s) for s in key)
+        return size
+
+
+_clients = {}
+_dictionaries = {}
+_refcounts = collections.Counter()
+_lock = threading.Lock()
+
+
+def get_client(path):
+    """Return the ServiceClient for path, shared by all pipelines."""
+    with _lock:
+        client = _clients.get(path)
+        if client is None:
+            client = _clients[path] = ServiceClient(path)
+        return client
+
+
+def open_dictionaries(path, dictionary_file_names, cache_size=CACHE_SIZE):
+    """Return filename -> RemoteDictionary for the files path serves.
+
+    Files the service refuses, or all if it can't be reached, are left
+    out, to be loaded locally. Served dictionaries are shared by all
+    pipelines and reference counted like those of the dictionary
+    registry; release them with release_dictionaries.
+    """
+    client = get_client(path)
+    served = {}
+    try:
+        for filename in dictionary_file_names:
+            if filename in served:
+                continue
+            # Held while talking to the service: the service opens a
+            # file once per connection, so opening and closing the
+            # same file must not interleave.
+            with _lock:
+                d = _dictionaries.get((path, filename))
+                if d is None:
+                    try:
+                        d = RemoteDictionary(client, filename, cache_size)
+                    except ServiceError as e:
+                        log.info("Loading %s locally: %s", filename, e)
+                        continue
+                    _dictionaries[(path, filename)] = d
+                _refcounts[(path, filename)] += 1
+            served[filename] = d
+    except:
+        release_dictionaries(path, served)
+        raise
+    return served
+
+
+def release_dictionaries(path, dictionary_file_names):
+    """Drop one reference to each of the named served dictionaries."""
+    for filename in dictionary_file_names:
+        with _lock:
+            _refcounts[(path, filename)] -= 1
+            if _refcounts[(path, filename)]:
+                continue
+            del _refcounts[(path, filename)]
+            _dictionaries.pop((path, filename)).close()
+
+
+class DictionaryService(object):
+    """Serves dictionaries under the allowed directories on a socket."""
+
+    def __init__(self, path, allowed, storage='compiled'):
+        self.path = path
+        self.allowed = [os.path.join(os.path.realpath(d), '')
+                        for d in allowed]
+        self.storage = storage
+        # ploverlink imports this module for the client side
+        import ploverlink
+        self._registry = ploverlink.dict_registry
+        self._lock = threading.Lock()
+        # realpath -> id; ids are never reused while the service runs
+        self._ids = {}
+        self._files = {}
+        self._dicts = {}
+        self._users = collections.Counter()
+        self._generations = collections.Counter()
+        self._clients = 0
+        self._registry.watcher.add_listener(self._changed)
+
+    def _changed(self, filename, dictionary, changes):
+        with self._lock:
+            i = self._ids.get(filename)
+            if i is not None:
+                self._generations[i] += 1
+
+    def _open(self, filename, opened):
+        filename = os.path.realpath(filename)
+        if not any(filename.startswith(d) for d in self.allowed):
+            raise ServiceError("%s is not served" % filename)
+        if filename not in opened:
+            d = self._registry.acquire([filename], storage=self.storage)[0]
+            with self._lock:
+                i = self._ids.setdefault(filename, len(self._ids) + 1)
+                self._files[i] = filename
+                self._dicts[i] = d
+                self._users[i] += 1
+            opened[filename] = i
+        i = opened[filename]
+        with self._lock:
+            d = self._dicts[i]
+            generation = self._generations[i]
+        return {'id': i, 'entries': len(d), 'longest_key': d.longest_key,
+                'generation': generation}
+
+    def _release(self, filename, i):
+        with self._lock:
+            self._users[i] -= 1
+            if not self._users[i]:
+                del self._users[i]
+                del self._dicts[i]
+        self._registry.release([filename])
+
+    def _close(self, i, opened):
+        for filename, n in opened.items():
+            if n == i:
+                del opened[filename]
+                self._release(filename, i)
+                return {}
+        raise ServiceError("dictionary %s is not open" % i)
+
+    def _lookup(self, i, key, opened):
+        if i not in opened.itervalues():
+            raise ServiceError("dictionary %s is not open" % i)
+        with self._lock:
+            d = self._dicts[i]
+            generation = self._generations[i]
+        key = tuple(key)
+        return {'values': [d.get(key[n:]) for n in xrange(len(key))],
+                'longest_key': d.longest_key, 'generation': generation}
+
+    def _stats(self):
+        with self._lock:
+            dicts = [(self._files[i], d, self._users[i])
+                     for i, d in self._dicts.iteritems()]
+            clients = self._clients
+        # Sizing a plain dictionary walks its entries; not under the lock
+        dicts = [{'file': filename, 'entries': len(d), 'clients': users,
+                  'size': memory.dictionary_size(d)}
+                 for filename, d, users in dicts]
+        return {'dictionaries': dicts, 'clients': clients,
+                'rss': memory.rss()}
+
+    def _handle(self, request, opened):
+        op = request['op']
+        if op == 'lookup':
+            return self._lookup(request['id'], request['key'], opened)
+        elif op == 'open':
+            return self._open(request['file'], opened)
+        elif op == 'close':
+            return self._close(request['id'], opened)
+        elif op == 'stats':
+            return self._stats()
+        raise ServiceError("unknown request: %s" % op)
+
+    def _serve_client(self, conn):
+        opened = {}
+        with self._lock:
+            self._clients += 1
+        try:
+            f = conn.makefile('rb')
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                try:
+                    reply = self._handle(json.loads(line), opened)
+                except ServiceError as e:
+                    reply = {'error': str(e)}
+                except Exception as e:
+                    log.exception("Error handling %r", line)
+                    reply = {'error': "%s: %s" % (type(e).__name__, e)}
+                conn.sendall(json.dumps(reply) + '\n')
+        except socket.error:
+            pass
+        finally:
+            for filename, i in opened.iteritems():
+                self._release(filename, i)
+            conn.close()
+            with self._lock:
+                self._clients -= 1
+
+    def _accept(self, listener):
+        while True:
+            conn, _ = listener.accept()
+            client = threading.Thread(target=self._serve_client,
+                                      args=(conn,))
+            client.daemon = True
+            client.start()
+
+    def _listen(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(self.path)
+        except socket.error as e:
+            if e.errno != errno.EADDRINUSE:
+                raise
+            # Left over by a service that didn't exit cleanly?
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                os.unlink(self.path)
+                listener.bind(self.path)
+            else:
+                raise ServiceError("%s is already in use" % self.path)
+            finally:
+                probe.close()
+        os.chmod(self.path, 0666)
+        listener.listen(16)
+        return listener
+
+    def run(self):
+        """Serve until interrupted."""
+        listener = self._listen()
+        try:
+            accept = threading.Thread(target=self._accept, args=(listener,))
+            accept.daemon = True
+            accept.start()
+            log.info("Serving dictionaries on %s", self.path)
+            # The dictionary watcher runs on the main loop
+            gobject.MainLoop().run()
+        finally:
+            listener.close()
+            os.unlink(self.path)
+
+
+def main():
+    import ploverlink
+    path = DEFAULT_SOCKET
+    allowed = []
+    storage = 'compiled'
+    opts, args = getopt.getopt(sys.argv[1:], "s:a:t:",
+                               ["socket=", "allow=", "storage="])
+    for o, a in opts:
+        if o in ("-s", "--socket"):
+            path = a
+        elif o in ("-a", "--allow"):
+            allowed.append(a)
+        elif o in ("-t", "--storage"):
+            storage = ploverlink.storage_converter(a)
+    if not allowed:
+        print >> sys.stderr, "No dictionary directories allowed; use -a"
+        sys.exit(2)
+
+    gobject.threads_init()
+    try:
+        DictionaryService(path, allowed, storage).run()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Reload dictionaries in place when their files change
+
+Files are watched with GIO file monitors (inotify on Linux), which
+deliver events through the gobject main loop. When a file changes it
+is re-parsed and diffed against the loaded dictionary on a worker
+thread; only the changed entries are then applied, on the main loop,
+to the dictionary object that the translators already hold. Translator
+and undo state are left alone.
+"""
+
+import threading
+import gobject
+
+try:
+    import gio
+except ImportError:
+    gio = None
+
+from plover.dictionary.base import load_dictionary
+
+import log
+
+
+def diff_dictionaries(old, new):
+    """Return {key: value} for entries that differ; None means deleted."""
+    changes = {}
+    for key, value in new.iteritems():
+        if old.get(key) != value:
+            changes[key] = value
+    for key in old:
+        if key not in new:
+            changes[key] = None
+    return changes
+
+
+def apply_changes(dictionary, changes):
+    for key, value in changes.iteritems():
+        if value is None:
+            if key in dictionary:
+                del dictionary[key]
+        else:
+            dictionary[key] = value
+
+
+class DictionaryWatcher(object):
+    """Watch dictionary files and patch the loaded dictionaries."""
+
+    def __init__(self):
+        self._monitors = {}
+        self._dicts = {}
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """Call callback(filename, dictionary, changes) after a reload."""
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def watch(self, filename, dictionary):
+        """Start watching filename. Must be called on the main loop."""
+        if gio is None or filename in self._monitors:
+            return False
+        monitor = gio.File(filename).monitor_file()
+        monitor.connect("changed", self._file_changed, filename)
+        self._monitors[filename] = monitor
+        self._dicts[filename] = dictionary
+        return False
+
+    def unwatch(self, filename):
+        monitor = self._monitors.pop(filename, None)
+        if monitor is not None:
+            monitor.cancel()
+            del self._dicts[filename]
+
+    def _file_changed(self, monitor, f, other_file, event_type, filename):
+        if event_type not in (gio.FILE_MONITOR_EVENT_CHANGES_DONE_HINT,
+                              gio.FILE_MONITOR_EVENT_CREATED):
+            return
+        reloader = threading.Thread(target=self._reload, args=(filename,))
+        reloader.daemon = True
+        reloader.start()
+
+    def _reload(self, filename):
+        """Parse and diff on a worker thread."""
+        dictionary = self._dicts.get(filename)
+        if dictionary is None:
+            return
+        try:
+            changes = diff_dictionaries(dictionary, load_dictionary(filename))
+        except Exception:
+            log.exception("Reloading %s failed", filename)
+            return
+        if changes:
+            gobject.idle_add(self._apply, filename, dictionary, changes)
+
+    def _apply(self, filename, dictionary, changes):
+        if self._dicts.get(filename) is not dictionary:
+            return False
+        log.info("Reloading %s", filename, changed=len(changes))
+        apply_changes(dictionary, changes)
+        for callback in self._listeners:
+            callback(filename, dictionary, changes)
+        return False
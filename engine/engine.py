@@ -26,31 +26,71 @@ from ibus import keysyms
 from ibus import modifier
 from os.path import commonprefix
 
-from plover.oslayer.keyboardcontrol import KeyboardEmulation
 from ploverlink import Steno
+from state_cache import cache as state_cache
 # from plover import StenoEngine
+from plover.steno import Stroke
 import plover_machine
-from key_combinations import parse_key_combinations
+import keymaps
+import memory
+import key_combinations
+import suggestions
 
 import aware_formatter
 import plover.formatting as formatting
+from latency import recorder as latency
+import replay
+import log
+from ui_scheduler import UIScheduler
+from startup import profile
+
+# Number of characters before the cursor kept in the shadow buffer,
+# at least; more while a longer translation can still be undone
+SHADOW_LENGTH = 200
 
 class Engine(ibus.EngineBase):
     def __init__(self, bus, object_path):
         super(Engine, self).__init__(bus, object_path)
-        self.__is_invalidate = False
+        self.__object_path = object_path
         self.__preedit_string = u""
         self.__aux_string = u""
-        #self.__lookup_table = ibus.LookupTable()
+        # What the client was last sent; None until the first update
+        self.__sent_aux = None
+        self.__sent_preedit = None
+        self.__sent_suggestions = None
+        self.__suggestions = ()
+        self.__ui = UIScheduler(self.__update)
+        # Local copy of the text before the cursor, so that
+        # change_string doesn't need a surrounding text round trip
+        self.__shadow = u""
+        self.__shadow_valid = False
+        # Edits waiting to be sent in batch_output mode
+        self.__pending_delete = 0
+        self.__pending_text = u""
+        self.__flush_queued = False
+        self.__lookup_table = ibus.LookupTable(
+            page_size=suggestions.SUGGESTION_COUNT)
+        self.__lookup_table.set_cursor_visible(False)
         self.__prop_list = ibus.PropList()
-        self.__prop_list.append(ibus.Property(u"test", icon = u"ibus-locale"))
+        self.__engine_commands = {
+            'latency': self.__show_latency,
+            'memory': self.__show_memory,
+        }
         self.__init_plover()
 
     def __init_plover(self):
-        print "Init plover"
+        log.info("Init plover")
         self.machine = plover_machine.Stenotype({'arpeggiate': False})
+        profile.mark('create machine')
         self.steno = Steno(self.machine, self)
-        self.keyboard_control = KeyboardEmulation()
+        profile.mark('create pipeline')
+        log.set_level(self.steno.options['log_level'])
+        self.__keymaps = keymaps.get_keymaps(self.steno.options['keymap_files'])
+        self.__init_keymap_property()
+        profile.mark('load keymaps')
+        state_cache.set_limit(self.steno.options['state_cache_size'] * 1024)
+        self.__batch_output = self.steno.options['batch_output']
+        self.__show_held_keys = self.steno.options['show_held_keys']
 
         # # Patch formatter
         # formatting.Formatter = aware_formatter.AwareFormatter
@@ -66,31 +106,43 @@ class Engine(ibus.EngineBase):
         # plover.app.init_engine(self.steno_engine, self.plover_config)
         #self.steno_engine.set_is_running(True)
 
+    def do_destroy(self):
+        self.steno.forget_state(self.__object_path)
+        self.steno.close()
+        super(Engine, self).do_destroy()
+
     def process_key_event(self, keyval, keycode, state):
+        if replay.recorder.enabled:
+            replay.recorder.record(keyval, keycode, state)
+
         # ignore key presses with modifiers (e.g. Control-C)
         if (state & ~modifier.RELEASE_MASK):
-            return False
+            return self.__pass_through(keyval, keycode, state)
 
         is_press = ((state & modifier.RELEASE_MASK) == 0)
         try:
-            if is_press:
-                handled = self.machine.key_down(keycode)
-            else:
-                handled = self.machine.key_up(keycode)
+            with latency.timed('process_key_event'):
+                if is_press:
+                    handled = self.machine.key_down(keycode)
+                else:
+                    latency.start_stroke()
+                    handled = self.machine.key_up(keycode)
 
-            # # Show steno keys
             if self.__aux_string:
-                self.__aux_string = ""
+                self.__aux_string = u""
+                self.__invalidate()
+            # The held keys are read when the next frame is sent
+            if handled and self.__show_held_keys:
                 self.__invalidate()
-            # self.__aux_string = self.steno.get_steno_string()
-            # self.__invalidate()
         except:
-            import traceback
-            traceback.print_exc()
+            log.exception("Error processing key event")
         
         # Don't pass through key presses corresponding to steno keys
         if not handled:
-            print "...", keyval, keycode, state
+            if log.is_enabled_for(log.DEBUG):
+                log.debug("Passing through key", keyval=keyval,
+                          keycode=keycode, state=state)
+            return self.__pass_through(keyval, keycode, state)
         return handled
 
         if self.__preedit_string:
@@ -126,98 +178,261 @@ class Engine(ibus.EngineBase):
 
         return False
 
+    def __pass_through(self, keyval, keycode, state):
+        """Let the client have a key after the output typed before it.
+
+        Returns True if the pipeline holds the key back for that, to
+        send it with send_key_event.
+        """
+        if self.steno.pass_through(keyval, keycode, state):
+            return True
+        # Edits still waiting in batch_output mode go first
+        self.__flush_edits()
+        # The client will act on this key, possibly moving the cursor
+        self.__shadow_valid = False
+        return False
+
     def __invalidate(self):
-        if self.__is_invalidate:
-            return
-        self.__is_invalidate = True
-        gobject.idle_add(self.__update, priority = gobject.PRIORITY_LOW)
+        self.__ui.invalidate()
 
     def __commit_string(self, text):
-        self.commit_text(ibus.Text(text))
+        with latency.timed('commit_text'):
+            self.commit_text(ibus.Text(text))
         self.__preedit_string = u""
         self.__update()
 
+    def __aux_text(self):
+        if self.__show_held_keys:
+            keys = self.machine.held_keys()
+            if keys:
+                return Stroke(keys).rtfcre
+        return self.__aux_string
+
     def __update(self):
-        preedit_len = len(self.__preedit_string)
-        attrs = ibus.AttrList()
-        if preedit_len > 0:
-            attrs.append(ibus.AttributeForeground(0xff0000, 0, preedit_len))
-        self.update_auxiliary_text(
-            ibus.Text(self.__aux_string, ibus.AttrList()),
-            len(self.__aux_string) > 0)
-        attrs.append(
-            ibus.AttributeUnderline(pango.UNDERLINE_SINGLE, 0, preedit_len))
-        self.update_preedit_text(ibus.Text(self.__preedit_string, attrs),
-                                 preedit_len, preedit_len > 0)
-        self.__is_invalidate = False
+        # Only send what changed since the last update
+        aux_string = self.__aux_text()
+        if aux_string != self.__sent_aux:
+            self.update_auxiliary_text(
+                ibus.Text(aux_string, ibus.AttrList()),
+                len(aux_string) > 0)
+            self.__sent_aux = aux_string
+        if self.__preedit_string != self.__sent_preedit:
+            preedit_len = len(self.__preedit_string)
+            attrs = ibus.AttrList()
+            if preedit_len > 0:
+                attrs.append(
+                    ibus.AttributeForeground(0xff0000, 0, preedit_len))
+            attrs.append(ibus.AttributeUnderline(pango.UNDERLINE_SINGLE, 0,
+                                                 preedit_len))
+            self.update_preedit_text(ibus.Text(self.__preedit_string, attrs),
+                                     preedit_len, preedit_len > 0)
+            self.__sent_preedit = self.__preedit_string
+        if self.__suggestions != self.__sent_suggestions:
+            if self.__suggestions:
+                self.__lookup_table.clean()
+                for brief in self.__suggestions:
+                    self.__lookup_table.append_candidate(ibus.Text(brief))
+                self.update_lookup_table(self.__lookup_table, True)
+            else:
+                self.hide_lookup_table()
+            self.__sent_suggestions = self.__suggestions
 
     def focus_in(self):
-        print "focus in %s" % self.__proxy._object_path
-        sys.stdout.flush()
-        #self.register_properties(self.__prop_list)
+        log.debug("focus in %s", self.__object_path)
+        self.__shadow_valid = False
+        self.steno.restore_state(self.__object_path)
+        # Another engine may have switched keymaps meanwhile
+        if keymaps.selected != self.__keymap_name:
+            self.__set_keymap(keymaps.selected)
+        self.register_properties(self.__prop_list)
+        # The panel may have hidden our text meanwhile; send it again
+        self.__sent_aux = self.__sent_preedit = \
+            self.__sent_suggestions = None
+        self.__invalidate()
 
     def focus_out(self):
-        pass
+        self.__flush_edits()
+        self.__shadow_valid = False
+        self.steno.save_state(self.__object_path)
 
     def reset(self):
-        pass
+        # Clients reset on mouse clicks, among other things
+        self.__flush_edits()
+        self.__shadow_valid = False
 
     def enable(self):
         # Tell IBus we want to use surrounding text later
-        print "enable %s" % self.__proxy._object_path
-        sys.stdout.flush()
+        log.debug("enable %s", self.__object_path)
         self.get_surrounding_text()
 
-    def property_activate(self, prop_name):
-        print "PropertyActivate(%s)" % prop_name
+    def property_activate(self, prop_name, state=ibus.PROP_STATE_CHECKED):
+        log.debug("PropertyActivate(%s)", prop_name)
+        if prop_name.startswith(u"keymap.") and \
+                state == ibus.PROP_STATE_CHECKED:
+            self.__set_keymap(prop_name[len(u"keymap."):])
+
+    def __init_keymap_property(self):
+        name = keymaps.selected or self.steno.options['keymap']
+        if name not in self.__keymaps:
+            log.warning("Unknown keymap %s, using qwerty", name)
+            name = 'qwerty'
+        self.__keymap_props = {}
+        sub_props = ibus.PropList()
+        for n in self.__keymaps:
+            prop = ibus.Property(u"keymap." + n,
+                                 type=ibus.PROP_TYPE_RADIO,
+                                 label=ibus.Text(n))
+            self.__keymap_props[n] = prop
+            sub_props.append(prop)
+        self.__keymap_menu = ibus.Property(u"keymap",
+                                           type=ibus.PROP_TYPE_MENU,
+                                           icon=u"input-keyboard",
+                                           sub_props=sub_props)
+        self.__prop_list.append(self.__keymap_menu)
+        self.__set_keymap(name)
+
+    def __set_keymap(self, name):
+        """Switch the steno keymap profile, keeping the pipeline."""
+        keymap = self.__keymaps.get(name)
+        if keymap is None:
+            return
+        self.machine.set_keymap(keymap)
+        self.__keymap_name = keymaps.selected = name
+        self.__keymap_menu.label = ibus.Text(u"Keymap: %s" % name)
+        for n, prop in self.__keymap_props.iteritems():
+            prop.state = (ibus.PROP_STATE_CHECKED if n == name
+                          else ibus.PROP_STATE_UNCHECKED)
+            self.update_property(prop)
+        self.update_property(self.__keymap_menu)
 
     def __plover_update_status(self, state):
-        print "Plover update status:", state
+        log.debug("Plover update status: %s", state)
 
     def __plover_consume_command(self, command):
-        print "Plover consume command:", command
+        log.debug("Plover consume command: %s", command)
 
     # Plover callbacks
     def change_string(self, before, after):
-        # Check if surrounding text matches text to delete
-        s, p = self.get_surrounding_text()
-        current_text = s.get_text()[p - len(before):p]
-        if current_text != before:
-            print "MISMATCH: '%s' != '%s'" % (before, current_text)
-            return False
+        with latency.timed('change_string'):
+            return self.__change_string(before, after)
+
+    def __resync_shadow(self, length):
+        """Reread the text before the cursor, keeping at least length."""
+        self.__flush_edits()
+        with latency.timed('get_surrounding_text'):
+            s, p = self.get_surrounding_text()
+        self.__shadow = s.get_text()[:p][-max(length, SHADOW_LENGTH):]
+        self.__shadow_valid = True
+
+    def __change_string(self, before, after):
+        # Check if the text before the cursor matches text to delete,
+        # asking the client only if our shadow copy can't tell
+        if not (self.__shadow_valid and self.__shadow.endswith(before)):
+            self.__resync_shadow(len(before))
+            if not self.__shadow.endswith(before):
+                current_text = self.__shadow[-len(before):]
+                log.warning("Mismatch", expected=before,
+                            found=current_text)
+                self.__shadow_valid = False
+                return False
         offset = len(commonprefix([before, after]))
-        print "____", offset, "___", before, '->', after
+        if log.is_enabled_for(log.DEBUG):
+            log.debug("Changing string", offset=offset, before=before,
+                      after=after)
         #print "Changing ok: '%s'" % t
         delete_length = len(before[offset:])
-        self.delete_surrounding_text(-delete_length, delete_length)
+        # Long enough to undo this change without a round trip
+        self.__shadow = (self.__shadow[:len(self.__shadow) - delete_length] +
+                         after[offset:])[-max(len(after), SHADOW_LENGTH):]
+        if self.__batch_output:
+            self.__queue_edit(delete_length, after[offset:])
+            return True
+        if delete_length:
+            with latency.timed('delete_surrounding_text'):
+                self.delete_surrounding_text(-delete_length, delete_length)
         self.__preedit_string += after[offset:]
         self.__commit_string(self.__preedit_string)
         return True
 
+    def __queue_edit(self, delete_length, text):
+        """Merge an edit into the pending (delete, insert) operation."""
+        pending = self.__pending_text
+        if delete_length <= len(pending):
+            self.__pending_text = pending[:len(pending) - delete_length] + text
+        else:
+            self.__pending_delete += delete_length - len(pending)
+            self.__pending_text = text
+        if not self.__flush_queued:
+            self.__flush_queued = True
+            gobject.idle_add(self.__flush_edits)
+
+    def __flush_edits(self):
+        """Send pending edits to the client as one delete and commit."""
+        self.__flush_queued = False
+        delete_length = self.__pending_delete
+        text = self.__pending_text
+        self.__pending_delete = 0
+        self.__pending_text = u""
+        if delete_length:
+            with latency.timed('delete_surrounding_text'):
+                self.delete_surrounding_text(-delete_length, delete_length)
+        if text:
+            self.__preedit_string += text
+            self.__commit_string(self.__preedit_string)
+        return False
+
     def send_key_combination(self, c):
-        print "**** Send key comb:", c
-        # Does it need to be delayed?
-        # wx.CallAfter(self.keyboard_control.send_key_combination, c)
+        log.debug("Send key combination: %s", c)
+        # Text typed before the combination must reach the client first
+        self.__flush_edits()
+        # Forwarded events go straight to the client, so they are not
+        # picked up again by process_key_event.
+        for keyval, keycode, state in key_combinations.compiler.compile(c):
+            self.forward_key_event(keyval, keycode, state)
+        self.__shadow_valid = False
 
-        # Does it need to be protected so it's not picked up again? In
-        # theory yes; but as long as key combos aren't sending steno
-        # key codes it'll be ok.
-        self.keyboard_control.send_key_combination(c)
 
+    def send_key_event(self, keyval, keycode, state):
+        """Forward a key the pipeline held back behind strokes."""
+        self.__flush_edits()
+        self.forward_key_event(keyval, keycode, state)
+        self.__shadow_valid = False
 
     # TODO: test all the commands now
     def send_engine_command(self, c):
-        print "**** Send engine command:", c
-        result = self.engine_command_callback(c)
+        log.debug("Send engine command: %s", c)
+        command = self.__engine_commands.get(c.lower())
+        if command is None:
+            log.warning("Unknown engine command: %s", c)
+            return
+        command()
         # if result and not self.engine.is_running:
         #     self.engine.machine.suppress = self.send_backspaces
 
+    def __show_latency(self):
+        """Engine command: show stroke latency percentiles."""
+        log.info("Stroke latency\n%s", latency.report())
+        self.show_message(latency.summary())
+
+    def __show_memory(self):
+        """Engine command: show memory used by dictionaries and state."""
+        report, summary = memory.report(self.steno)
+        log.info("Memory use\n%s", report)
+        self.show_message(summary)
+
     def show_message(self, message):
         def set_message():
             self.__aux_string = message
             self.__invalidate()
         gobject.idle_add(set_message, priority = gobject.PRIORITY_LOW)
 
+    def show_suggestions(self, briefs):
+        """Show briefs in the lookup table; none hides it."""
+        def set_suggestions():
+            self.__suggestions = tuple(briefs)
+            self.__invalidate()
+        gobject.idle_add(set_suggestions, priority = gobject.PRIORITY_LOW)
+
 
 class EngineFactory(ibus.EngineFactoryBase):
     def __init__(self, bus):
@@ -19,8 +19,8 @@
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
 import ibus
-import engine
-import traceback
+import log
+from startup import profile
 
 class EngineFactory(ibus.EngineFactoryBase):
     def __init__(self, bus):
@@ -32,13 +32,17 @@ class EngineFactory(ibus.EngineFactoryBase):
     def create_engine(self, engine_name):
         if engine_name == "plover":
             self.__id += 1
-            print engine_name, self.__id
+            log.info("Creating engine", name=engine_name, id=self.__id)
             bus_name = "%s/%d" % ("/org/freedesktop/IBus/Plover/Engine",
                                   self.__id)
             try:
+                # Deferred so that the component registers quickly
+                import engine
+                profile.mark('import engine')
                 e = engine.Engine(self.__bus, bus_name)
+                profile.mark('create engine %d' % self.__id)
             except:
-                traceback.print_exc()
+                log.exception("Creating engine failed")
             return e
         return super(EngineFactory, self).create_engine(engine_name)
 
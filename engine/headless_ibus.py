@@ -0,0 +1,363 @@
+"""In-process stand-in for the ibus Python bindings
+
+Lets main.IMApp, factory.EngineFactory and engine.Engine run without an
+IBus daemon, D-Bus or X session, as simulator.py does. install() puts
+this module in place of ibus. Its Bus creates engines through the
+registered factory, each with an InputContext playing the client: it
+keeps the text before the cursor for surrounding text, applies
+commits, deletions and forwarded keys to it, and counts the calls the
+engine makes. Calls are synchronous, where D-Bus ones are not.
+
+The keysyms and modifier tables are the real ones from the installed
+bindings, loaded without the D-Bus parts of the package. Where the
+bindings aren't installed, minimal tables stand in: the masks, and the
+keysyms of printable ASCII, editing, function and modifier keys.
+"""
+
+import os
+import imp
+import sys
+import types
+import collections
+
+PROP_TYPE_NORMAL = 0
+PROP_TYPE_TOGGLE = 1
+PROP_TYPE_RADIO = 2
+PROP_TYPE_MENU = 3
+PROP_TYPE_SEPARATOR = 4
+
+PROP_STATE_UNCHECKED = 0
+PROP_STATE_CHECKED = 1
+PROP_STATE_INCONSISTENT = 2
+
+# Characters of text before the cursor a client reports
+SURROUNDING_LENGTH = 1000
+
+# Buses created so far, most recent last
+buses = []
+
+
+# Names of the keysyms 0x20 to 0x7e
+ASCII_KEYSYMS = (
+    'space exclam quotedbl numbersign dollar percent ampersand apostrophe '
+    'parenleft parenright asterisk plus comma minus period slash '
+    '0 1 2 3 4 5 6 7 8 9 colon semicolon less equal greater question at '
+    'A B C D E F G H I J K L M N O P Q R S T U V W X Y Z '
+    'bracketleft backslash bracketright asciicircum underscore grave '
+    'a b c d e f g h i j k l m n o p q r s t u v w x y z '
+    'braceleft bar braceright asciitilde').split()
+
+OTHER_KEYSYMS = {
+    'BackSpace': 0xff08, 'Tab': 0xff09, 'Return': 0xff0d,
+    'Escape': 0xff1b, 'Delete': 0xffff, 'Home': 0xff50, 'Left': 0xff51,
+    'Up': 0xff52, 'Right': 0xff53, 'Down': 0xff54, 'Page_Up': 0xff55,
+    'Page_Down': 0xff56, 'End': 0xff57, 'Insert': 0xff63,
+    'Mode_switch': 0xff7e, 'Shift_L': 0xffe1, 'Shift_R': 0xffe2,
+    'Control_L': 0xffe3, 'Control_R': 0xffe4, 'Caps_Lock': 0xffe5,
+    'Alt_L': 0xffe9, 'Alt_R': 0xffea, 'Super_L': 0xffeb,
+    'Super_R': 0xffec, 'VoidSymbol': 0xffffff,
+}
+
+MODIFIER_MASKS = {
+    'SHIFT_MASK': 1 << 0, 'LOCK_MASK': 1 << 1, 'CONTROL_MASK': 1 << 2,
+    'MOD1_MASK': 1 << 3, 'MOD2_MASK': 1 << 4, 'MOD3_MASK': 1 << 5,
+    'MOD4_MASK': 1 << 6, 'MOD5_MASK': 1 << 7, 'ALT_MASK': 1 << 3,
+    'SUPER_MASK': 1 << 26, 'HYPER_MASK': 1 << 27, 'META_MASK': 1 << 28,
+    'RELEASE_MASK': 1 << 30,
+}
+
+
+def _load_tables():
+    """Return the keysyms and modifier modules of the real bindings.
+
+    Returns minimal stand-ins if the bindings aren't installed.
+    """
+    try:
+        path = imp.find_module('ibus')[1]
+    except ImportError:
+        return _minimal_tables()
+    return [imp.load_source('ibus.' + name, os.path.join(path, name + '.py'))
+            for name in ('keysyms', 'modifier')]
+
+
+def _minimal_tables():
+    table = dict((name, 0x20 + n) for n, name in enumerate(ASCII_KEYSYMS))
+    table.update(('F%d' % n, 0xffbd + n) for n in xrange(1, 13))
+    table.update(OTHER_KEYSYMS)
+    names = dict((keysym, name) for name, keysym in table.iteritems())
+    keysyms = types.ModuleType('ibus.keysyms')
+    vars(keysyms).update(table)
+    keysyms.name_to_keycode = \
+        lambda name: table.get(name, keysyms.VoidSymbol)
+    keysyms.keycode_to_name = lambda keysym: names.get(keysym, '')
+    modifier = types.ModuleType('ibus.modifier')
+    for name, mask in MODIFIER_MASKS.iteritems():
+        setattr(modifier, name, mask)
+    return keysyms, modifier
+
+
+def install():
+    """Make this module importable as ibus. Call before importing main."""
+    module = sys.modules[__name__]
+    if sys.modules.get('ibus') is not module:
+        module.keysyms, module.modifier = _load_tables()
+        sys.modules['ibus'] = module
+        sys.modules['ibus.keysyms'] = module.keysyms
+        sys.modules['ibus.modifier'] = module.modifier
+    return module
+
+
+class Text(object):
+    def __init__(self, text=u"", attrs=None):
+        self.text = text
+        self.attributes = attrs
+
+    def get_text(self):
+        return self.text
+
+
+class AttrList(list):
+    pass
+
+
+def AttributeForeground(color, start, end):
+    return ('foreground', color, start, end)
+
+
+def AttributeUnderline(underline, start, end):
+    return ('underline', underline, start, end)
+
+
+class Property(object):
+    def __init__(self, key, type=PROP_TYPE_NORMAL, label=None, icon=u"",
+                 tooltip=None, sensitive=True, visible=True,
+                 state=PROP_STATE_UNCHECKED, sub_props=None):
+        self.key = key
+        self.type = type
+        self.label = label
+        self.icon = icon
+        self.tooltip = tooltip
+        self.sensitive = sensitive
+        self.visible = visible
+        self.state = state
+        self.sub_props = sub_props
+
+
+class PropList(list):
+    pass
+
+
+class LookupTable(object):
+    def __init__(self, page_size=5, cursor_pos=0, coursor_visible=True,
+                 round=False):
+        self.page_size = page_size
+        self.cursor_visible = coursor_visible
+        self.candidates = []
+
+    def set_cursor_visible(self, visible):
+        self.cursor_visible = visible
+
+    def append_candidate(self, candidate, label=None):
+        self.candidates.append(candidate)
+
+    def get_number_of_candidates(self):
+        return len(self.candidates)
+
+    def clean(self):
+        self.candidates = []
+
+
+class Component(object):
+    def __init__(self, name, description, version, license, author):
+        self.name = name
+        self.engines = []
+
+    def add_engine(self, name, longname, description, language, license,
+                   author, icon, layout):
+        self.engines.append(name)
+
+
+class Bus(object):
+    """Creates input contexts through the factory registered on it."""
+
+    def __init__(self):
+        self.factory = None
+        self.component = None
+        self.contexts = []
+        self._handlers = collections.defaultdict(list)
+        buses.append(self)
+
+    def connect(self, signal, callback):
+        self._handlers[signal].append(callback)
+
+    def request_name(self, name, flags):
+        pass
+
+    def register_component(self, component):
+        self.component = component
+
+    def create_input_context(self, engine_name=None):
+        """Have the factory create an engine; return its client."""
+        if engine_name is None:
+            engine_name = self.component.engines[0]
+        engine = self.factory.create_engine(engine_name)
+        context = engine.client
+        context.enable()
+        self.contexts.append(context)
+        return context
+
+    def close(self):
+        """Destroy the contexts and disconnect, as when IBus exits."""
+        for context in self.contexts:
+            context.destroy()
+        self.contexts = []
+        for callback in self._handlers['disconnected']:
+            callback(self)
+
+
+class EngineFactoryBase(object):
+    def __init__(self, bus):
+        bus.factory = self
+
+    def create_engine(self, engine_name):
+        raise ValueError("Unknown engine: %s" % engine_name)
+
+
+class InputContext(object):
+    """The client side of an engine: an input field with focus.
+
+    output_callback, if set, is called after each change the engine
+    makes to the text.
+    """
+
+    def __init__(self, object_path):
+        self.object_path = object_path
+        self.engine = None
+        self.text = u""
+        self.aux_text = u""
+        self.preedit_text = u""
+        self.candidates = []
+        self.focused = False
+        self.calls = collections.Counter()
+        self.output_callback = None
+
+    def process_key_event(self, keyval, keycode, state):
+        handled = self.engine.process_key_event(keyval, keycode, state)
+        if not handled:
+            self.type_key(keyval, state)
+        return handled
+
+    def type_key(self, keyval, state):
+        """Apply a key the engine didn't handle, as a text field would."""
+        if state & modifier.RELEASE_MASK:
+            return
+        if keyval == keysyms.BackSpace:
+            self.text = self.text[:-1]
+        elif keyval == keysyms.Return:
+            self._insert(u"\n")
+        elif 0x20 <= keyval < 0x7f and \
+                not state & (modifier.CONTROL_MASK | modifier.MOD1_MASK):
+            self._insert(unichr(keyval))
+
+    def _insert(self, text):
+        self.text = (self.text + text)[-SURROUNDING_LENGTH:]
+
+    def _output(self):
+        if self.output_callback is not None:
+            self.output_callback(self)
+
+    def enable(self):
+        self.engine.enable()
+
+    def focus_in(self):
+        self.focused = True
+        self.engine.focus_in()
+
+    def focus_out(self):
+        self.focused = False
+        self.engine.focus_out()
+
+    def reset(self):
+        self.engine.reset()
+
+    def destroy(self):
+        self.engine.do_destroy()
+
+
+class EngineBase(object):
+    """Engine calls to the client go to an InputContext."""
+
+    def __init__(self, bus, object_path):
+        self.client = InputContext(object_path)
+        self.client.engine = self
+
+    def process_key_event(self, keyval, keycode, state):
+        return False
+
+    def focus_in(self):
+        pass
+
+    def focus_out(self):
+        pass
+
+    def reset(self):
+        pass
+
+    def enable(self):
+        pass
+
+    def disable(self):
+        pass
+
+    def property_activate(self, prop_name, state=PROP_STATE_CHECKED):
+        pass
+
+    def do_destroy(self):
+        pass
+
+    def commit_text(self, text):
+        self.client.calls['commit_text'] += 1
+        self.client._insert(text.get_text())
+        self.client._output()
+
+    def delete_surrounding_text(self, offset_from_cursor, nchars):
+        self.client.calls['delete_surrounding_text'] += 1
+        # Only deletions before the cursor, which is at the end
+        text = self.client.text
+        start = max(len(text) + offset_from_cursor, 0)
+        self.client.text = text[:start] + text[start + nchars:]
+        self.client._output()
+
+    def get_surrounding_text(self):
+        self.client.calls['get_surrounding_text'] += 1
+        return Text(self.client.text), len(self.client.text)
+
+    def forward_key_event(self, keyval, keycode, state):
+        self.client.calls['forward_key_event'] += 1
+        self.client.type_key(keyval, state)
+        self.client._output()
+
+    def update_auxiliary_text(self, text, visible):
+        self.client.calls['update_auxiliary_text'] += 1
+        self.client.aux_text = text.get_text() if visible else u""
+
+    def update_preedit_text(self, text, cursor_pos, visible):
+        self.client.calls['update_preedit_text'] += 1
+        self.client.preedit_text = text.get_text() if visible else u""
+
+    def update_lookup_table(self, lookup_table, visible,
+                            just_current_page=False):
+        self.client.calls['update_lookup_table'] += 1
+        self.client.candidates = ([c.get_text()
+                                   for c in lookup_table.candidates]
+                                  if visible else [])
+
+    def hide_lookup_table(self):
+        self.client.calls['hide_lookup_table'] += 1
+        self.client.candidates = []
+
+    def register_properties(self, props):
+        self.client.calls['register_properties'] += 1
+
+    def update_property(self, prop):
+        self.client.calls['update_property'] += 1
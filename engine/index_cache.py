@@ -0,0 +1,48 @@
+"""Indexes shared by every pipeline over the same dictionaries
+
+The stroke index and the suggestion index are each built once per
+list of dictionaries, however many pipelines use that list, and are
+dropped when the last collection holding them goes. An IndexCache
+keys them on the identity of the dictionaries, which the index keeps
+valid by holding them in its dicts attribute.
+"""
+
+import threading
+import weakref
+
+
+class IndexCache(object):
+    """Weakly held indexes built by build(dicts).
+
+    Indexes have a dicts attribute and an update(dictionary, key)
+    method for keys changed in one of them.
+    """
+
+    def __init__(self, build):
+        self._build = build
+        self._indexes = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def get(self, dicts):
+        """Return the index for dicts, building it if needed.
+
+        Building takes a while for large dictionaries; call this from
+        a loader thread.
+        """
+        cache_key = tuple(id(d) for d in dicts)
+        with self._lock:
+            index = self._indexes.get(cache_key)
+        if index is None:
+            index = self._build(dicts)
+            with self._lock:
+                index = self._indexes.setdefault(cache_key, index)
+        return index
+
+    def update(self, filename, dictionary, changes):
+        """DictionaryWatcher listener updating the indexes for changes."""
+        with self._lock:
+            indexes = [i for i in self._indexes.values()
+                       if any(d is dictionary for d in i.dicts)]
+        for index in indexes:
+            for key in changes:
+                index.update(dictionary, key)
@@ -1,106 +1,220 @@
+"""Compile key combination strings into key events
+
+Dictionary entries such as {#Control_L(Left)} describe key
+combinations. A combination is compiled once into a tuple of (keyval,
+keycode, state) events, which the engine forwards to the client with
+forward_key_event. Compiled combinations are kept in a small LRU
+cache, so repeated ones only cost a dictionary lookup.
+
+Keycodes and the modifiers needed to type each keysym come from a
+table built from the X keyboard mapping when python-xlib is
+available. Without it keycodes are 0, and clients go by the keyval.
+The table is built on first use and again after the X server reports
+a keyboard mapping change, e.g. a layout switch; the cached
+combinations are dropped with it.
+"""
+
+import re
+import collections
+
+import gobject
 from ibus import keysyms
 from ibus import modifier
 
-def parse_key_combinations(combo_string):
-    """Emulate a sequence of key combinations.
+try:
+    from Xlib import X, display
+except ImportError:
+    display = None
+
+import log
+
+# IBus keycodes are X keycodes minus this offset
+X_KEYCODE_OFFSET = 8
+
+COMPILED_CACHE_SIZE = 256
+
+# Masks in the event state while these keys are held
+MODIFIER_KEYS = {
+    keysyms.Shift_L: modifier.SHIFT_MASK,
+    keysyms.Shift_R: modifier.SHIFT_MASK,
+    keysyms.Control_L: modifier.CONTROL_MASK,
+    keysyms.Control_R: modifier.CONTROL_MASK,
+    keysyms.Alt_L: modifier.MOD1_MASK,
+    keysyms.Alt_R: modifier.MOD1_MASK,
+    keysyms.Super_L: modifier.MOD4_MASK,
+    keysyms.Super_R: modifier.MOD4_MASK,
+}
 
-    KeyboardCapture instance would normally detect the emulated
-    key events. In order to prevent this, all KeyboardCapture
-    instances are told to ignore the emulated key events.
+TOKEN_RE = re.compile(r'[()]|[^\s()]+')
 
-    Argument:
 
-    combo_string -- A string representing a sequence of key
-    combinations. Keys are represented by their names in the IBus
-    keysyms module. For example, the left Alt key is represented by
-    'Alt_L'. Keys are either separated by a space or a left or right
-    parenthesis.  Parentheses must be properly formed in pairs and may
-    be nested. A key immediately followed by a parenthetical indicates
-    that the key is pressed down while all keys enclosed in the
-    parenthetical are pressed and released in turn. For example,
-    Alt_L(Tab) means to hold the left Alt key down, press and release
-    the Tab key, and then release the left Alt key.
+class Keymap(object):
+    """Table of keysym -> (keycode, modifiers) for the X keymap."""
 
+    def __init__(self):
+        self._table = {}
+        if display is None:
+            return
+        try:
+            d = display.Display()
+        except Exception as e:
+            log.warning("Not using the X keymap: %s", e)
+            return
+        try:
+            self._load(d)
+        finally:
+            d.close()
+
+    def _load(self, d):
+        # Modifiers selecting the second group, for keysyms at index 2, 3
+        group_mask = 0
+        mode_switch = set(keycode for keycode, index in
+                          d.keysym_to_keycodes(keysyms.Mode_switch))
+        for i, keycodes in enumerate(d.get_modifier_mapping()):
+            if mode_switch.intersection(keycodes):
+                group_mask |= 1 << i
+
+        first = d.display.info.min_keycode
+        count = d.display.info.max_keycode - first + 1
+        mapping = d.get_keyboard_mapping(first, count)
+        # Prefer mappings needing fewest modifiers, then lowest keycode
+        for index in xrange(4):
+            mods = 0
+            if index & 1:
+                mods |= modifier.SHIFT_MASK
+            if index & 2:
+                mods |= group_mask
+            for n, keysyms_ in enumerate(mapping):
+                if index >= len(keysyms_):
+                    continue
+                keysym = keysyms_[index]
+                if keysym != X.NoSymbol and keysym not in self._table:
+                    self._table[keysym] = (first + n - X_KEYCODE_OFFSET,
+                                           mods)
+
+    def lookup(self, keysym):
+        """Return (keycode, modifiers) typing keysym; (0, 0) if unknown."""
+        return self._table.get(keysym, (0, 0))
+
+
+def watch_mapping(callback):
+    """Call callback() on the main loop when the X keymap changes.
+
+    Return whether there is an X display to watch.
     """
-    # Convert the argument into a sequence of keycode, event type pairs
-    # that, if executed in order, would emulate the key
-    # combination represented by the argument.
-    keysym_events = []
-    key_down_stack = []
-    current_command = []
-    def press(k):
-        keysym_events.append((k, 0))
-    def release(k):
-        keysym_events.append((k, modifier.RELEASE_MASK))
-    for c in combo_string:
-        if c in (' ', '(', ')'):
-            keysym, keycode, state = _parse_key(''.join(current_command))
-            # keycode means keysym here...
-            keysym = keysyms.name_to_keycode(keystring)
-            # keycode, mods = self._keysym_to_keycode_and_modifiers(keysym)
-            current_command = []
-            if keysym is keysyms.VoidSymbol:
+    if display is None:
+        return False
+    try:
+        d = display.Display()
+    except Exception as e:
+        log.warning("Not watching the X keymap: %s", e)
+        return False
+
+    def readable(fd, condition):
+        # MappingNotify is sent to every client, without selecting it
+        changed = False
+        while d.pending_events():
+            event = d.next_event()
+            if event.type == X.MappingNotify and \
+                    event.request in (X.MappingKeyboard, X.MappingModifier):
+                changed = True
+        if changed:
+            callback()
+        return True
+    gobject.io_add_watch(d.fileno(), gobject.IO_IN, readable)
+    return True
+
+
+class KeyCombinationCompiler(object):
+    """Compile key combination strings, caching the results."""
+
+    def __init__(self, keymap=None, cache_size=COMPILED_CACHE_SIZE):
+        self._keymap = keymap
+        self._cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self._watching = False
+
+    def set_keymap(self, keymap):
+        """Use a new keymap; None to build one from the X keymap."""
+        self._keymap = keymap
+        self._cache.clear()
+
+    def _mapping_changed(self):
+        log.info("Keyboard mapping changed")
+        self.set_keymap(None)
+
+    def compile(self, combo_string):
+        """Return the key events emulating combo_string.
+
+        combo_string -- A string representing a sequence of key
+        combinations. Keys are represented by their names in the IBus
+        keysyms module. For example, the left Alt key is represented
+        by 'Alt_L'. Keys are either separated by a space or a left or
+        right parenthesis. Parentheses must be properly formed in
+        pairs and may be nested. A key immediately followed by a
+        parenthetical indicates that the key is pressed down while all
+        keys enclosed in the parenthetical are pressed and released in
+        turn. For example, Alt_L(Tab) means to hold the left Alt key
+        down, press and release the Tab key, and then release the left
+        Alt key.
+
+        The result is a tuple of (keyval, keycode, state) events.
+        """
+        events = self._cache.pop(combo_string, None)
+        if events is None:
+            events = self._compile(combo_string)
+            if len(self._cache) >= self.cache_size:
+                self._cache.popitem(last=False)
+        self._cache[combo_string] = events
+        return events
+
+    def _compile(self, combo_string):
+        if self._keymap is None:
+            self._keymap = Keymap()
+            if not self._watching:
+                self._watching = watch_mapping(self._mapping_changed)
+        lookup = self._keymap.lookup
+        events = []
+        # Keysyms held down by an open parenthesis; None for unknown
+        # key names, so that parentheses still pair up
+        held = []
+
+        def emit(keysym, release):
+            keycode, mods = lookup(keysym)
+            state = mods
+            for k in held:
+                state |= MODIFIER_KEYS.get(k, 0)
+            if release:
+                state |= modifier.RELEASE_MASK
+            events.append((keysym, keycode, state))
+
+        tokens = TOKEN_RE.findall(combo_string)
+        for n, token in enumerate(tokens):
+            if token == ')':
+                if held:
+                    if held[-1] is not None:
+                        emit(held[-1], True)
+                    held.pop()
+                continue
+            elif token == '(':
                 continue
-            if c == ' ':
-                # Record press and release for command's key.
-                press(keysym)
-                release(keysym)
-            elif c == '(':
-                # Record press for command's key.
-                key_down_stack.append(keysym)
-                press(keysym)
-            elif c == ')':
-                # Record press and release for command's key and
-                # release previously held key.
-                press(keysym)
-                release(keysym)
-                if len(key_down_stack):
-                    release(key_down_stack.pop())
-        else:
-            current_command.append(c)
-    # Record final command key.
-    keysym = keysyms.name_to_keycode(''.join(current_command))
-    #keysym, mods = self._keysym_to_keysym_and_modifiers(keysym)
-    if keysym is not keysyms.VoidSymbol:
-        press(keysym)
-        release(keysym)
-
-    # Release all keys.
-    for keysym in key_down_stack:
-        release(keysym)
-
-    return keysym_events
-
-
-def _parse_key(keystring):
-    keysym = XK.string_to_keysym(keystring)
-    keycode, mods = _keysym_to_keycode_and_modifiers(keysym)
-
-
-def _keysym_to_keycode_and_modifiers(keysym):
-    """Return a keycode and modifier mask pair that result in the keysym.
-
-    There is a one-to-many mapping from keysyms to keycode and
-    modifiers pairs; this function returns one of the possibly
-    many valid mappings, or the tuple (None, None) if no mapping
-    exists.
-
-    Arguments:
-
-    keysym -- A key symbol.
+            keysym = keysyms.name_to_keycode(token)
+            if keysym == keysyms.VoidSymbol:
+                keysym = None
+            hold = n + 1 < len(tokens) and tokens[n + 1] == '('
+            if keysym is not None:
+                emit(keysym, False)
+                if not hold:
+                    emit(keysym, True)
+            if hold:
+                held.append(keysym)
 
-    """
-    keycodes = self.display.keysym_to_keycodes(keysym)
-    if len(keycodes) > 0:
-        keycode, offset = keycodes[0]
-        modifiers = 0
-        if offset == 1 or offset == 3:
-            # The keycode needs the Shift modifier.
-            modifiers |= X.ShiftMask
-        if offset == 2 or offset == 3:
-            # The keysym is in group Group 2 instead of Group 1.
-            for i, mod_keycodes in enumerate(self.modifier_mapping):
-                if keycode in mod_keycodes:
-                    modifiers |= (1 << i)
-        return (keycode, modifiers)
-    return (None, None)
+        # Release all keys still held.
+        while held:
+            if held[-1] is not None:
+                emit(held[-1], True)
+            held.pop()
+        return tuple(events)
+
+
+compiler = KeyCombinationCompiler()
@@ -0,0 +1,145 @@
+"""Keymap profiles
+
+A keymap maps IBus keycodes to steno keys. Keycodes identify physical
+keys, whatever characters the X layout gives them, so with a software
+Dvorak or Colemak layout the qwerty profile still applies; the dvorak
+profile is for keyboards doing the Dvorak mapping themselves. NKRO and
+ortholinear keyboards in QWERTY mode send the same keycodes as any
+other QWERTY keyboard.
+
+More profiles can be defined in [Keymap <name>] sections of the Plover
+config file, or of the files listed in the keymap_files option, as
+steno key = keycodes:
+
+    [Keymap planck]
+    S- = 16 30
+    T- = 17
+    number = 2 3 4
+    ...
+
+The number key is written 'number', since a line starting with '#' is
+a comment. A section with the name of a built-in profile replaces it.
+Profiles are compiled into dense keycode-indexed tables when loaded.
+"""
+
+import ConfigParser
+import collections
+
+import plover.config
+
+from plover_machine import (KEYCODE_TO_STENO_KEY, STENO_KEY_ORDER,
+                            KEYCODE_TABLE_SIZE, compile_keymap)
+import log
+
+DVORAK = {
+    40: "S-",  # '
+    30: "S-",  # A
+    51: "T-",  # ,
+    24: "K-",  # O
+    52: "P-",  # .
+    18: "W-",  # E
+    25: "H-",  # P
+    22: "R-",  # U
+    36: "A-",  # J
+    37: "O-",  # K
+    21: "*",   # Y
+    23: "*",   # I
+    33: "*",   # F
+    32: "*",   # D
+    48: "-E",  # B
+    50: "-U",  # M
+    34: "-F",  # G
+    35: "-R",  # H
+    46: "-P",  # C
+    20: "-B",  # T
+    19: "-L",  # R
+    49: "-G",  # N
+    38: "-T",  # L
+    31: "-S",  # S
+    53: "-D",  # /
+    12: "-Z",  # -
+    2: "#",    # 1
+    3: "#",    # 2
+    4: "#",    # 3
+    5: "#",    # 4
+    6: "#",    # 5
+    7: "#",    # 6
+    8: "#",    # 7
+    9: "#",    # 8
+    10: "#",   # 9
+    11: "#",   # 0
+    26: "#",   # [
+    27: "#",   # ]
+}
+
+BUILTIN_KEYMAPS = {
+    'qwerty': KEYCODE_TO_STENO_KEY,
+    'dvorak': DVORAK,
+}
+
+SECTION_PREFIX = 'Keymap '
+
+# Names for steno keys that can't be written as themselves
+KEY_ALIASES = {
+    'number': '#',
+}
+
+
+def read_keymaps(filenames):
+    """Read {name: {keycode: steno key}} from [Keymap ...] sections."""
+    parser = ConfigParser.RawConfigParser()
+    # Steno keys are case sensitive
+    parser.optionxform = str
+    parser.read(filenames)
+    keymaps = {}
+    for section in parser.sections():
+        if not section.startswith(SECTION_PREFIX):
+            continue
+        name = section[len(SECTION_PREFIX):].strip()
+        keymap = {}
+        for key, keycodes in parser.items(section):
+            key = KEY_ALIASES.get(key, key)
+            if key not in STENO_KEY_ORDER:
+                log.warning("Unknown steno key in keymap", keymap=name,
+                            key=key)
+                continue
+            for keycode in keycodes.split():
+                try:
+                    keycode = int(keycode)
+                except ValueError:
+                    keycode = -1
+                if not 0 <= keycode < KEYCODE_TABLE_SIZE:
+                    log.warning("Invalid keycode in keymap", keymap=name,
+                                key=key, keycode=keycode)
+                    continue
+                keymap[keycode] = key
+        keymaps[name] = keymap
+    return keymaps
+
+
+def load_keymaps(filenames=()):
+    """Return the compiled profiles, built-in ones first.
+
+    Reads the Plover config file and filenames.
+    """
+    keymaps = dict(BUILTIN_KEYMAPS)
+    keymaps.update(read_keymaps([plover.config.CONFIG_FILE] +
+                                list(filenames)))
+    compiled = collections.OrderedDict()
+    for name in sorted(BUILTIN_KEYMAPS) + sorted(set(keymaps) -
+                                                 set(BUILTIN_KEYMAPS)):
+        compiled[name] = compile_keymap(keymaps[name])
+    return compiled
+
+
+_keymaps = None
+# Profile chosen most recently, used by newly created engines
+selected = None
+
+
+def get_keymaps(filenames=()):
+    """Return the compiled profiles, loading them on first use."""
+    global _keymaps
+    if _keymaps is None:
+        _keymaps = load_keymaps(filenames)
+    return _keymaps
@@ -0,0 +1,178 @@
+"""Stroke latency instrumentation
+
+Stages of the key-event to committed-text pipeline are timed with a
+monotonic clock and aggregated into log-scaled histograms, so the cost
+of recording a sample is a couple of arithmetic operations and a list
+increment. Stages nest: each one includes the time of the stages it
+calls. "stroke" measures from the key release that completes a chord
+to the end of its output.
+
+Recording is off until enable() is called; the disabled path is a
+single attribute check. In pipelined mode stages are recorded from the
+translation worker as well as the main loop, so the histograms are
+guarded by a lock.
+"""
+
+import math
+import time
+import threading
+import ctypes
+import ctypes.util
+
+
+def _clock_gettime():
+    CLOCK_MONOTONIC = 1
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+                        use_errno=True)
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    t = timespec()
+    ref = ctypes.byref(t)
+
+    def monotonic():
+        clock_gettime(CLOCK_MONOTONIC, ref)
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+try:
+    monotonic = _clock_gettime()
+    monotonic()
+except (OSError, AttributeError):
+    monotonic = time.time
+
+
+class Histogram(object):
+    """Log-scaled histogram of durations from 1us to 100s."""
+
+    BUCKETS_PER_DECADE = 20
+    DECADES = 8
+
+    def __init__(self):
+        self.counts = [0] * (self.BUCKETS_PER_DECADE * self.DECADES + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        us = seconds * 1e6
+        if us <= 1.0:
+            i = 0
+        else:
+            i = min(int(math.log10(us) * self.BUCKETS_PER_DECADE) + 1,
+                    len(self.counts) - 1)
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        """Add the samples of another histogram to this one."""
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """Upper bound in seconds of the bucket holding percentile p."""
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                break
+        return min(10 ** (float(i) / self.BUCKETS_PER_DECADE) * 1e-6,
+                   self.max)
+
+
+class _Timer(object):
+    __slots__ = ('recorder', 'stage', 'start')
+
+    def __init__(self, recorder, stage):
+        self.recorder = recorder
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = monotonic()
+
+    def __exit__(self, *exc_info):
+        self.recorder.record(self.stage, monotonic() - self.start)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+_null_timer = _NullTimer()
+
+
+class LatencyRecorder(object):
+    def __init__(self):
+        self.enabled = False
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._stroke_start = None
+
+    def enable(self):
+        self.enabled = True
+
+    def timed(self, stage):
+        """Return a context manager timing stage."""
+        if not self.enabled:
+            return _null_timer
+        return _Timer(self, stage)
+
+    def record(self, stage, seconds):
+        with self._lock:
+            h = self.histograms.get(stage)
+            if h is None:
+                h = self.histograms[stage] = Histogram()
+            h.add(seconds)
+
+    def start_stroke(self):
+        if self.enabled:
+            self._stroke_start = monotonic()
+
+    def end_stroke(self):
+        if self._stroke_start is not None:
+            self.record('stroke', monotonic() - self._stroke_start)
+            self._stroke_start = None
+
+    def summary(self, stage='stroke'):
+        """One line p50/p95/p99 summary for stage, in milliseconds."""
+        with self._lock:
+            h = self.histograms.get(stage)
+            if h is None:
+                return u"%s: no samples" % stage
+            return u"%s p50 %.2fms p95 %.2fms p99 %.2fms (n=%d)" % (
+                stage, h.percentile(50) * 1e3, h.percentile(95) * 1e3,
+                h.percentile(99) * 1e3, h.count)
+
+    def report(self):
+        lines = ["%-24s %8s %9s %9s %9s %9s" % (
+            "stage", "count", "p50 ms", "p95 ms", "p99 ms", "max ms")]
+        with self._lock:
+            for stage in sorted(self.histograms):
+                h = self.histograms[stage]
+                lines.append("%-24s %8d %9.3f %9.3f %9.3f %9.3f" % (
+                    stage, h.count, h.percentile(50) * 1e3,
+                    h.percentile(95) * 1e3, h.percentile(99) * 1e3,
+                    h.max * 1e3))
+        return "\n".join(lines)
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            f.write(self.report() + "\n")
+
+
+recorder = LatencyRecorder()
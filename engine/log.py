@@ -0,0 +1,166 @@
+"""Buffered, asynchronous logging
+
+Log calls on the stroke path must not block on stdout, which under the
+IBus launcher is often a pipe or the journal. Records are appended to
+an in-memory ring buffer and a queue, and a background thread formats
+and writes them. Calls below the current level return after a single
+comparison, and formatting of the arguments is deferred to the writer.
+
+The ring buffer keeps the most recent records so that they can be
+dumped when something goes wrong, e.g. on a StateMismatch.
+"""
+
+import sys
+import time
+import atexit
+import threading
+import traceback
+import collections
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {
+    DEBUG: 'DEBUG',
+    INFO: 'INFO',
+    WARNING: 'WARNING',
+    ERROR: 'ERROR',
+}
+
+
+def level_converter(s):
+    """Convert a level name from the config file to a level."""
+    for level, name in LEVEL_NAMES.iteritems():
+        if name == s.upper():
+            return level
+    raise ValueError("Unknown log level: %s" % s)
+
+
+def format_record(record):
+    timestamp, level, message, args, fields = record
+    tb = fields.get('traceback')
+    if tb is not None:
+        fields = dict(fields)
+        del fields['traceback']
+    if args:
+        try:
+            message = message % args
+        except Exception:
+            message = "%s %r" % (message, args)
+    line = "%s %-7s %s" % (
+        time.strftime('%H:%M:%S', time.localtime(timestamp)),
+        LEVEL_NAMES.get(level, level), message)
+    if fields:
+        line += ' ' + ' '.join('%s=%r' % item for item in
+                               sorted(fields.iteritems()))
+    if tb is not None:
+        line += '\n' + tb.rstrip('\n')
+    if isinstance(line, unicode):
+        line = line.encode('utf-8')
+    return line
+
+
+class Logger(object):
+    """Ring-buffered logger with a background writer thread."""
+
+    def __init__(self, stream=None, capacity=500):
+        self.level = INFO
+        self.stream = stream if stream is not None else sys.stdout
+        self.recent = collections.deque(maxlen=capacity)
+        self._queue = collections.deque()
+        self._wakeup = threading.Event()
+        self._write_lock = threading.Lock()
+        self._writer = None
+
+    def log(self, level, message, args, fields):
+        if level < self.level:
+            return
+        record = (time.time(), level, message, args, fields)
+        self.recent.append(record)
+        self._queue.append(record)
+        if self._writer is None:
+            self._start_writer()
+        self._wakeup.set()
+
+    def _start_writer(self):
+        self._writer = threading.Thread(target=self._run)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Write out queued records. Safe to call from any thread."""
+        with self._write_lock:
+            lines = []
+            while self._queue:
+                lines.append(format_record(self._queue.popleft()))
+            if lines:
+                try:
+                    self.stream.write('\n'.join(lines) + '\n')
+                    self.stream.flush()
+                except IOError:
+                    pass
+
+    def dump(self, reason):
+        """Write the recent history, e.g. after an error."""
+        self.flush()
+        with self._write_lock:
+            lines = ["---- %s: last %d log records ----" % (
+                reason, len(self.recent))]
+            lines.extend(format_record(r) for r in list(self.recent))
+            lines.append("---- end of log dump ----")
+            try:
+                self.stream.write('\n'.join(lines) + '\n')
+                self.stream.flush()
+            except IOError:
+                pass
+
+
+logger = Logger()
+atexit.register(logger.flush)
+
+
+def set_level(level):
+    logger.level = level
+
+
+def is_enabled_for(level):
+    """Whether records at level are logged; guards costly arguments."""
+    return level >= logger.level
+
+
+def debug(message, *args, **fields):
+    if DEBUG >= logger.level:
+        logger.log(DEBUG, message, args, fields)
+
+
+def info(message, *args, **fields):
+    if INFO >= logger.level:
+        logger.log(INFO, message, args, fields)
+
+
+def warning(message, *args, **fields):
+    if WARNING >= logger.level:
+        logger.log(WARNING, message, args, fields)
+
+
+def error(message, *args, **fields):
+    if ERROR >= logger.level:
+        logger.log(ERROR, message, args, fields)
+
+
+def exception(message, *args, **fields):
+    """Log an error with the traceback of the exception being handled."""
+    fields['traceback'] = traceback.format_exc()
+    logger.log(ERROR, message, args, fields)
+
+
+def dump(reason):
+    logger.dump(reason)
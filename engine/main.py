@@ -18,13 +18,20 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
+from startup import profile
 import os
 import sys
 import getopt
+import locale
+import atexit
+# Only what is needed to register the component is imported here;
+# engine.py and Plover are imported when the first engine is created.
 import ibus
-import factory
+profile.mark('import ibus')
 import gobject
-import locale
+profile.mark('import gobject')
+import factory
+profile.mark('import factory')
 
 class IMApp:
     def __init__(self, exec_by_ibus):
@@ -49,21 +56,49 @@ class IMApp:
             self.__bus.request_name("org.freedesktop.IBus.Plover", 0)
         else:
             self.__bus.register_component(self.__component)
+        profile.mark('register component')
 
     def run(self):
+        gobject.idle_add(self.__mainloop_started)
         self.__mainloop.run()
 
+    def __mainloop_started(self):
+        profile.mark('main loop running')
+        return False
+
     def __bus_disconnected_cb(self, bus):
         self.__mainloop.quit()
 
 
 def launch_engine(exec_by_ibus):
+    # Dictionaries are loaded on background threads
+    gobject.threads_init()
     IMApp(exec_by_ibus).run()
 
+def build_dictionary_cache():
+    import ploverlink
+    import dictionary_cache
+    config = ploverlink.load_config()
+    for filename in config.get_dictionary_file_names():
+        if dictionary_cache.is_fresh(filename):
+            print "Up to date: %s" % filename
+        else:
+            print "Building: %s" % filename
+            dictionary_cache.build(filename)
+
+def enable_latency_log(filename):
+    from latency import recorder
+    recorder.enable()
+    atexit.register(recorder.dump, filename)
+
 def print_help(out, v = 0):
     print >> out, "-i, --ibus             executed by ibus."
     print >> out, "-h, --help             show this message."
     print >> out, "-d, --daemonize        daemonize ibus"
+    print >> out, "-b, --build-cache      build compiled dictionaries and exit"
+    print >> out, "-l, --latency-log FILE write stroke latency report to FILE on exit"
+    print >> out, "-r, --record FILE      append raw key events to FILE"
+    print >> out, "-p, --profile-startup  log startup phase times at the first stroke"
     sys.exit(v)
 
 def main():
@@ -75,8 +110,9 @@ def main():
     exec_by_ibus = False
     daemonize = False
 
-    shortopt = "ihd"
-    longopt = ["ibus", "help", "daemonize"]
+    shortopt = "ihdbl:r:p"
+    longopt = ["ibus", "help", "daemonize", "build-cache", "latency-log=",
+               "record=", "profile-startup"]
 
     try:
         opts, args = getopt.getopt(sys.argv[1:], shortopt, longopt)
@@ -90,10 +126,23 @@ def main():
             daemonize = True
         elif o in ("-i", "--ibus"):
             exec_by_ibus = True
+        elif o in ("-b", "--build-cache"):
+            build_dictionary_cache()
+            sys.exit()
+        elif o in ("-l", "--latency-log"):
+            enable_latency_log(a)
+        elif o in ("-r", "--record"):
+            import replay
+            replay.recorder.start(a)
+        elif o in ("-p", "--profile-startup"):
+            profile.enabled = True
+            atexit.register(profile.finish, 'exit')
         else:
             print >> sys.stderr, "Unknown argument: %s" % o
             print_help(sys.stderr, 1)
 
+    profile.mark('parse options')
+
     if daemonize:
         if os.fork():
             sys.exit()
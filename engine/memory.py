@@ -0,0 +1,104 @@
+"""Memory use report for the 'memory' engine command
+
+Sizes are estimates from sys.getsizeof, walking plain dictionaries
+entry by entry, so the report takes a moment for large ones. Served
+dictionaries are counted as their local cache; their storage in the
+dictionary service is listed with the service.
+"""
+
+import os
+import sys
+
+from state_cache import cache as state_cache, estimate_size
+
+MB = 1024.0 * 1024.0
+
+
+def rss():
+    """Resident set size of the daemon in bytes, or None."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def dictionary_size(d):
+    """Approximate number of bytes held by a dictionary.
+
+    Dictionaries other than Plover's own report their size through
+    memory_usage; only a plain StenoDictionary has reverse tables.
+    """
+    memory_usage = getattr(d, 'memory_usage', None)
+    if memory_usage is not None:
+        return memory_usage()
+    size = sys.getsizeof(d._dict)
+    for key, value in d._dict.iteritems():
+        size += sys.getsizeof(key) + sys.getsizeof(value)
+        size += sum(sys.getsizeof(s) for s in key)
+    for table in (d.reverse, d.casereverse):
+        size += sys.getsizeof(table)
+        size += sum(sys.getsizeof(v) for v in table.itervalues())
+    return size
+
+
+def report(steno):
+    """Return (report, one line summary) for a Steno pipeline.
+
+    Dictionaries are shared by all pipelines and counted once here.
+    """
+    # dictionary_service imports this module for the service's stats
+    import dictionary_service
+    lines = []
+    total = 0
+    collection = steno.translator.get_dictionary()
+    for d in collection.dicts:
+        size = dictionary_size(d)
+        total += size
+        lines.append("%-32s %-22s %8d entries %9.1f MB" % (
+            os.path.basename(d.get_path()) or '(unnamed)',
+            type(d).__name__, len(d), size / MB))
+    index = getattr(collection, 'index', None)
+    if index is not None:
+        lines.append("%-32s %-22s %8d nodes   %9.1f MB" % (
+            "stroke index", type(index).__name__, len(index),
+            index.memory_usage() / MB))
+    if steno.suggestions is not None:
+        lines.append("%-32s %-22s %8d texts   %9.1f MB" % (
+            "suggestion index", type(steno.suggestions).__name__,
+            len(steno.suggestions), steno.suggestions.memory_usage() / MB))
+    clients = set(d.client for d in collection.dicts
+                  if isinstance(d, dictionary_service.RemoteDictionary))
+    for client in clients:
+        try:
+            stats = client.stats()
+        except dictionary_service.ServiceError as e:
+            lines.append("dictionary service: %s" % e)
+            continue
+        lines.append("dictionary service: %d dictionaries, %d clients, "
+                     "RSS %.1f MB" % (len(stats['dictionaries']),
+                                      stats['clients'],
+                                      (stats['rss'] or 0) / MB))
+        for served in stats['dictionaries']:
+            lines.append("  %-30s %-22s %8d entries %9.1f MB" % (
+                os.path.basename(served['file']),
+                "%d clients" % served['clients'], served['entries'],
+                served['size'] / MB))
+    state = steno.translator.get_state()
+    undo_size = estimate_size(state)
+    lines.append("translator state: %d of %d translations, %.1f KB" % (
+        len(state.translations), state.translations.capacity,
+        undo_size / 1024.0))
+    lines.append("saved states of other contexts: %d, %.1f KB" % (
+        len(state_cache), state_cache.size / 1024.0))
+    resident = rss()
+    if resident is not None:
+        lines.append("resident set size: %.1f MB" % (resident / MB))
+    summary = u"dictionaries %.1f MB, undo %.1f KB" % (
+        total / MB, (undo_size + state_cache.size) / 1024.0)
+    if resident is not None:
+        summary = u"RSS %.1f MB, %s" % (resident / MB, summary)
+    return "\n".join(lines), summary
@@ -1,6 +1,7 @@
 "Represent the IBus engine through the Plover machine interface"
 
 from plover.machine.base import StenotypeBase, STATE_RUNNING
+from latency import recorder as latency
 
 
 KEYCODE_TO_STENO_KEY = {
@@ -44,6 +45,29 @@ KEYCODE_TO_STENO_KEY = {
     13: "#",   # =
 }
 
+# Steno order, used to sort the keys of a chord once per distinct chord
+STENO_KEY_ORDER = ("#", "S-", "T-", "K-", "P-", "W-", "H-", "R-", "A-", "O-",
+                   "*", "-E", "-U", "-F", "-R", "-P", "-B", "-L", "-G", "-T",
+                   "-S", "-D", "-Z")
+
+KEYCODE_TABLE_SIZE = 256
+CHORD_CACHE_SIZE = 4096
+
+
+def compile_keymap(keycode_to_steno_key):
+    """Compile a keycode -> steno key dict into dense tables.
+
+    Returns (keycode_bits, bit_keys): keycode_bits is indexed by
+    keycode and holds a distinct single-bit mask for every mapped
+    keycode (0 if unmapped); bit_keys[i] is the steno key of bit i.
+    """
+    keycode_bits = [0] * KEYCODE_TABLE_SIZE
+    bit_keys = []
+    for keycode, key in sorted(keycode_to_steno_key.items()):
+        keycode_bits[keycode] = 1 << len(bit_keys)
+        bit_keys.append(key)
+    return keycode_bits, tuple(bit_keys)
+
 
 class Stenotype(StenotypeBase):
     """
@@ -53,12 +77,28 @@ class Stenotype(StenotypeBase):
 
     """
 
-    def __init__(self, params):
-        """Report IBus events to Plover."""
+    def __init__(self, params, keymap=None):
+        """Report IBus events to Plover.
+
+        keymap is a compiled keymap (see compile_keymap); the default
+        is KEYCODE_TO_STENO_KEY.
+        """
         StenotypeBase.__init__(self)
-        self._down_keys = set()
-        self._released_keys = set()
+        if keymap is None:
+            keymap = compile_keymap(KEYCODE_TO_STENO_KEY)
+        self.set_keymap(keymap)
         self.arpeggiate = params['arpeggiate']
+        if latency.enabled:
+            # Keep the timer off the key path unless it's recording
+            self.key_up = self._timed_key_up
+
+    def set_keymap(self, keymap):
+        """Switch to a compiled keymap, dropping any chord in progress."""
+        # Chord state is kept as bitmasks over the mapped keycodes
+        self._down_keys = 0
+        self._released_keys = 0
+        self._keycode_bits, self._bit_keys = keymap
+        self._chords = {}
 
     def start_capture(self):
         """Begin listening for output from the stenotype machine."""
@@ -72,8 +112,9 @@ class Stenotype(StenotypeBase):
         """Called when a key is pressed."""
         if self.state != STATE_RUNNING:
             return False  # not handled -- will type as normal
-        elif keycode in KEYCODE_TO_STENO_KEY:
-            self._down_keys.add(keycode)
+        bit = keycode < KEYCODE_TABLE_SIZE and self._keycode_bits[keycode]
+        if bit:
+            self._down_keys |= bit
             return True  # handled
         else:
             return False  # not handled
@@ -92,11 +133,10 @@ class Stenotype(StenotypeBase):
         """Called when a key is released."""
         if self.state != STATE_RUNNING:
             return False  # not handled -- will type as normal
-        if keycode in KEYCODE_TO_STENO_KEY:
-            self._released_keys.add(keycode)
-            # Remove invalid released keys
-            self._released_keys = \
-                self._released_keys.intersection(self._down_keys)
+        bit = keycode < KEYCODE_TABLE_SIZE and self._keycode_bits[keycode]
+        if bit:
+            # Ignore releases of keys that weren't pressed
+            self._released_keys = (self._released_keys | bit) & self._down_keys
 
             # A stroke is complete if all pressed keys have been released.
             # If we are in arpeggiate mode then only send stroke when
@@ -106,14 +146,39 @@ class Stenotype(StenotypeBase):
             # if self.arpeggiate:
             #     send_strokes &= event.keystring == ' '
             if send_strokes:
-                steno_keys = [KEYCODE_TO_STENO_KEY[k] for k in self._down_keys]
-                self._down_keys.clear()
-                self._released_keys.clear()
-                self._notify(steno_keys)
+                steno_keys = self._chord_keys(self._down_keys)
+                self._down_keys = 0
+                self._released_keys = 0
+                with latency.timed('notify'):
+                    self._notify(steno_keys)
 
             return True  # handled
         return False  # not handled
 
+    def held_keys(self):
+        """Return the steno keys pressed and not yet released."""
+        return self._chord_keys(self._down_keys & ~self._released_keys)
+
+    def _timed_key_up(self, keycode):
+        with latency.timed('key_up'):
+            return Stenotype.key_up(self, keycode)
+
+    def _chord_keys(self, mask):
+        """Return the ordered steno key tuple for a chord bitmask."""
+        keys = self._chords.get(mask)
+        if keys is None:
+            keys = set()
+            bit = 0
+            while mask >> bit:
+                if (mask >> bit) & 1:
+                    keys.add(self._bit_keys[bit])
+                bit += 1
+            keys = tuple(k for k in STENO_KEY_ORDER if k in keys)
+            if len(self._chords) >= CHORD_CACHE_SIZE:
+                self._chords.clear()
+            self._chords[mask] = keys
+        return keys
+
     @staticmethod
     def get_option_info():
         bool_converter = lambda s: s == 'True'
@@ -1,11 +1,31 @@
 #import plover.app
+import sys
+import Queue
+import ConfigParser
+import threading
+import gobject
+from startup import profile
 import plover.config
 import plover.steno as steno
-import plover.translation as translation
-#import plover.formatting as formatting
-import aware_formatter
-from plover.dictionary.loading_manager import manager as dict_manager
+import plover.formatting
+import plover.translation
+from plover.dictionary.base import load_dictionary
+from plover.steno_dictionary import StenoDictionaryCollection
 from plover.exception import InvalidConfigurationError,DictionaryLoaderException
+# Plover's modules are most of the engine's import time
+profile.mark('import plover')
+import aware_formatter
+import compact_dictionary
+import dictionary_cache
+import dictionary_collection
+import dictionary_service
+import dictionary_watcher
+import stroke_log
+import suggestions
+import undo_history
+from state_cache import cache as state_cache
+from latency import recorder as latency, monotonic
+import log
 
 
 
@@ -17,52 +37,310 @@ def load_config():
     return config
 
 
+# ibus-plover's own settings, kept in their own section of the Plover
+# config file: name -> (default, converter)
+OPTIONS_SECTION = 'IBus Plover'
+
+bool_converter = lambda s: s == 'True'
+
+# How dictionaries are held in memory: mapped from the compiled cache,
+# packed by compact_dictionary, or as parsed by Plover. The stroke index
+# of compiled dictionaries is mapped from an index file too, written on
+# the first start with a given set of dictionaries; the others build it
+# in memory on every start.
+DICTIONARY_STORAGE = ('compiled', 'compact', 'plain')
+
+
+def storage_converter(s):
+    if s not in DICTIONARY_STORAGE:
+        raise ValueError("Unknown dictionary storage: %s" % s)
+    return s
+
+OPTION_INFO = {
+    'batch_output': (False, bool_converter),
+    # Unix socket of a dictionary service (see dictionary_service.py)
+    # to look dictionaries up in; empty to load them all in the daemon
+    'dictionary_service': ('', str),
+    'dictionary_storage': ('compiled', storage_converter),
+    'keymap': ('qwerty', str),
+    'keymap_files': ([], lambda s: s.split()),
+    'log_level': (log.INFO, log.level_converter),
+    'pipelined': (False, bool_converter),
+    # Entries of each served dictionary cached in the daemon
+    'service_cache_size': (dictionary_service.CACHE_SIZE, int),
+    # Show the steno keys being held in the auxiliary text
+    'show_held_keys': (False, bool_converter),
+    # Memory cap, in KiB, for translator states of unfocused contexts
+    'state_cache_size': (512, int),
+    # Offer shorter briefs for each word written in the lookup table
+    'suggestions': (False, bool_converter),
+    # Number of strokes that can be undone with *, at least
+    'undo_depth': (10, int),
+}
+
+
+def default_options():
+    return dict((name, default)
+                for name, (default, converter) in OPTION_INFO.iteritems())
+
+
+def load_options(filename=None):
+    """Read the [IBus Plover] options from the Plover config file."""
+    if filename is None:
+        filename = plover.config.CONFIG_FILE
+    parser = ConfigParser.RawConfigParser()
+    parser.read(filename)
+    options = default_options()
+    for name, (default, converter) in OPTION_INFO.iteritems():
+        if parser.has_option(OPTIONS_SECTION, name):
+            options[name] = converter(parser.get(OPTIONS_SECTION, name))
+    return options
+
+
 def get_dicts(config):
     """Initialize a StenoEngine from a config object."""
-    dictionary_file_names = config.get_dictionary_file_names()
+    return load_dicts(config.get_dictionary_file_names())
+
+
+def load_dicts(dictionary_file_names, storage='compiled'):
+    """Load the named dictionaries, stored as given by storage."""
     try:
-        dicts = dict_manager.load(dictionary_file_names)
+        return [load_dict(f, storage) for f in dictionary_file_names]
     except DictionaryLoaderException as e:
         raise InvalidConfigurationError(unicode(e))
-    return dicts
 
-    # log_file_name = config.get_log_file_name()
-    # if log_file_name:
-    #     engine.set_log_file_name(log_file_name)
 
-    # engine.enable_stroke_logging(config.get_enable_stroke_logging())
-    # engine.enable_translation_logging(config.get_enable_translation_logging())
+def load_dict(filename, storage='compiled'):
+    if storage == 'compiled':
+        try:
+            return dictionary_cache.load(filename)
+        except EnvironmentError as e:
+            # Cache directory not writable, or similar: parse the source.
+            log.warning("Not using dictionary cache for %s: %s", filename, e)
+    # Plover's loading manager would keep the parsed copy alive until
+    # the next load; only the compact one should outlive this call.
+    d = load_dictionary(filename)
+    if storage == 'compact':
+        d = compact_dictionary.compact(d)
+    return d
 
     # engine.set_is_running(config.get_auto_start())
 
 
+class DictionaryRegistry(object):
+    """Process-wide set of loaded dictionaries.
+
+    Every Steno pipeline in the daemon acquires its dictionaries from
+    here, so each file is only parsed once however many input contexts
+    are open. Dictionaries are reference counted by file name and
+    dropped when the last pipeline using them is closed.
+
+    acquire() may be called from loader threads; concurrent requests
+    for the same file wait for a single load.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._file_locks = {}
+        self._dicts = {}
+        self._refcounts = {}
+        self.watcher = dictionary_watcher.DictionaryWatcher()
+        self.watcher.add_listener(dictionary_collection.indexes.update)
+        self.watcher.add_listener(suggestions.indexes.update)
+
+    def acquire(self, dictionary_file_names, progress=None,
+                storage='compiled'):
+        """Return the loaded dictionaries, loading any that are missing.
+
+        progress, if given, is called as progress(index, total,
+        filename) before each dictionary is fetched. Missing
+        dictionaries are loaded with the given storage; ones already
+        loaded are shared as they are.
+        """
+        dicts = []
+        try:
+            for n, filename in enumerate(dictionary_file_names):
+                if progress is not None:
+                    progress(n, len(dictionary_file_names), filename)
+                dicts.append(self._acquire_one(filename, storage))
+        except:
+            self.release(dictionary_file_names[:len(dicts)])
+            raise
+        return dicts
+
+    def _acquire_one(self, filename, storage):
+        with self._lock:
+            file_lock = self._file_locks.setdefault(filename,
+                                                    threading.Lock())
+        with file_lock:
+            with self._lock:
+                d = self._dicts.get(filename)
+            if d is None:
+                d = load_dicts([filename], storage)[0]
+                gobject.idle_add(self._watch, filename, d)
+            with self._lock:
+                self._dicts.setdefault(filename, d)
+                self._refcounts[filename] = \
+                    self._refcounts.get(filename, 0) + 1
+                return self._dicts[filename]
+
+    def _watch(self, filename, d):
+        with self._lock:
+            if self._dicts.get(filename) is not d:
+                return False
+        self.watcher.watch(filename, d)
+        return False
+
+    def release(self, dictionary_file_names):
+        """Drop one reference to each of the named dictionaries."""
+        with self._lock:
+            for filename in dictionary_file_names:
+                self._refcounts[filename] -= 1
+                if self._refcounts[filename] == 0:
+                    del self._refcounts[filename]
+                    del self._dicts[filename]
+                    self.watcher.unwatch(filename)
+
+
+dict_registry = DictionaryRegistry()
+
+
+class MainLoopOutput(object):
+    """Run output calls from the translation worker on the main loop.
+
+    The worker waits for each call to finish, so output reaches the
+    client in stroke order and change_string can still report a
+    mismatch back to the formatter.
+    """
+
+    def __init__(self, output):
+        self._output = output
+
+    def _call(self, method, *args):
+        done = threading.Event()
+        result = []
+
+        def run():
+            try:
+                result.append((True, method(*args)))
+            except Exception:
+                result.append((False, sys.exc_info()))
+            done.set()
+            return False
+        gobject.idle_add(run)
+        done.wait()
+        ok, value = result[0]
+        if not ok:
+            raise value[0], value[1], value[2]
+        return value
+
+    def change_string(self, before, after):
+        return self._call(self._output.change_string, before, after)
+
+    def send_key_combination(self, c):
+        return self._call(self._output.send_key_combination, c)
+
+    def send_engine_command(self, c):
+        return self._call(self._output.send_engine_command, c)
+
+    def send_key_event(self, keyval, keycode, state):
+        return self._call(self._output.send_key_event, keyval, keycode, state)
+
+    def show_message(self, message):
+        # Already safe to call from any thread
+        self._output.show_message(message)
+
+    def show_suggestions(self, briefs):
+        self._output.show_suggestions(briefs)
+
+
 class Steno(object):
-    def __init__(self, machine, output):
-        """Creates and configures a single steno pipeline."""
+    def __init__(self, machine, output, config=None, dicts=None,
+                 options=None):
+        """Creates and configures a single steno pipeline.
 
-        self.config = load_config()
+        config, options and dicts may be given to run without reading
+        the Plover config file or the shared dictionary registry, as
+        the benchmarks do.
+        """
+
+        if config is None:
+            config = load_config()
+        self.config = config
+        if options is None:
+            options = load_options()
+        self.options = options
 
         # self.subscribers = []
         # self.stroke_listeners = []
         self.is_running = False
         self.machine = machine
 
-        self.translator = translation.Translator()
+        self.translator = undo_history.UndoTranslator()
+
+        # Plover's stroke and translation log, written in the
+        # background; nothing is hooked up unless it is enabled.
+        log_strokes = self.config.get_enable_stroke_logging()
+        log_translations = self.config.get_enable_translation_logging()
+        if log_strokes or log_translations:
+            self.stroke_log = stroke_log.get_stroke_log(
+                self.config.get_log_file_name())
+        else:
+            self.stroke_log = None
+        if log_strokes:
+            self.machine.add_stroke_callback(self.stroke_log.log_stroke)
+
         self.machine.add_stroke_callback(self._stroke_notify)
         self.machine.start_capture()
 
         self.formatter = aware_formatter.AwareFormatter()
         self.output = output
-        self.formatter.set_output(output)
-        # self.logger = Logger()
-        # self.translator.add_listener(self.logger.log_translation)
+        # In pipelined mode, key events only queue completed strokes;
+        # translation and formatting run on a worker thread, and the
+        # translator state is only touched from there (see _submit).
+        if self.options['pipelined']:
+            self._loop_output = MainLoopOutput(output)
+            self.formatter.set_output(self._loop_output)
+            self._jobs = Queue.Queue()
+            worker = threading.Thread(target=self._run_jobs)
+            worker.daemon = True
+            worker.start()
+        else:
+            self.formatter.set_output(output)
+            self._jobs = None
         self.translator.add_listener(self.formatter.format)
-        # This seems like a reasonable number. If this becomes a problem it can
-        # be parameterized.
-        self.translator.set_min_undo_length(10)
-
-        self.translator.get_dictionary().set_dicts(get_dicts(self.config))
+        if log_translations:
+            self.translator.add_listener(self.stroke_log.log_translation)
+        self.translator.set_min_undo_length(self.options['undo_depth'])
+        # Reverse index for suggestions, once dictionaries are loaded
+        self.suggestions = None
+        self._showing_suggestions = False
+        if self.options['suggestions']:
+            self.translator.add_listener(self._suggest)
 
+        # The dictionaries themselves are shared with every other
+        # pipeline; only the translator state is our own. They are
+        # loaded in the background so the main loop isn't blocked;
+        # strokes arriving in the meantime are queued.
+        self._dicts_acquired = False
+        self._closed = False
+        # Those of dictionary_file_names loaded in the daemon, and
+        # those looked up in the dictionary service
+        self._local_file_names = []
+        self._served_file_names = []
+        if dicts is not None:
+            self.dictionary_file_names = []
+            self._pending_strokes = None
+            self._set_dicts(dicts)
+            if self.options['suggestions']:
+                self.suggestions = suggestions.indexes.get(dicts)
+        else:
+            self.dictionary_file_names = \
+                self.config.get_dictionary_file_names()
+            self._pending_strokes = []
+            loader = threading.Thread(target=self._load_dictionaries)
+            loader.daemon = True
+            loader.start()
 
         # self.full_output = SimpleNamespace()
         # self.command_only_output = SimpleNamespace()
@@ -70,14 +348,203 @@ class Steno(object):
         # self.set_is_running(False)
 
         # self.machine.add_state_callback(self._machine_state_callback)
-        # self.machine.add_stroke_callback(self.logger.log_stroke)
         # self.machine.add_stroke_callback(self._translator_machine_callback)
 
+    @property
+    def loading(self):
+        """Whether strokes are being queued until dictionaries load."""
+        return self._pending_strokes is not None
+
+    def _load_dictionaries(self):
+        """Acquire the dictionaries. Runs on the loader thread."""
+        try:
+            names = self.dictionary_file_names
+            served = {}
+            if self.options['dictionary_service']:
+                served = dictionary_service.open_dictionaries(
+                    self.options['dictionary_service'], names,
+                    self.options['service_cache_size'])
+                self._served_file_names = list(served)
+            local_file_names = [n for n in names if n not in served]
+            # acquire releases what it got if it fails part way
+            local = dict(zip(local_file_names, dict_registry.acquire(
+                local_file_names, self._loading_progress,
+                self.options['dictionary_storage'])))
+            self._local_file_names = local_file_names
+            dicts = [served[n] if n in served else local[n] for n in names]
+            if dictionary_collection.indexable(dicts):
+                # Build the stroke index here rather than in set_dicts;
+                # holding it keeps it cached until then.
+                self._index = dictionary_collection.indexes.get(dicts)
+            if self.options['suggestions']:
+                self.suggestions = suggestions.indexes.get(dicts)
+        except Exception as e:
+            # Carry on without dictionaries rather than queueing
+            # strokes forever.
+            log.exception("Error loading dictionaries")
+            self._release_dictionaries()
+            self.output.show_message(u"Error loading dictionaries: %s" % e)
+            dicts = None
+        gobject.idle_add(self._dictionaries_loaded, dicts)
+
+    def _loading_progress(self, n, total, filename):
+        self.output.show_message(
+            u"Loading dictionaries (%d/%d)..." % (n + 1, total))
+
+    def _dictionaries_loaded(self, dicts):
+        if dicts is not None:
+            if self._closed:
+                self._release_dictionaries()
+                return False
+            self._submit(self._set_dicts, dicts)
+            self._dicts_acquired = True
+            self.output.show_message(u"")
+            profile.mark('load dictionaries')
+        pending, self._pending_strokes = self._pending_strokes, None
+        for steno_keys in pending:
+            self._submit(self._translate, steno_keys)
+        return False
+
+    def _set_dicts(self, dicts):
+        """Look strokes up in dicts, through the stroke index if worth it."""
+        if dictionary_collection.indexable(dicts):
+            collection = dictionary_collection.IndexedDictionaryCollection()
+        else:
+            collection = StenoDictionaryCollection()
+        self.translator.set_dictionary(collection)
+        # After set_dictionary, which listens for the longest key
+        collection.set_dicts(dicts)
+
+    def close(self):
+        """Release the shared dictionaries used by this pipeline."""
+        self._closed = True
+        self.suggestions = None
+        if self._dicts_acquired:
+            self._submit(self.translator.get_dictionary().set_dicts, [])
+            self._release_dictionaries()
+            self._dicts_acquired = False
+        if self.stroke_log is not None:
+            # The log is shared with other pipelines; just make sure
+            # this one's strokes reach the disk.
+            self._submit(self.stroke_log.flush, True)
+        if self._jobs is not None:
+            self._jobs.put(None)
+
+    def _release_dictionaries(self):
+        dict_registry.release(self._local_file_names)
+        if self._served_file_names:
+            dictionary_service.release_dictionaries(
+                self.options['dictionary_service'], self._served_file_names)
+        self._local_file_names = []
+        self._served_file_names = []
+
+    def _submit(self, fn, *args):
+        """Run fn(*args) where the translator state lives.
+
+        That is on the worker thread, after the strokes already queued,
+        in pipelined mode; right away otherwise.
+        """
+        if self._jobs is None:
+            return fn(*args)
+        self._jobs.put((fn, args))
+
+    def pass_through(self, keyval, keycode, state):
+        """Hold back a key the engine doesn't handle, if need be.
+
+        In pipelined mode, strokes typed before the key may still be
+        waiting for translation. The key is then queued behind them,
+        to be sent with output.send_key_event after their output, and
+        True is returned; otherwise the caller lets the key through.
+        """
+        if self._jobs is None or not self._jobs.unfinished_tasks:
+            return False
+        self._jobs.put((self._loop_output.send_key_event,
+                        (keyval, keycode, state)))
+        return True
+
+    def save_state(self, key):
+        """Move the translator state to the state cache under key."""
+        self._submit(self._save_state, key)
+
+    def _save_state(self, key):
+        state = self.translator.get_state()
+        if state.translations:
+            state_cache.put(key, state)
+        else:
+            state_cache.discard(key)
+        self.translator.clear_state()
+
+    def restore_state(self, key):
+        """Take back the translator state saved under key, if any."""
+        self._submit(self._restore_state, key)
+
+    def _restore_state(self, key):
+        state = state_cache.pop(key)
+        if state is not None:
+            self.translator.set_state(state)
+
+    def forget_state(self, key):
+        """Drop the state saved under key, after any save still queued."""
+        self._submit(state_cache.discard, key)
+
+    def _suggest(self, undo, do, prev):
+        """Translator listener offering shorter briefs for the last word."""
+        index = self.suggestions
+        if index is None:
+            return
+        briefs = []
+        if do:
+            t = do[-1]
+            briefs = index.briefs(self.translator.get_dictionary(),
+                                  t.english, t.rtfcre)
+        if briefs or self._showing_suggestions:
+            self._showing_suggestions = bool(briefs)
+            self.output.show_suggestions(briefs)
+
+    def _run_jobs(self):
+        """Translation worker loop, for pipelined mode."""
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            fn, args = job
+            try:
+                fn(*args)
+            except Exception:
+                log.exception("Error in translation worker")
+            # After the job's output, which pass_through waits for
+            self._jobs.task_done()
+
     def _stroke_notify(self, steno_keys):
+        if self._pending_strokes is not None:
+            # Still loading dictionaries
+            self._pending_strokes.append(steno_keys)
+            return
+        if self._jobs is not None:
+            queued = monotonic() if latency.enabled else None
+            self._jobs.put((self._translate_queued, (steno_keys, queued)))
+            latency.end_stroke()
+            return
+        with latency.timed('stroke_notify'):
+            self._translate(steno_keys)
+        latency.end_stroke()
+
+    def _translate_queued(self, steno_keys, queued):
+        self._translate(steno_keys)
+        if queued is not None:
+            # From the end of the key event to the output being applied
+            latency.record('queued_stroke', monotonic() - queued)
+
+    def _translate(self, steno_keys):
         s = steno.Stroke(steno_keys)
         try:
-            self.translator.translate(s)
+            with latency.timed('translate'):
+                self.translator.translate(s)
+            if not profile.reported:
+                # Translated and output, after any wait for dictionaries
+                profile.finish('first stroke')
         except aware_formatter.StateMismatch:
+            log.dump("State mismatch")
             self.output.show_message("Resetting state")
             self.translator.clear_state()
             # Resend last stroke
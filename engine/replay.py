@@ -0,0 +1,173 @@
+"""Record and replay raw key event streams
+
+Engine.process_key_event can log every (keyval, keycode, state) it
+sees to a file, one event per line. Recorded or generated streams can
+then be replayed headlessly through a Stenotype and Steno pipeline
+writing to a FakeOutput, without IBus running.
+"""
+
+import plover.config
+from plover.steno_dictionary import StenoDictionary
+
+import plover_machine
+from ploverlink import Steno, default_options
+
+# Same value as ibus.modifier.RELEASE_MASK; not imported so that
+# replaying doesn't need the ibus bindings.
+RELEASE_MASK = 1 << 30
+
+
+class KeyEventRecorder(object):
+    """Append key events to a file while enabled."""
+
+    def __init__(self):
+        self.enabled = False
+        self._file = None
+
+    def start(self, filename):
+        self._file = open(filename, 'a', 1)
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def record(self, keyval, keycode, state):
+        self._file.write("%d %d %d\n" % (keyval, keycode, state))
+
+
+recorder = KeyEventRecorder()
+
+
+def load_events(filename):
+    """Read a recorded stream as a list of (keyval, keycode, state)."""
+    events = []
+    with open(filename) as f:
+        for line in f:
+            if line.strip():
+                events.append(tuple(int(x) for x in line.split()))
+    return events
+
+
+def stroke_to_keys(rtfcre):
+    """Split a simple stroke like 'KAT' or 'T-P' into steno keys.
+
+    Only handles the plain (unnumbered) steno order.
+    """
+    keys = []
+    right = False
+    for c in rtfcre:
+        if c == '-':
+            right = True
+        elif c == '#':
+            keys.append('#')
+        elif c in 'AO':
+            keys.append(c + '-')
+            right = True
+        elif c in 'EU':
+            keys.append('-' + c)
+            right = True
+        elif c == '*':
+            keys.append('*')
+            right = True
+        elif right:
+            keys.append('-' + c)
+        else:
+            keys.append(c + '-')
+    return keys
+
+
+def _steno_key_to_keycode():
+    keycodes = {}
+    for keycode, key in sorted(plover_machine.KEYCODE_TO_STENO_KEY.items()):
+        keycodes.setdefault(key, keycode)
+    return keycodes
+
+
+def strokes_to_events(strokes):
+    """Generate the key events a keyboard would send for strokes.
+
+    All keys of a stroke are pressed, then all released.
+    """
+    keycodes = _steno_key_to_keycode()
+    events = []
+    for stroke in strokes:
+        codes = [keycodes[k] for k in stroke_to_keys(stroke)]
+        for code in codes:
+            events.append((0, code, 0))
+        for code in codes:
+            events.append((0, code, RELEASE_MASK))
+    return events
+
+
+def make_dictionary(entries):
+    """Build a StenoDictionary from {'KAT/A/LOG': 'catalogue'}."""
+    d = StenoDictionary()
+    for strokes, translation in entries.iteritems():
+        d[tuple(strokes.split('/'))] = translation
+    return d
+
+
+class FakeOutput(object):
+    """Stand-in for the engine's output side.
+
+    Keeps the text before the cursor, as the client would report it
+    through surrounding text, and applies change_string to it.
+    """
+
+    def __init__(self):
+        self.text = u""
+        self.key_combinations = []
+        self.engine_commands = []
+        self.messages = []
+        self.suggestions = []
+        self.mismatches = 0
+
+    def change_string(self, before, after):
+        if not self.text.endswith(before):
+            self.mismatches += 1
+            return False
+        self.text = self.text[:len(self.text) - len(before)] + after
+        return True
+
+    def send_key_combination(self, c):
+        self.key_combinations.append(c)
+
+    def send_engine_command(self, c):
+        self.engine_commands.append(c)
+
+    def show_message(self, message):
+        self.messages.append(message)
+
+    def show_suggestions(self, briefs):
+        self.suggestions.append(briefs)
+
+
+class Pipeline(object):
+    """A headless Stenotype and Steno pipeline."""
+
+    def __init__(self, dicts, output=None, config=None, options=None):
+        if output is None:
+            output = FakeOutput()
+        if config is None:
+            config = plover.config.Config()
+        if options is None:
+            options = default_options()
+        self.output = output
+        self.machine = plover_machine.Stenotype({'arpeggiate': False})
+        self.steno = Steno(self.machine, self.output, config=config,
+                           dicts=dicts, options=options)
+
+    def process_key_event(self, keyval, keycode, state):
+        """Dispatch an event the way Engine.process_key_event does."""
+        if (state & ~RELEASE_MASK):
+            return False
+        if state & RELEASE_MASK:
+            return self.machine.key_up(keycode)
+        return self.machine.key_down(keycode)
+
+    def replay(self, events):
+        for keyval, keycode, state in events:
+            self.process_key_event(keyval, keycode, state)
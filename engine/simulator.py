@@ -0,0 +1,278 @@
+"""Headless multi-context load simulator
+
+Runs the daemon -- main.IMApp, factory.EngineFactory and engine.Engine
+-- with headless_ibus in place of IBus, typing into many input
+contexts at once from main loop timers, to size the daemon for
+multi-seat and VDI machines without X sessions. Engines read the
+Plover config and [IBus Plover] options as the daemon does.
+
+    python simulator.py [-c COUNTS] [-t SECONDS] [-r RATE] [-s SEATS]
+                        [-f SECONDS] [-v] [EVENTS_FILE...]
+
+For each context count in COUNTS (default 1,5,10,25,50), contexts are
+added up to that count and typed into for -t SECONDS (default 10).
+Each seat types RATE strokes a second (default 4) into its focused
+context; by default every context is a seat of its own. With -s the
+contexts are shared among SEATS seats, each of which moves focus to
+its next context every -f SECONDS (default 5) on average, as a user
+switching windows does.
+
+Strokes come from the benchmark corpora, or from recorded key event
+streams (see replay.py).
+
+Each step reports process CPU use, the RSS and its growth since the
+previous step (the first includes the dictionaries), and the latency
+from a stroke's key events to its first change to the client's text,
+over all contexts and for the worst one; strokes that change no text
+are not counted. Timer lag is how late the main loop ran the typing
+timers, which grows once it cannot keep up. calls/str counts engine
+calls that would go over D-Bus. -v also reports each context.
+"""
+
+import os
+import sys
+import random
+import getopt
+
+import headless_ibus
+headless_ibus.install()
+
+import gobject
+
+from main import IMApp
+from latency import monotonic, Histogram
+import benchmark
+import memory
+import replay
+
+# Time for output still queued in the main loop to reach the clients
+DRAIN_TIME = 0.5
+
+
+def split_strokes(events):
+    """Split a key event stream into the events of each stroke."""
+    strokes = []
+    current = []
+    down = set()
+    for keyval, keycode, state in events:
+        current.append((keyval, keycode, state))
+        if state & replay.RELEASE_MASK:
+            down.discard(keycode)
+            if not down:
+                strokes.append(current)
+                current = []
+        else:
+            down.add(keycode)
+    return strokes
+
+
+class SimulatedContext(object):
+    """An input context and the latency of strokes typed into it."""
+
+    def __init__(self, client):
+        self.client = client
+        client.output_callback = self._output
+        self.reset()
+
+    def reset(self):
+        self.latency = Histogram()
+        self.strokes = 0
+        self._calls_before = sum(self.client.calls.itervalues())
+        self._stroke_start = None
+
+    @property
+    def calls(self):
+        return sum(self.client.calls.itervalues()) - self._calls_before
+
+    def type_stroke(self, events):
+        self.strokes += 1
+        self._stroke_start = monotonic()
+        for event in events:
+            self.client.process_key_event(*event)
+
+    def _output(self, client):
+        if self._stroke_start is not None:
+            self.latency.add(monotonic() - self._stroke_start)
+            self._stroke_start = None
+
+
+class Seat(object):
+    """A user typing into one of their contexts at a time."""
+
+    def __init__(self, simulator, contexts):
+        self.simulator = simulator
+        self.contexts = contexts
+        self.current = 0
+        self.position = simulator.rng.randrange(len(simulator.strokes))
+
+    def start(self):
+        for n, context in enumerate(self.contexts):
+            if n != self.current and context.client.focused:
+                context.client.focus_out()
+        if not self.contexts[self.current].client.focused:
+            self.contexts[self.current].client.focus_in()
+        self._switch_at = monotonic() + self._focus_time()
+        self._schedule()
+
+    def _focus_time(self):
+        return self.simulator.rng.expovariate(
+            1.0 / self.simulator.focus_interval)
+
+    def _schedule(self):
+        simulator = self.simulator
+        interval = simulator.rng.uniform(0.7, 1.3) / simulator.rate
+        self._due = monotonic() + interval
+        gobject.timeout_add(int(interval * 1000), self._type, simulator.step)
+
+    def _type(self, step):
+        simulator = self.simulator
+        if step != simulator.step or not simulator.running:
+            return False
+        now = monotonic()
+        simulator.lag.add(max(now - self._due, 0.0))
+        if len(self.contexts) > 1 and now >= self._switch_at:
+            self.contexts[self.current].client.focus_out()
+            self.current = (self.current + 1) % len(self.contexts)
+            self.contexts[self.current].client.focus_in()
+            self._switch_at = now + self._focus_time()
+        self.contexts[self.current].type_stroke(
+            simulator.strokes[self.position])
+        self.position = (self.position + 1) % len(simulator.strokes)
+        self._schedule()
+        return False
+
+
+class Simulator(object):
+    def __init__(self, bus, strokes, counts, duration=10.0, rate=4.0,
+                 seats=None, focus_interval=5.0, verbose=False):
+        self.bus = bus
+        self.strokes = strokes
+        self.counts = counts
+        self.duration = duration
+        self.rate = rate
+        self.seats = seats
+        self.focus_interval = focus_interval
+        self.verbose = verbose
+        self.rng = random.Random(0)
+        self.contexts = []
+        self.step = 0
+        self.running = False
+        self.lag = Histogram()
+        self._steps = None
+
+    def start(self):
+        self._steps = self._run()
+        return self._advance()
+
+    def _advance(self):
+        """Run the next part of _run, after the delay it yielded."""
+        try:
+            delay = next(self._steps)
+        except StopIteration:
+            return False
+        gobject.timeout_add(int(delay * 1000), self._advance)
+        return False
+
+    def _run(self):
+        print "%8s %5s %9s %6s %9s %8s %7s %7s %7s %7s %9s %8s %9s" % (
+            "contexts", "seats", "strokes/s", "cpu %", "cpu us/str",
+            "rss MB", "+MB", "p50 ms", "p95 ms", "p99 ms", "worst p99",
+            "lag p99", "calls/str")
+        previous_rss = memory.rss()
+        for count in self.counts:
+            while len(self.contexts) < count:
+                self.contexts.append(
+                    SimulatedContext(self.bus.create_input_context()))
+            while any(c.client.engine.steno.loading for c in self.contexts):
+                yield 0.1
+            n = min(self.seats or count, count)
+            seats = [Seat(self, self.contexts[i::n]) for i in xrange(n)]
+            for context in self.contexts:
+                context.reset()
+            self.lag = Histogram()
+            self.step += 1
+            self.running = True
+            start = monotonic()
+            cpu = sum(os.times()[:2])
+            for seat in seats:
+                seat.start()
+            yield self.duration
+            self.running = False
+            yield DRAIN_TIME
+            elapsed = monotonic() - start
+            cpu = sum(os.times()[:2]) - cpu
+            rss = memory.rss()
+            self._report(count, n, elapsed, cpu, rss, previous_rss)
+            previous_rss = rss
+        self.bus.close()
+
+    def _report(self, count, seats, elapsed, cpu, rss, previous_rss):
+        latency = Histogram()
+        for context in self.contexts:
+            latency.merge(context.latency)
+        strokes = sum(c.strokes for c in self.contexts)
+        worst = max(c.latency.percentile(99) for c in self.contexts)
+        calls = sum(c.calls for c in self.contexts)
+        if rss is None:
+            rss = previous_rss = 0
+        print "%8d %5d %9.1f %6.1f %9.0f %8.1f %7.1f %7.2f %7.2f %7.2f " \
+              "%9.2f %8.2f %9.1f" % (
+                count, seats, strokes / self.duration, cpu / elapsed * 100,
+                cpu / max(strokes, 1) * 1e6, rss / memory.MB,
+                (rss - previous_rss) / memory.MB,
+                latency.percentile(50) * 1e3, latency.percentile(95) * 1e3,
+                latency.percentile(99) * 1e3, worst * 1e3,
+                self.lag.percentile(99) * 1e3, float(calls) / max(strokes, 1))
+        if self.verbose:
+            for context in self.contexts:
+                h = context.latency
+                print "    %-40s %6d strokes %7.2f %7.2f %7.2f ms %6d calls" % (
+                    context.client.object_path, context.strokes,
+                    h.percentile(50) * 1e3, h.percentile(95) * 1e3,
+                    h.percentile(99) * 1e3, context.calls)
+        sys.stdout.flush()
+
+
+def main():
+    counts = [1, 5, 10, 25, 50]
+    duration = 10.0
+    rate = 4.0
+    seats = None
+    focus_interval = 5.0
+    verbose = False
+    opts, args = getopt.getopt(sys.argv[1:], "c:t:r:s:f:v",
+                               ["contexts=", "duration=", "rate=", "seats=",
+                                "focus-interval=", "verbose"])
+    for o, a in opts:
+        if o in ("-c", "--contexts"):
+            counts = sorted(int(n) for n in a.split(','))
+        elif o in ("-t", "--duration"):
+            duration = float(a)
+        elif o in ("-r", "--rate"):
+            rate = float(a)
+        elif o in ("-s", "--seats"):
+            seats = int(a)
+        elif o in ("-f", "--focus-interval"):
+            focus_interval = float(a)
+        elif o in ("-v", "--verbose"):
+            verbose = True
+
+    if args:
+        strokes = []
+        for filename in args:
+            strokes.extend(split_strokes(replay.load_events(filename)))
+    else:
+        strokes = [replay.strokes_to_events([stroke])
+                   for name, corpus in benchmark.CORPORA
+                   for stroke in corpus.split()]
+
+    # Dictionaries are loaded on background threads
+    gobject.threads_init()
+    app = IMApp(False)
+    simulator = Simulator(headless_ibus.buses[-1], strokes, counts,
+                          duration, rate, seats, focus_interval, verbose)
+    gobject.idle_add(simulator.start)
+    app.run()
+
+if __name__ == "__main__":
+    main()
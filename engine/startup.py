@@ -0,0 +1,49 @@
+"""Startup phase timing for --profile-startup
+
+Phases of daemon startup mark the wall time at which they finish.
+Marks are always taken, as there are only a handful; the report is
+only written when profiling was asked for, once the first stroke has
+been translated and output (or at exit if none was). Marks after the
+report, e.g. from engines created later, are dropped.
+"""
+
+import time
+import threading
+
+import log
+
+
+class StartupProfile(object):
+    def __init__(self):
+        self.enabled = False
+        self.reported = False
+        self.start = time.time()
+        self.marks = []
+        self._lock = threading.Lock()
+
+    def mark(self, phase):
+        if not self.reported:
+            self.marks.append((phase, time.time()))
+
+    def report(self):
+        lines = ["%-32s %10s %10s" % ("phase", "ms", "total ms")]
+        last = self.start
+        for phase, t in self.marks:
+            lines.append("%-32s %10.1f %10.1f" % (
+                phase, (t - last) * 1e3, (t - self.start) * 1e3))
+            last = t
+        return "\n".join(lines)
+
+    def finish(self, phase):
+        """Mark the last phase and log the report, once."""
+        # Pipelines translate on their own workers in pipelined mode
+        with self._lock:
+            if self.reported:
+                return
+            self.mark(phase)
+            self.reported = True
+        if self.enabled:
+            log.info("Startup profile\n%s", self.report())
+
+
+profile = StartupProfile()
@@ -0,0 +1,92 @@
+"""Translator state kept for unfocused input contexts
+
+Each input context has its own engine and translator. When a context
+loses focus its translator state (the recent translations used for
+undo and multi-stroke lookups) is moved here, and it is moved back
+when the context is focused again. The cache is shared by all contexts
+and bounded by an estimate of the memory the states hold; the least
+recently used states are dropped first, which only costs those
+contexts their undo history.
+"""
+
+import sys
+import threading
+import collections
+
+# Rough per-object costs, in bytes, used by estimate_size
+STATE_OVERHEAD = 512
+STROKE_SIZE = 256
+
+
+def estimate_size(state):
+    """Estimate the number of bytes held by a translator state."""
+    size = STATE_OVERHEAD
+    pending = list(state.translations)
+    tail = getattr(state, 'tail', None)
+    if tail is not None:
+        pending.append(tail)
+    while pending:
+        t = pending.pop()
+        size += sys.getsizeof(t) + sys.getsizeof(t.__dict__)
+        size += sys.getsizeof(t.english) + len(t.strokes) * STROKE_SIZE
+        size += sum(sys.getsizeof(s) for s in t.rtfcre)
+        pending.extend(t.replaced)
+    return size
+
+
+class StateCache(object):
+    """LRU of translator states keyed by input context.
+
+    Used from translation worker threads in pipelined mode, so access
+    is locked.
+    """
+
+    def __init__(self, limit=512 * 1024):
+        self.limit = limit
+        self.size = 0
+        self._states = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, key, state):
+        size = estimate_size(state)
+        with self._lock:
+            self._discard(key)
+            if size > self.limit:
+                return
+            self._states[key] = (state, size)
+            self.size += size
+            self._evict()
+
+    def pop(self, key):
+        """Remove and return the state stored for key, or None."""
+        with self._lock:
+            entry = self._states.get(key)
+            if entry is None:
+                return None
+            self._discard(key)
+            return entry[0]
+
+    def discard(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        entry = self._states.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def _evict(self):
+        while self.size > self.limit:
+            key, (state, size) = self._states.popitem(last=False)
+            self.size -= size
+
+    def set_limit(self, limit):
+        with self._lock:
+            self.limit = limit
+            self._evict()
+
+    def __len__(self):
+        return len(self._states)
+
+
+cache = StateCache()
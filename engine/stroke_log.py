@@ -0,0 +1,149 @@
+"""Background stroke and translation logging
+
+Plover's stroke and translation log, as enabled in its Logging
+Configuration, written without touching the disk on the stroke path.
+Strokes and translations are appended to an in-memory queue; a writer
+thread formats them and appends them to the log file once a second,
+with an fsync every few seconds. The file is rotated by size, like
+Plover's own log. At exit, and when a pipeline is closed, everything
+queued is written and synced regardless of the interval.
+"""
+
+import os
+import time
+import atexit
+import threading
+import collections
+
+import log
+
+FLUSH_INTERVAL = 1.0
+FSYNC_INTERVAL = 10.0
+MAX_BYTES = 10 * 1024 * 1024
+BACKUP_COUNT = 9
+
+
+def format_record(record):
+    timestamp, kind, obj = record
+    if kind == 'stroke':
+        message = u"Stroke(%s)" % u" ".join(obj)
+    elif kind == 'undo':
+        message = u"*%s" % obj
+    else:
+        message = u"%s" % obj
+    line = u"%s,%03d %s\n" % (
+        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)),
+        int(timestamp * 1000) % 1000, message)
+    return line.encode('utf-8')
+
+
+class StrokeLog(object):
+    """Append-only, size-rotated log file written by a background thread."""
+
+    def __init__(self, filename, max_bytes=MAX_BYTES,
+                 backup_count=BACKUP_COUNT):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+        self._file = None
+        self._unsynced = False
+        self._last_fsync = time.time()
+        writer = threading.Thread(target=self._run)
+        writer.daemon = True
+        writer.start()
+        atexit.register(self.flush, force=True)
+
+    # Machine stroke callback and translator listener. These only
+    # queue the record; formatting happens on the writer thread.
+
+    def log_stroke(self, steno_keys):
+        self._queue.append((time.time(), 'stroke', steno_keys))
+
+    def log_translation(self, undo, do, prev):
+        now = time.time()
+        for t in undo:
+            self._queue.append((now, 'undo', t))
+        for t in do:
+            self._queue.append((now, 'do', t))
+
+    def _run(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self, force=False):
+        """Write out the queued records. Safe to call from any thread.
+
+        The file is synced every FSYNC_INTERVAL seconds, or now if force
+        is true.
+        """
+        with self._lock:
+            lines = []
+            while self._queue:
+                lines.append(format_record(self._queue.popleft()))
+            try:
+                if lines:
+                    self._write(''.join(lines))
+                if self._unsynced and (force or
+                        time.time() - self._last_fsync >= FSYNC_INTERVAL):
+                    os.fsync(self._file.fileno())
+                    self._unsynced = False
+                    self._last_fsync = time.time()
+            except EnvironmentError:
+                log.exception("Writing stroke log %s failed", self.filename)
+                self._close()
+
+    def _write(self, data):
+        if self._file is None:
+            self._open()
+        if self.max_bytes and \
+                self._file.tell() + len(data) > self.max_bytes:
+            self._rotate()
+        self._file.write(data)
+        self._file.flush()
+        self._unsynced = True
+
+    def _rotate(self):
+        """Rename filename to filename.1, and so on, and start afresh."""
+        self._close()
+        for n in xrange(self.backup_count - 1, 0, -1):
+            source = "%s.%d" % (self.filename, n)
+            if os.path.exists(source):
+                os.rename(source, "%s.%d" % (self.filename, n + 1))
+        if self.backup_count:
+            os.rename(self.filename, self.filename + ".1")
+        else:
+            os.remove(self.filename)
+        self._open()
+
+    def _open(self):
+        self._file = open(self.filename, 'ab')
+        # The position of a file opened for appending is only moved to
+        # the end by the first write; size checks need it there now.
+        self._file.seek(0, os.SEEK_END)
+
+    def _close(self):
+        if self._file is not None:
+            try:
+                if self._unsynced:
+                    os.fsync(self._file.fileno())
+                self._file.close()
+            except EnvironmentError:
+                pass
+            self._file = None
+            self._unsynced = False
+
+
+_logs = {}
+_logs_lock = threading.Lock()
+
+
+def get_stroke_log(filename):
+    """Return the StrokeLog for filename, shared by all pipelines."""
+    with _logs_lock:
+        stroke_log = _logs.get(filename)
+        if stroke_log is None:
+            stroke_log = _logs[filename] = StrokeLog(filename)
+        return stroke_log
@@ -0,0 +1,134 @@
+"""Reverse index for brief suggestions
+
+Maps the text of dictionary translations to the keys that write it,
+so that after each translation the engine can offer shorter briefs
+for the word just written. Texts are case-folded, and translations
+with formatting or commands in them are left out. The keys of each
+text are kept shortest first, so a query stops at the first key no
+shorter than the one used. The distinct texts are also kept sorted,
+for prefix queries. Texts and keys are stored UTF-8 encoded, which
+sorts the same and takes a fraction of the memory.
+
+Like the stroke index, an index is built on the dictionary loader
+thread, shared by every pipeline over the same dictionaries through
+the indexes cache, and updated for changed keys only. Entries are
+never removed: a key whose translation changed stays under its old
+text as well. Queries check each key against the dictionary
+collection, so only keys that really write the text are suggested.
+"""
+
+import sys
+import bisect
+
+from index_cache import IndexCache
+
+# Suggestions offered for one word, at most
+SUGGESTION_COUNT = 5
+
+
+def normalize(text):
+    """The indexed form of a translation, or None if not indexed."""
+    if not text or '{' in text:
+        return None
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    return text.strip().lower().encode('utf-8') or None
+
+
+def _size(key):
+    """Sort key for '/'-joined keys: fewer strokes, then fewer keys."""
+    return (key.count('/'), len(key))
+
+
+class SuggestionIndex(object):
+    """Translation text -> keys, over dictionaries in any order."""
+
+    def __init__(self, dicts):
+        # Holding the dictionaries keeps their ids valid as cache keys.
+        self.dicts = list(dicts)
+        # text -> key, or tuple of keys, shortest first, since few
+        # texts have more than one; keys are strokes joined by '/'.
+        self._keys = {}
+        for d in self.dicts:
+            for key, value in d.iteritems():
+                self._add(key, value)
+        self._texts = sorted(self._keys)
+
+    def _add(self, key, value):
+        """Index key under value; return the text if it is new."""
+        text = normalize(value)
+        if text is None:
+            return None
+        key = u'/'.join(key).encode('utf-8')
+        keys = self._keys.get(text)
+        if keys is None:
+            self._keys[text] = key
+            return text
+        if not isinstance(keys, tuple):
+            keys = (keys,)
+        if key not in keys:
+            self._keys[text] = tuple(sorted(keys + (key,), key=_size))
+        return None
+
+    def update(self, dictionary, key):
+        """Index the current translation of key in dictionary."""
+        text = self._add(key, dictionary.get(key))
+        if text is not None:
+            bisect.insort(self._texts, text)
+
+    def _keys_for(self, text):
+        keys = self._keys.get(text, ())
+        if not isinstance(keys, tuple):
+            keys = (keys,)
+        return keys
+
+    def briefs(self, collection, text, used, limit=SUGGESTION_COUNT):
+        """Return keys shorter than used that write text in collection.
+
+        used is the key tuple the text was written with. Shorter means
+        fewer strokes, or as many strokes with fewer keys; the shortest
+        come first.
+        """
+        text = normalize(text)
+        if text is None:
+            return []
+        used_size = _size(u'/'.join(used).encode('utf-8'))
+        found = []
+        for key in self._keys_for(text):
+            if _size(key) >= used_size or len(found) == limit:
+                break
+            strokes = tuple(key.decode('utf-8').split(u'/'))
+            if normalize(collection.lookup(strokes)) == text:
+                found.append(u'/'.join(strokes))
+        return found
+
+    def starting_with(self, prefix, limit=SUGGESTION_COUNT):
+        """Return up to limit (text, keys) pairs, texts starting with prefix."""
+        prefix = normalize(prefix)
+        if prefix is None:
+            return []
+        texts = self._texts
+        found = []
+        i = bisect.bisect_left(texts, prefix)
+        while i < len(texts) and len(found) < limit and \
+                texts[i].startswith(prefix):
+            found.append((texts[i].decode('utf-8'),
+                          [k.decode('utf-8') for k in self._keys_for(texts[i])]))
+            i += 1
+        return found
+
+    def memory_usage(self):
+        """Approximate number of bytes held by the index."""
+        size = sys.getsizeof(self._keys) + sys.getsizeof(self._texts)
+        for text, keys in self._keys.iteritems():
+            size += sys.getsizeof(text) + sys.getsizeof(keys)
+            if isinstance(keys, tuple):
+                size += sum(sys.getsizeof(k) for k in keys)
+        return size
+
+    def __len__(self):
+        """Number of distinct texts."""
+        return len(self._keys)
+
+
+indexes = IndexCache(SuggestionIndex)
@@ -0,0 +1,64 @@
+"""Packed in-memory dictionary storage"""
+
+import unittest
+
+from compact_dictionary import CompactDictionary, compact
+import replay
+
+ENTRIES = {
+    'KAT': 'cat',
+    'TKOG': 'dog',
+    'KAT/-S': 'cats',
+    'TKOG/-S': 'dogs',
+    'KAT/KAT': 'cat',
+}
+
+
+class CompactDictionaryTest(unittest.TestCase):
+    def setUp(self):
+        self.source = replay.make_dictionary(ENTRIES)
+        self.d = compact(self.source)
+
+    def test_same_entries(self):
+        self.assertEqual(dict(self.d.iteritems()),
+                         dict(self.source.iteritems()))
+        self.assertEqual(sorted(self.d), sorted(self.source))
+        self.assertEqual(len(self.d), len(ENTRIES))
+        self.assertEqual(self.d.longest_key, 2)
+        self.assertEqual(self.d[('KAT', 'KAT')], u'cat')
+        self.assertIn(('TKOG', '-S'), self.d)
+
+    def test_missing_keys(self):
+        # Known strokes, unknown key; and an unknown stroke
+        self.assertNotIn(('-S', 'KAT'), self.d)
+        self.assertIsNone(self.d.get(('-Z',)))
+        self.assertRaises(KeyError, lambda: self.d[('KAT', '-Z')])
+
+    def test_repeated_translations_stored_once(self):
+        self.assertEqual(len(self.d._offsets), len(set(ENTRIES.values())) + 1)
+
+    def test_set_and_delete(self):
+        self.d[('S', 'KAT', '-S')] = u'is cats'
+        self.d[('KAT',)] = u'kitten'
+        self.assertEqual(self.d[('KAT',)], u'kitten')
+        self.assertEqual(self.d.longest_key, 3)
+        del self.d[('S', 'KAT', '-S')]
+        self.assertEqual(self.d.longest_key, 2)
+        self.assertRaises(KeyError, self.d.__delitem__, ('S', 'KAT', '-S'))
+        self.assertEqual(len(self.d), len(ENTRIES))
+
+    def test_memory_usage_counts_offsets_once(self):
+        before = self.d.memory_usage()
+        self.d._offsets.extend([0] * 100)
+        self.assertEqual(self.d.memory_usage() - before,
+                         100 * self.d._offsets.itemsize)
+
+    def test_empty(self):
+        d = CompactDictionary()
+        self.assertEqual(len(d), 0)
+        self.assertEqual(d.longest_key, 0)
+        self.assertIsNone(d.get(('KAT',)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+"""Compiled dictionaries and their in-memory overlay"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import dictionary_cache
+
+ENTRIES = {
+    'KAT': 'cat',
+    'TKOG': 'dog',
+    'KAT/-S': 'cats',
+}
+
+
+class CompiledDictionaryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache_dir = dictionary_cache.CACHE_DIR
+        dictionary_cache.CACHE_DIR = os.path.join(self.tmp, 'cache')
+        filename = os.path.join(self.tmp, 'main.json')
+        with open(filename, 'w') as f:
+            json.dump(ENTRIES, f)
+        self.d = dictionary_cache.load(filename)
+
+    def tearDown(self):
+        dictionary_cache.CACHE_DIR = self.cache_dir
+        shutil.rmtree(self.tmp)
+
+    def assertEntries(self, expected):
+        self.assertEqual(dict(self.d.iteritems()), expected)
+        self.assertEqual(len(self.d), len(expected))
+        self.assertEqual(sorted(self.d), sorted(expected))
+
+    def test_lookup(self):
+        self.assertEqual(self.d[('KAT', '-S')], u'cats')
+        self.assertEqual(self.d.get(('-S',)), None)
+        self.assertEqual(self.d.longest_key, 2)
+        self.assertEntries({('KAT',): u'cat', ('TKOG',): u'dog',
+                            ('KAT', '-S'): u'cats'})
+
+    def test_add_and_override(self):
+        self.d[('-S',)] = u's'
+        self.d[('KAT',)] = u'kitten'
+        self.d[('KAT',)] = u'kitty'
+        self.d[('S', 'KAT', '-S')] = u'is cats'
+        self.assertEqual(self.d[('KAT',)], u'kitty')
+        self.assertEqual(self.d.longest_key, 3)
+        self.assertEntries({('KAT',): u'kitty', ('TKOG',): u'dog',
+                            ('KAT', '-S'): u'cats', ('-S',): u's',
+                            ('S', 'KAT', '-S'): u'is cats'})
+
+    def test_delete(self):
+        del self.d[('TKOG',)]
+        self.assertNotIn(('TKOG',), self.d)
+        self.assertRaises(KeyError, self.d.__delitem__, ('TKOG',))
+        self.assertRaises(KeyError, self.d.__delitem__, ('-S',))
+        self.assertEntries({('KAT',): u'cat', ('KAT', '-S'): u'cats'})
+
+    def test_delete_overlay(self):
+        # Added, then deleted: gone
+        self.d[('-S',)] = u's'
+        del self.d[('-S',)]
+        # Overridden, then deleted: the file's entry is gone too
+        self.d[('KAT',)] = u'kitten'
+        del self.d[('KAT',)]
+        self.assertEntries({('TKOG',): u'dog', ('KAT', '-S'): u'cats'})
+
+    def test_add_after_delete(self):
+        del self.d[('KAT',)]
+        self.d[('KAT',)] = u'kitten'
+        self.assertEntries({('KAT',): u'kitten', ('TKOG',): u'dog',
+                            ('KAT', '-S'): u'cats'})
+
+    def test_overlay_not_written(self):
+        self.d[('-S',)] = u's'
+        del self.d[('KAT',)]
+        reloaded = dictionary_cache.load(self.d.get_path())
+        self.assertEqual(len(reloaded), 3)
+        self.assertEqual(reloaded[('KAT',)], u'cat')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+"""Stroke index of compiled dictionaries, mapped from an index file"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import dictionary_cache
+import dictionary_collection
+from dictionary_collection import MappedStrokeIndex, StrokeIndex
+
+MAIN = {
+    'KAT': 'cat',
+    'KAT/-S': 'cats',
+    'TKOG': 'dog',
+    'S/TKOG': 'is dog',
+}
+
+USER = {
+    'KAT': 'kitten',
+    'TKOG/-S': 'dogs',
+}
+
+PROBES = [
+    ('KAT',), ('-S',), ('TKOG',), ('KAT', '-S'), ('TKOG', '-S'),
+    ('S', 'TKOG'), ('S',), ('-Z',), ('S', 'KAT'),
+]
+
+
+class MappedStrokeIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache_dir = dictionary_cache.CACHE_DIR
+        dictionary_cache.CACHE_DIR = os.path.join(self.tmp, 'cache')
+        self.dicts = [self.load('main.json', MAIN),
+                      self.load('user.json', USER)]
+
+    def tearDown(self):
+        dictionary_cache.CACHE_DIR = self.cache_dir
+        shutil.rmtree(self.tmp)
+
+    def load(self, name, entries):
+        filename = os.path.join(self.tmp, name)
+        with open(filename, 'w') as f:
+            json.dump(entries, f)
+        return dictionary_cache.load(filename)
+
+    def assertSameIndex(self, index, expected):
+        for key in PROBES:
+            self.assertIs(index.find_dictionary(key),
+                          expected.find_dictionary(key), key)
+            self.assertEqual(index.longest_key_ending_with(key),
+                             expected.longest_key_ending_with(key), key)
+        self.assertEqual(len(index), len(expected))
+
+    def test_written_then_mapped(self):
+        index = dictionary_collection.build_index(self.dicts)
+        self.assertIsInstance(index, MappedStrokeIndex)
+        self.assertTrue(os.path.exists(
+            dictionary_collection.index_file_name(self.dicts)))
+        self.assertSameIndex(index, StrokeIndex(self.dicts))
+        self.assertSameIndex(dictionary_collection.build_index(self.dicts),
+                             StrokeIndex(self.dicts))
+
+    def test_changes(self):
+        index = dictionary_collection.build_index(self.dicts)
+        main, user = self.dicts
+        user[('S', 'KAT')] = u'is cat'
+        index.update(user, ('S', 'KAT'))
+        del user[('KAT',)]
+        index.update(user, ('KAT',))
+        main[('-Z',)] = u'zed'
+        index.update(main, ('-Z',))
+        expected = StrokeIndex(self.dicts)
+        self.assertSameIndex(index, expected)
+        # Changed keys are applied again on top of the file
+        self.assertSameIndex(dictionary_collection.build_index(self.dicts),
+                             expected)
+
+    def test_stale_index_rewritten(self):
+        dictionary_collection.build_index(self.dicts)
+        filename = os.path.join(self.tmp, 'user.json')
+        with open(filename, 'w') as f:
+            json.dump(dict(USER, **{'-Z': 'zed'}), f)
+        os.utime(filename, (0, 0))
+        self.dicts[1] = dictionary_cache.load(filename)
+        self.assertSameIndex(dictionary_collection.build_index(self.dicts),
+                             StrokeIndex(self.dicts))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+"""Engine output checks, against headless_ibus clients"""
+
+import time
+import threading
+import unittest
+
+import headless_ibus
+headless_ibus.install()
+
+import gobject
+from ibus import keysyms, modifier
+import plover.config
+
+import engine
+import keymaps
+import ploverlink
+import replay
+from state_cache import cache as state_cache
+
+RETURN_KEYCODE = 28
+
+
+def make_steno(machine, output):
+    """A pipeline without dictionaries or the user's Plover config."""
+    return ploverlink.Steno(machine, output, config=plover.config.Config(),
+                            dicts=[], options=ploverlink.default_options())
+
+
+class ChangeStringTest(unittest.TestCase):
+    def setUp(self):
+        self._steno = engine.Steno
+        engine.Steno = make_steno
+        self.engine = engine.Engine(headless_ibus.Bus(), "/test/1")
+        self.client = self.engine.client
+
+    def tearDown(self):
+        engine.Steno = self._steno
+
+    def test_replace_long_translation(self):
+        long_text = u"".join(unichr(ord(u"a") + n % 26) for n in xrange(250))
+        self.assertTrue(self.engine.change_string(u"", long_text))
+        self.assertTrue(self.engine.change_string(long_text, u" short"))
+        self.assertEqual(self.client.text, u" short")
+
+    def test_replace_long_text_after_resync(self):
+        long_text = u"x" * 250
+        self.client.text = u"before " + long_text
+        self.engine.reset()
+        self.assertTrue(self.engine.change_string(long_text, u"y"))
+        self.assertEqual(self.client.text, u"before y")
+
+    def test_mismatch(self):
+        self.client.text = u"abc"
+        self.engine.reset()
+        self.assertFalse(self.engine.change_string(u"xyz", u""))
+        self.assertEqual(self.client.text, u"abc")
+
+
+class KeymapTest(unittest.TestCase):
+    def setUp(self):
+        self._steno = engine.Steno
+        engine.Steno = make_steno
+        self.engines = [engine.Engine(headless_ibus.Bus(), "/test/%d" % n)
+                        for n in (1, 2)]
+
+    def tearDown(self):
+        engine.Steno = self._steno
+        keymaps.selected = None
+
+    def test_switch_applies_on_focus_in(self):
+        first, second = self.engines
+        first.property_activate(u"keymap.dvorak")
+        second.focus_in()
+        dvorak = keymaps.get_keymaps()['dvorak']
+        self.assertIs(second.machine._keycode_bits, dvorak[0])
+
+
+def make_pipelined_steno(machine, output):
+    """A pipelined pipeline translating KAT as 'cat'."""
+    options = ploverlink.default_options()
+    options['pipelined'] = True
+    return ploverlink.Steno(machine, output, config=plover.config.Config(),
+                            dicts=[replay.make_dictionary({'KAT': 'cat'})],
+                            options=options)
+
+
+def run_until(condition, timeout=5.0):
+    """Run the main loop until condition() is true or timeout passes."""
+    loop = gobject.MainLoop()
+    deadline = time.time() + timeout
+
+    def check():
+        if condition() or time.time() > deadline:
+            loop.quit()
+            return False
+        return True
+    gobject.timeout_add(10, check)
+    loop.run()
+
+
+class PipelinedTestCase(unittest.TestCase):
+    def setUp(self):
+        self._steno = engine.Steno
+        engine.Steno = make_pipelined_steno
+        self.engine = engine.Engine(headless_ibus.Bus(), "/test/1")
+        self.client = self.engine.client
+
+    def tearDown(self):
+        self.engine.steno.close()
+        engine.Steno = self._steno
+
+    def type_strokes(self, *strokes):
+        for event in replay.strokes_to_events(strokes):
+            self.client.process_key_event(*event)
+
+    def type_return(self):
+        for state in (0, modifier.RELEASE_MASK):
+            self.client.process_key_event(keysyms.Return, RETURN_KEYCODE,
+                                          state)
+
+
+class PipelinedPassThroughTest(PipelinedTestCase):
+    def test_key_after_stroke(self):
+        self.type_strokes('KAT')
+        self.type_return()
+        run_until(lambda: u"\n" in self.client.text)
+        self.assertEqual(self.client.text, u" cat\n")
+
+    def test_key_after_undo(self):
+        self.type_strokes('KAT')
+        run_until(lambda: self.client.text)
+        self.type_strokes('*')
+        self.type_return()
+        self.type_strokes('KAT')
+        run_until(lambda: self.client.text.endswith(u"cat"))
+        self.assertEqual(self.client.text, u"\n cat")
+        self.assertEqual(self.engine.steno.translator.get_state()
+                         .translations[-1].english, u"cat")
+
+
+class PipelinedDestroyTest(PipelinedTestCase):
+    def test_destroy_after_focus_out(self):
+        self.type_strokes('KAT')
+        run_until(lambda: self.client.text)
+        steno = self.engine.steno
+        # Hold the worker so that the state is still being saved
+        held = threading.Event()
+        steno._submit(held.wait)
+        self.engine.focus_out()
+        self.engine.do_destroy()
+        held.set()
+        # Only the worker's stop marker left
+        run_until(lambda: steno._jobs.unfinished_tasks == 1)
+        self.assertIsNone(state_cache.pop("/test/1"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,33 @@
+"""Checks of the tables headless_ibus stands in with"""
+
+import imp
+import unittest
+
+import headless_ibus
+
+
+class MinimalTablesTest(unittest.TestCase):
+    def setUp(self):
+        self._find_module = imp.find_module
+
+        def find_module(name, path=None):
+            raise ImportError("No module named %s" % name)
+        imp.find_module = find_module
+
+    def tearDown(self):
+        imp.find_module = self._find_module
+
+    def test_fallback_without_bindings(self):
+        keysyms, modifier = headless_ibus._load_tables()
+        self.assertEqual(keysyms.name_to_keycode('Return'), 0xff0d)
+        self.assertEqual(keysyms.name_to_keycode('asciitilde'), ord('~'))
+        self.assertEqual(keysyms.name_to_keycode('F12'), 0xffc9)
+        self.assertEqual(keysyms.name_to_keycode('no_such_key'),
+                         keysyms.VoidSymbol)
+        self.assertEqual(keysyms.keycode_to_name(ord('a')), 'a')
+        self.assertEqual(modifier.ALT_MASK, modifier.MOD1_MASK)
+        self.assertEqual(modifier.RELEASE_MASK, 1 << 30)
+
+
+if __name__ == "__main__":
+    unittest.main()
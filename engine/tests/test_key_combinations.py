@@ -0,0 +1,86 @@
+"""Key combination strings compiled into key events"""
+
+import unittest
+
+import headless_ibus
+headless_ibus.install()
+
+from ibus import keysyms, modifier
+
+from key_combinations import KeyCombinationCompiler
+
+RELEASE = modifier.RELEASE_MASK
+
+
+class FakeKeymap(object):
+    """Keycodes for a few keys; 'A' needs Shift."""
+
+    TABLE = {
+        keysyms.a: (30, 0),
+        keysyms.A: (30, modifier.SHIFT_MASK),
+        keysyms.Tab: (15, 0),
+        keysyms.Alt_L: (56, 0),
+        keysyms.Control_L: (29, 0),
+        keysyms.Shift_L: (42, 0),
+    }
+
+    def lookup(self, keysym):
+        return self.TABLE.get(keysym, (0, 0))
+
+
+class KeyCombinationCompilerTest(unittest.TestCase):
+    def setUp(self):
+        self.compiler = KeyCombinationCompiler(FakeKeymap(), cache_size=2)
+
+    def test_single_keys(self):
+        self.assertEqual(self.compiler.compile('a Tab'), (
+            (keysyms.a, 30, 0), (keysyms.a, 30, RELEASE),
+            (keysyms.Tab, 15, 0), (keysyms.Tab, 15, RELEASE)))
+
+    def test_held_modifier(self):
+        # As in X events, the state is the one before the event
+        self.assertEqual(self.compiler.compile('Alt_L(Tab)'), (
+            (keysyms.Alt_L, 56, 0),
+            (keysyms.Tab, 15, modifier.MOD1_MASK),
+            (keysyms.Tab, 15, modifier.MOD1_MASK | RELEASE),
+            (keysyms.Alt_L, 56, modifier.MOD1_MASK | RELEASE)))
+
+    def test_nested_and_keymap_modifiers(self):
+        control = modifier.CONTROL_MASK
+        both = control | modifier.SHIFT_MASK
+        self.assertEqual(self.compiler.compile('Control_L(Shift_L(a) A)'), (
+            (keysyms.Control_L, 29, 0),
+            (keysyms.Shift_L, 42, control),
+            (keysyms.a, 30, both),
+            (keysyms.a, 30, both | RELEASE),
+            (keysyms.Shift_L, 42, both | RELEASE),
+            (keysyms.A, 30, both),
+            (keysyms.A, 30, both | RELEASE),
+            (keysyms.Control_L, 29, control | RELEASE)))
+
+    def test_unknown_and_unbalanced(self):
+        # Unknown names are skipped but still pair with their
+        # parentheses; unclosed keys are released at the end.
+        self.assertEqual(self.compiler.compile('Nonsense(a) Alt_L(Tab'), (
+            (keysyms.a, 30, 0), (keysyms.a, 30, RELEASE),
+            (keysyms.Alt_L, 56, 0),
+            (keysyms.Tab, 15, modifier.MOD1_MASK),
+            (keysyms.Tab, 15, modifier.MOD1_MASK | RELEASE),
+            (keysyms.Alt_L, 56, modifier.MOD1_MASK | RELEASE)))
+        self.assertEqual(self.compiler.compile('a ) )'),
+                         self.compiler.compile('a'))
+
+    def test_cache(self):
+        events = self.compiler.compile('a')
+        self.assertIs(self.compiler.compile('a'), events)
+        self.compiler.compile('Tab')
+        self.compiler.compile('a')
+        # Tab is now the least recently used of two
+        self.compiler.compile('Alt_L')
+        self.assertEqual(list(self.compiler._cache), ['a', 'Alt_L'])
+        self.compiler.set_keymap(FakeKeymap())
+        self.assertIsNot(self.compiler.compile('a'), events)
+
+
+if __name__ == '__main__':
+    unittest.main()
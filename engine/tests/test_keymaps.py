@@ -0,0 +1,41 @@
+"""Keymap profiles read from config files"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import keymaps
+from plover_machine import compile_keymap
+
+
+class ReadKeymapsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, text):
+        filename = os.path.join(self.directory, 'keymaps.cfg')
+        with open(filename, 'w') as f:
+            f.write(text)
+        return keymaps.read_keymaps([filename])
+
+    def test_number_key(self):
+        result = self.read("[Keymap test]\n"
+                           "S- = 30\n"
+                           "number = 2 3\n")
+        self.assertEqual(result, {'test': {30: 'S-', 2: '#', 3: '#'}})
+        keycode_bits, bit_keys = compile_keymap(result['test'])
+        self.assertEqual(bit_keys[keycode_bits[2].bit_length() - 1], '#')
+
+    def test_unknown_key(self):
+        result = self.read("[Keymap test]\n"
+                           "Q- = 30\n"
+                           "S- = 31\n")
+        self.assertEqual(result, {'test': {31: 'S-'}})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+"""Least recently used eviction of cached translator states"""
+
+import unittest
+
+from plover.steno import Stroke
+from plover.translation import Translation
+
+import replay
+from state_cache import StateCache, estimate_size
+from undo_history import UndoState
+
+
+def make_state(english):
+    state = UndoState(4)
+    stroke = Stroke(replay.stroke_to_keys('KAT'))
+    state.translations.append(Translation([stroke], english))
+    return state
+
+
+class StateCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.states = dict((key, make_state(u'cat'))
+                           for key in ('a', 'b', 'c'))
+        # Room for two states
+        self.size = estimate_size(self.states['a'])
+        self.cache = StateCache(limit=2 * self.size)
+
+    def put(self, *keys):
+        for key in keys:
+            self.cache.put(key, self.states[key])
+
+    def test_oldest_evicted(self):
+        self.put('a', 'b', 'c')
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.size, 2 * self.size)
+        self.assertIsNone(self.cache.pop('a'))
+        self.assertIs(self.cache.pop('b'), self.states['b'])
+
+    def test_put_again_refreshes(self):
+        self.put('a', 'b', 'a', 'c')
+        self.assertIsNone(self.cache.pop('b'))
+        self.assertIs(self.cache.pop('a'), self.states['a'])
+        self.assertIs(self.cache.pop('c'), self.states['c'])
+        self.assertEqual(self.cache.size, 0)
+
+    def test_pop_and_discard(self):
+        self.put('a', 'b')
+        self.assertIs(self.cache.pop('a'), self.states['a'])
+        self.assertIsNone(self.cache.pop('a'))
+        self.cache.discard('b')
+        self.cache.discard('b')
+        self.assertEqual((len(self.cache), self.cache.size), (0, 0))
+
+    def test_too_large_not_kept(self):
+        self.cache.set_limit(self.size - 1)
+        self.put('a')
+        self.assertEqual(len(self.cache), 0)
+
+    def test_lower_limit_evicts(self):
+        self.put('a', 'b')
+        self.cache.set_limit(self.size)
+        self.assertIsNone(self.cache.pop('a'))
+        self.assertIs(self.cache.pop('b'), self.states['b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+"""Translator lookback through the stroke index"""
+
+import unittest
+
+from plover.steno import Stroke
+
+import replay
+from dictionary_collection import IndexedDictionaryCollection
+from undo_history import UndoHistory, UndoTranslator
+
+ENTRIES = {
+    'S': 'is',
+    'TEFT': 'test',
+    'TEFT/-G': 'testing',
+    'S/S/S/S/S/S/S/S/S/TEFT/-G': 'long',
+}
+
+
+class CountingCollection(IndexedDictionaryCollection):
+    def __init__(self):
+        IndexedDictionaryCollection.__init__(self)
+        self.lookups = 0
+
+    def lookup(self, key):
+        self.lookups += 1
+        return IndexedDictionaryCollection.lookup(self, key)
+
+
+class LookbackTest(unittest.TestCase):
+    def setUp(self):
+        self.collection = CountingCollection()
+        self.translator = UndoTranslator()
+        self.translator.set_dictionary(self.collection)
+        self.collection.set_dicts([replay.make_dictionary(ENTRIES)])
+        self.output = []
+        self.translator.add_listener(
+            lambda undo, do, prev: self.output.extend(t.english for t in do))
+
+    def translate(self, strokes):
+        for stroke in strokes.split('/'):
+            self.translator.translate(
+                Stroke(replay.stroke_to_keys(stroke)))
+
+    def test_fewer_lookups(self):
+        self.translate('S/S/S/S/S/S/S/S/S')
+        self.collection.lookups = 0
+        # No key longer than one stroke ends with TEFT; Plover's
+        # translator would look back through all nine.
+        self.translate('TEFT')
+        self.assertEqual(self.collection.lookups, 1)
+
+    def test_multistroke_entries(self):
+        self.translate('TEFT/-G')
+        self.assertEqual(self.output, ['test', 'testing'])
+        del self.output[:]
+        self.translate('S/S/S/S/S/S/S/S/S/TEFT/-G')
+        self.assertEqual(self.output[-1], 'long')
+
+
+class UndoHistoryTest(unittest.TestCase):
+    def wrapped(self):
+        """A full history of capacity 4 whose oldest item isn't first."""
+        history = UndoHistory(4)
+        history.extend(range(6))
+        return history
+
+    def test_append_evicts_oldest(self):
+        history = self.wrapped()
+        self.assertEqual(list(history), [2, 3, 4, 5])
+        self.assertEqual(history.evicted, 1)
+        self.assertEqual(len(history), 4)
+
+    def test_access_after_wraparound(self):
+        history = self.wrapped()
+        self.assertEqual(history[0], 2)
+        self.assertEqual(history[-1], 5)
+        self.assertEqual(history[1:3], [3, 4])
+        self.assertEqual(history[-2:], [4, 5])
+        self.assertEqual(list(reversed(history)), [5, 4, 3, 2])
+        self.assertRaises(IndexError, lambda: history[4])
+
+    def test_delete_newest_after_wraparound(self):
+        history = self.wrapped()
+        del history[-2:]
+        self.assertEqual(list(history), [2, 3])
+        history.extend([6, 7, 8])
+        self.assertEqual(list(history), [3, 6, 7, 8])
+        self.assertEqual(history.evicted, 2)
+
+    def test_delete_oldest_after_wraparound(self):
+        history = self.wrapped()
+        del history[:3]
+        self.assertEqual(list(history), [5])
+        history.extend([6, 7, 8])
+        self.assertEqual(list(history), [5, 6, 7, 8])
+
+    def test_delete_middle_after_wraparound(self):
+        history = self.wrapped()
+        del history[1]
+        self.assertEqual(list(history), [2, 4, 5])
+        history.append(6)
+        self.assertEqual(list(history), [2, 4, 5, 6])
+
+    def test_remove_newest_occurrence(self):
+        history = UndoHistory(4)
+        history.extend([1, 2, 1, 3, 1])
+        history.remove(1)
+        self.assertEqual(list(history), [2, 1, 3])
+        self.assertRaises(ValueError, history.remove, 4)
+
+    def test_resize(self):
+        history = self.wrapped()
+        history.resize(2)
+        self.assertEqual(list(history), [4, 5])
+        self.assertEqual(history.evicted, 3)
+        history.resize(3)
+        history.append(6)
+        self.assertEqual(list(history), [4, 5, 6])
+        self.assertEqual(history.capacity, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+"""Frame-rate limited UI updates
+
+Changes to the auxiliary and preedit text only mark the engine's UI as
+needing an update; the update itself runs from the main loop at most
+FRAME_RATE times a second, and sends only what changed since the last
+one. A change after a quiet period is sent on the next idle, so single
+updates are not held back.
+"""
+
+import gobject
+
+from latency import monotonic
+
+FRAME_RATE = 30
+
+
+class UIScheduler(object):
+    def __init__(self, update, frame_rate=FRAME_RATE):
+        self._update = update
+        self.interval = 1.0 / frame_rate
+        self._scheduled = False
+        self._last_update = monotonic() - self.interval
+
+    def invalidate(self):
+        """Have update() called by the end of the current frame."""
+        if self._scheduled:
+            return
+        self._scheduled = True
+        delay = self._last_update + self.interval - monotonic()
+        if delay <= 0:
+            gobject.idle_add(self._run, priority=gobject.PRIORITY_LOW)
+        else:
+            gobject.timeout_add(int(delay * 1000) + 1, self._run,
+                                priority=gobject.PRIORITY_LOW)
+
+    def _run(self):
+        self._scheduled = False
+        self._last_update = monotonic()
+        self._update()
+        return False
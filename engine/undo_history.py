@@ -0,0 +1,198 @@
+"""Bounded undo history for the translator
+
+Plover's translator keeps its recent translations in a list and trims
+it from the front after every stroke, walking the whole history to
+count strokes, so each stroke costs time in proportion to the undo
+depth. UndoHistory keeps them in a fixed-capacity ring buffer instead:
+appending is O(1), and once the buffer is full each append evicts the
+oldest translation, which becomes the state's tail.
+
+The capacity counts translations, each of at least one stroke, so at
+least that many strokes can be undone, and it bounds the memory each
+context's history holds.
+
+UndoTranslator also looks back through the history only as far as the
+longest dictionary key ending with the new stroke, when the dictionary
+collection can tell (see dictionary_collection), rather than as far as
+the longest key of all.
+"""
+
+import itertools
+
+from plover.translation import Translator, Translation
+
+
+class UndoHistory(object):
+    """The most recent translations, oldest first, up to capacity.
+
+    Supports the list operations Translator uses on its history.
+    """
+
+    def __init__(self, capacity):
+        self._items = [None] * capacity
+        self._start = 0
+        self._length = 0
+        # The most recently evicted translation
+        self.evicted = None
+
+    @property
+    def capacity(self):
+        return len(self._items)
+
+    def _index(self, i):
+        """Position in _items of item i, counting from the oldest."""
+        return (self._start + i) % len(self._items)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for i in xrange(self._length):
+            yield self._items[self._index(i)]
+
+    def __reversed__(self):
+        for i in xrange(self._length - 1, -1, -1):
+            yield self._items[self._index(i)]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._items[self._index(n)]
+                    for n in xrange(*i.indices(self._length))]
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError("undo history index out of range")
+        return self._items[self._index(i)]
+
+    def __delitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self._length)
+        else:
+            if i < 0:
+                i += self._length
+            if not 0 <= i < self._length:
+                raise IndexError("undo history index out of range")
+            start, stop, step = i, i + 1, 1
+        if stop <= start:
+            return
+        if step == 1 and stop == self._length:
+            # Undone translations: drop the newest
+            for n in xrange(start, stop):
+                self._items[self._index(n)] = None
+            self._length = start
+        elif step == 1 and start == 0:
+            for n in xrange(stop):
+                self._items[self._index(n)] = None
+            self._start = self._index(stop)
+            self._length -= stop
+        else:
+            items = list(self)
+            del items[i]
+            self._replace(items)
+
+    def _replace(self, items):
+        self._items = [None] * len(self._items)
+        self._start = 0
+        self._length = 0
+        self.extend(items)
+
+    def append(self, item):
+        capacity = len(self._items)
+        if self._length == capacity:
+            self.evicted = self._items[self._start]
+            self._items[self._start] = item
+            self._start = (self._start + 1) % capacity
+        else:
+            self._items[self._index(self._length)] = item
+            self._length += 1
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def remove(self, item):
+        """Remove the newest occurrence of item."""
+        # Translator only removes the newest translation; list.remove
+        # would search from the oldest.
+        for i in xrange(self._length - 1, -1, -1):
+            t = self._items[self._index(i)]
+            if t is item or t == item:
+                del self[i]
+                return
+        raise ValueError("translation not in undo history")
+
+    def resize(self, capacity):
+        """Change the capacity, evicting the oldest items if needed."""
+        items = list(self)
+        if len(items) > capacity:
+            self.evicted = items[-capacity - 1]
+            items = items[-capacity:]
+        self._items = [None] * capacity
+        self._replace(items)
+
+
+class UndoState(object):
+    """Translator state with its history in an UndoHistory.
+
+    Stands in for plover.translation's own state class. The capacity
+    is set by restrict_size, which Translator calls after each stroke.
+    """
+
+    def __init__(self, capacity=1):
+        self.translations = UndoHistory(capacity)
+
+    @property
+    def tail(self):
+        """The newest translation evicted from the history."""
+        return self.translations.evicted
+
+    def last(self):
+        """Get the most recent translation."""
+        if self.translations:
+            return self.translations[-1]
+        return self.tail
+
+    def restrict_size(self, n):
+        """Keep the last n translations."""
+        n = max(n, 1)
+        if n != self.translations.capacity:
+            self.translations.resize(n)
+
+
+class UndoTranslator(Translator):
+    """Translator keeping its history in an UndoState."""
+
+    def __init__(self):
+        Translator.__init__(self)
+        self.set_state(UndoState())
+
+    def clear_state(self):
+        self.set_state(UndoState(self.get_state().translations.capacity))
+
+    def _find_translation_helper(self, stroke, suffixes=()):
+        longest_key_ending_with = getattr(self.get_dictionary(),
+                                          'longest_key_ending_with', None)
+        if longest_key_ending_with is None or suffixes:
+            # With suffixes, keys end with the stroke less a suffix key
+            return Translator._find_translation_helper(self, stroke,
+                                                       suffixes)
+        # As in Translator, but bounded by the keys ending with stroke
+        longest = longest_key_ending_with((stroke.rtfcre,))
+        history = self.get_state().translations
+        num_strokes = 1
+        translation_count = 0
+        for t in reversed(history):
+            num_strokes += len(t)
+            if num_strokes > longest:
+                break
+            translation_count += 1
+        translations = history[len(history) - translation_count:]
+        for i in xrange(len(translations)):
+            replaced = translations[i:]
+            strokes = list(itertools.chain(*[t.strokes for t in replaced]))
+            strokes.append(stroke)
+            mapping = self._lookup(strokes, suffixes)
+            if mapping is not None:
+                t = Translation(strokes, mapping)
+                t.replaced = replaced
+                return t